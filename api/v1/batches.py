@@ -0,0 +1,523 @@
+"""
+文件与批处理 API（兼容 OpenAI Files / Batch API）
+POST /v1/files 上传 JSONL 请求文件，POST /v1/batches 在后台逐行运行引擎：
+受模型 RPM 限制、以低于交互请求的优先级排队，进度逐行写入磁盘，重启后从断点继续
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Set, Tuple
+
+from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Form, Query
+from fastapi.responses import FileResponse
+from pydantic import ValidationError
+
+from models import ChatCompletionRequest, FileObject, BatchCreateRequest, BatchObject
+from config import config, ApiKeyConfig
+from utils.admission import admission_controller
+from utils.rate_limiter import rate_limiter
+from utils.response_cache import response_cache
+from utils.sse_writer import dumps_bytes
+from utils.batch_store import (
+    BatchStore, BATCH_VALIDATING, BATCH_FAILED, BATCH_IN_PROGRESS, BATCH_FINALIZING,
+    BATCH_COMPLETED, BATCH_EXPIRED, BATCH_CANCELLING, BATCH_CANCELLED,
+)
+from api.v1.pipeline import prepare_request
+from .chat import verify_auth, run_completion, build_completion_response
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# 支持的批处理端点和完成时限
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+COMPLETION_WINDOWS = {"24h": 24 * 3600}
+# 上传文件的读取块大小
+UPLOAD_CHUNK = 1024 * 1024
+# 校验输入文件时最多报告的错误数量
+MAX_VALIDATION_ERRORS = 100
+# 有交互请求在排队时，批处理等待的间隔(秒)
+YIELD_INTERVAL = 1.0
+
+
+def _visible(record: Dict[str, Any], caller: Optional[ApiKeyConfig]) -> bool:
+    """文件和批处理只对创建它的密钥（以及管理员密钥）可见"""
+    return caller is None or caller.admin or record["owner"] == caller.name
+
+
+def _file_object(record: Dict[str, Any]) -> FileObject:
+    return FileObject(
+        id=record["id"],
+        bytes=record["bytes"],
+        created_at=record["created_at"],
+        filename=record["filename"],
+        purpose=record["purpose"],
+    )
+
+
+def _read_input(path: str, endpoint: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """读取并校验输入文件，返回 (请求列表, 错误列表)"""
+    requests: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    seen: Set[str] = set()
+    with open(path, "rb") as f:
+        for number, raw in enumerate(f, 1):
+            if not raw.strip():
+                continue
+            try:
+                item = json.loads(raw)
+            except ValueError:
+                item = None
+            if not isinstance(item, dict):
+                errors.append({"code": "invalid_json_line", "message": "Line is not a JSON object", "line": number})
+                continue
+            custom_id = item.get("custom_id")
+            body = item.get("body")
+            error = None
+            if not isinstance(custom_id, str) or not custom_id:
+                error = ("missing_required_parameter", "custom_id is required")
+            elif custom_id in seen:
+                error = ("duplicate_custom_id", f"Duplicate custom_id: {custom_id}")
+            elif item.get("method") != "POST":
+                error = ("invalid_method", "method must be POST")
+            elif item.get("url") != endpoint:
+                error = ("invalid_url", f"url must be {endpoint}")
+            elif not isinstance(body, dict) or not body.get("model"):
+                error = ("missing_required_parameter", "body.model is required")
+            elif config.get_model(body["model"]) is None:
+                error = ("model_not_found", f"Model {body['model']} not found")
+            if error:
+                errors.append({"code": error[0], "message": error[1], "line": number})
+                if len(errors) >= MAX_VALIDATION_ERRORS:
+                    break
+                continue
+            seen.add(custom_id)
+            requests.append({"custom_id": custom_id, "body": body})
+    if not requests and not errors:
+        errors.append({"code": "empty_file", "message": "Input file contains no requests", "line": None})
+    return requests, errors
+
+
+def _load_checkpoint(path: Path) -> Set[str]:
+    """读取已写入的结果行，返回已完成的 custom_id；截掉崩溃时只写了一半的最后一行"""
+    if not path.exists():
+        return set()
+    data = path.read_bytes()
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+        with open(path, "r+b") as f:
+            f.truncate(end)
+    return {json.loads(line)["custom_id"] for line in data[:end].splitlines() if line.strip()}
+
+
+def _append_lines(output, lines: List[bytes]):
+    """追加结果行并刷新到磁盘（在线程中执行，不阻塞事件循环）"""
+    output.write(b"".join(lines))
+    output.flush()
+
+
+class BatchManager:
+    """文件存储与批处理执行：每个批处理一个运行任务，内部由 batch_concurrency 个 worker 逐行执行"""
+
+    def __init__(self):
+        self.store: Optional[BatchStore] = None
+        self._runners: Dict[str, asyncio.Task] = {}
+        self._workers: Dict[str, List[asyncio.Task]] = {}
+        # 已请求取消的批处理
+        self._cancelled: Set[str] = set()
+
+    @property
+    def data_dir(self) -> Path:
+        return Path(config.batch_data_dir)
+
+    async def start(self):
+        """打开存储，继续执行上次未结束的批处理"""
+        self.store = await asyncio.to_thread(BatchStore, str(self.data_dir / "batches.db"))
+        active = await asyncio.to_thread(self.store.active_ids)
+        for batch_id in active:
+            self._spawn(batch_id)
+        if active:
+            logger.info(f"Resumed {len(active)} batches")
+
+    async def stop(self):
+        """停止运行中的批处理；进度已写入磁盘，下次启动时继续"""
+        runners = list(self._runners.values())
+        for task in runners:
+            task.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        if self.store:
+            self.store.close()
+            self.store = None
+
+    def _spawn(self, batch_id: str):
+        task = asyncio.create_task(self._run(batch_id))
+        self._runners[batch_id] = task
+        task.add_done_callback(lambda _: self._runners.pop(batch_id, None))
+
+    # ---------- 文件 ----------
+
+    async def save_file(self, upload: UploadFile, purpose: str, caller: Optional[ApiKeyConfig]) -> Dict[str, Any]:
+        """把上传内容分块写入磁盘，超过 file_max_mb 时返回 413"""
+        file_id = f"file-{uuid.uuid4().hex}"
+        files_dir = self.data_dir / "files"
+        files_dir.mkdir(parents=True, exist_ok=True)
+        path = files_dir / f"{file_id}.jsonl"
+        limit = int(config.file_max_mb * 1024 * 1024)
+        size = 0
+        try:
+            with open(path, "wb") as f:
+                while chunk := await upload.read(UPLOAD_CHUNK):
+                    size += len(chunk)
+                    if size > limit:
+                        raise HTTPException(status_code=413, detail=f"File exceeds {config.file_max_mb:g} MB")
+                    await asyncio.to_thread(f.write, chunk)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+        return await asyncio.to_thread(
+            self.store.create_file, file_id, upload.filename or f"{file_id}.jsonl", purpose,
+            str(path), size, caller.name if caller else None,
+        )
+
+    async def get_file(self, file_id: str, caller: Optional[ApiKeyConfig]) -> Optional[Dict[str, Any]]:
+        record = await asyncio.to_thread(self.store.get_file, file_id)
+        return record if record and _visible(record, caller) else None
+
+    async def list_files(self, caller: Optional[ApiKeyConfig], purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        owner = None if caller is None or caller.admin else caller.name
+        return await asyncio.to_thread(self.store.list_files, owner, purpose)
+
+    async def delete_file(self, record: Dict[str, Any]):
+        await asyncio.to_thread(self.store.delete_file, record["id"])
+        Path(record["path"]).unlink(missing_ok=True)
+
+    # ---------- 批处理 ----------
+
+    async def create(self, request: BatchCreateRequest, caller: Optional[ApiKeyConfig]) -> Dict[str, Any]:
+        if request.endpoint not in BATCH_ENDPOINTS:
+            raise HTTPException(status_code=400, detail=f"Unsupported endpoint: {request.endpoint}")
+        window = COMPLETION_WINDOWS.get(request.completion_window)
+        if window is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported completion_window: {request.completion_window}")
+        input_file = await self.get_file(request.input_file_id, caller)
+        if not input_file:
+            raise HTTPException(status_code=404, detail=f"File {request.input_file_id} not found")
+        if input_file["purpose"] != "batch":
+            raise HTTPException(status_code=400, detail="Input file must be uploaded with purpose 'batch'")
+
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = await asyncio.to_thread(
+            self.store.create_batch, batch_id, request.endpoint, request.input_file_id,
+            request.completion_window, int(time.time()) + window, request.metadata,
+            caller.name if caller else None,
+        )
+        self._spawn(batch_id)
+        return batch
+
+    async def get(self, batch_id: str, caller: Optional[ApiKeyConfig]) -> Optional[Dict[str, Any]]:
+        record = await asyncio.to_thread(self.store.get_batch, batch_id)
+        return record if record and _visible(record, caller) else None
+
+    async def list_batches(self, caller: Optional[ApiKeyConfig], after: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        owner = None if caller is None or caller.admin else caller.name
+        return await asyncio.to_thread(self.store.list_batches, owner, after, limit)
+
+    async def cancel(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        """请求取消：正在运行的请求立即中止，已完成的结果仍写入输出文件"""
+        batch_id = batch["id"]
+        await asyncio.to_thread(
+            self.store.update_batch, batch_id, status=BATCH_CANCELLING, cancelling_at=int(time.time())
+        )
+        self._cancelled.add(batch_id)
+        for task in self._workers.get(batch_id, []):
+            task.cancel()
+        return await asyncio.to_thread(self.store.get_batch, batch_id)
+
+    async def _run(self, batch_id: str):
+        try:
+            await self._process(batch_id)
+        except asyncio.CancelledError:
+            # 服务关闭：保持当前状态，下次启动时从断点继续
+            raise
+        except Exception as e:
+            logger.error(f"Batch {batch_id} crashed: {e}")
+            await asyncio.to_thread(
+                self.store.update_batch, batch_id, status=BATCH_FAILED, failed_at=int(time.time()),
+                errors={"object": "list", "data": [{"code": "server_error", "message": str(e), "line": None}]},
+            )
+        finally:
+            self._workers.pop(batch_id, None)
+
+    async def _process(self, batch_id: str):
+        batch = await asyncio.to_thread(self.store.get_batch, batch_id)
+        if batch["status"] == BATCH_CANCELLING:
+            self._cancelled.add(batch_id)
+
+        input_file = await asyncio.to_thread(self.store.get_file, batch["input_file_id"])
+        if input_file is None:
+            raise RuntimeError(f"Input file {batch['input_file_id']} was deleted")
+        requests, errors = await asyncio.to_thread(_read_input, input_file["path"], batch["endpoint"])
+        if errors:
+            logger.warning(f"Batch {batch_id} failed validation with {len(errors)} errors")
+            await asyncio.to_thread(
+                self.store.update_batch, batch_id, status=BATCH_FAILED, failed_at=int(time.time()),
+                errors={"object": "list", "data": errors},
+            )
+            return
+        if batch["status"] == BATCH_VALIDATING and batch_id not in self._cancelled:
+            await asyncio.to_thread(
+                self.store.update_batch, batch_id, status=BATCH_IN_PROGRESS, in_progress_at=int(time.time()),
+                request_counts={"total": len(requests), "completed": 0, "failed": 0},
+            )
+            batch["status"] = BATCH_IN_PROGRESS
+            logger.info(f"Batch {batch_id} started: {len(requests)} requests")
+
+        # 已写入输出文件和错误文件的请求即为断点
+        batch_dir = self.data_dir / batch_id
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        output_path, error_path = batch_dir / "output.jsonl", batch_dir / "errors.jsonl"
+        succeeded = await asyncio.to_thread(_load_checkpoint, output_path)
+        failed = await asyncio.to_thread(_load_checkpoint, error_path)
+        counts = {"total": len(requests), "completed": len(succeeded), "failed": len(failed)}
+        pending = deque(r for r in requests if r["custom_id"] not in succeeded and r["custom_id"] not in failed)
+
+        expired = False
+        with open(output_path, "ab") as output, open(error_path, "ab") as error_output:
+            if batch["status"] == BATCH_IN_PROGRESS and pending:
+                # 提交批处理的密钥（已从配置中删除时不再限制）
+                caller = config.get_api_key(batch["owner"]) if batch["owner"] else None
+
+                async def worker():
+                    nonlocal expired
+                    while pending and batch_id not in self._cancelled:
+                        if time.time() >= batch["expires_at"]:
+                            expired = True
+                            return
+                        item = pending.popleft()
+                        await self._yield_to_interactive(item["body"]["model"])
+                        line, ok = await self._execute(item, caller)
+                        await asyncio.to_thread(_append_lines, output if ok else error_output, [dumps_bytes(line) + b"\n"])
+                        counts["completed" if ok else "failed"] += 1
+                        await asyncio.to_thread(self.store.update_batch, batch_id, request_counts=dict(counts))
+
+                workers = [asyncio.create_task(worker()) for _ in range(min(max(config.batch_concurrency, 1), len(pending)))]
+                self._workers[batch_id] = workers
+                results = await asyncio.gather(*workers, return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        raise result
+
+            # 超过完成时限时，未运行的请求写入错误文件
+            if expired:
+                lines = []
+                for item in pending:
+                    line = {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": item["custom_id"],
+                        "response": None,
+                        "error": {"code": "batch_expired", "message": "This request could not be executed before the completion window expired."},
+                    }
+                    lines.append(dumps_bytes(line) + b"\n")
+                    counts["failed"] += 1
+                await asyncio.to_thread(_append_lines, error_output, lines)
+
+        if batch_id in self._cancelled:
+            status = BATCH_CANCELLED
+        elif expired:
+            status = BATCH_EXPIRED
+        else:
+            status = BATCH_COMPLETED
+        await self._finalize(batch_id, status, counts, output_path, error_path)
+
+    @staticmethod
+    def _interactive_waiting(model_id: str) -> bool:
+        """
+        模型的交互请求是否在排队：在并发闸门前排队（设置了 max_concurrent），
+        或者该模型有进行中的交互请求、且后端限流器前有优先级高于批处理的调用在排队
+        """
+        if admission_controller.waiting(model_id):
+            return True
+        return bool(
+            admission_controller.interactive(model_id)
+            and rate_limiter.waiting_above(config.batch_priority)
+        )
+
+    async def _yield_to_interactive(self, model_id: str):
+        """模型有交互请求在排队时暂不启动新的批处理请求"""
+        while self._interactive_waiting(model_id):
+            await asyncio.sleep(YIELD_INTERVAL)
+
+    async def _execute(self, item: Dict[str, Any], caller: Optional[ApiKeyConfig]) -> Tuple[Dict[str, Any], bool]:
+        """运行一行请求，返回 (结果行, 是否成功)"""
+        line = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "response": None, "error": None}
+        try:
+            request = ChatCompletionRequest(**{**item["body"], "stream": False})
+            model_config = config.get_model(request.model)
+            if not model_config:
+                raise HTTPException(status_code=404, detail=f"Model {request.model} not found")
+            prepared = prepare_request(request, model_config, priority=config.batch_priority, caller=caller)
+            cached = await response_cache.get(prepared.cache_key) if model_config.cache_ttl else None
+            if cached is not None:
+                response = build_completion_response(prepared, cached)
+            else:
+                response = await run_completion(prepared, cache_ttl=model_config.cache_ttl)
+        except (HTTPException, ValidationError) as e:
+            status_code, message = (e.status_code, e.detail) if isinstance(e, HTTPException) else (400, str(e))
+            line["response"] = {
+                "status_code": status_code,
+                "request_id": line["id"],
+                "body": {"error": {"message": message, "type": "invalid_request_error" if status_code < 500 else "server_error"}},
+            }
+            return line, False
+        except Exception as e:
+            logger.error(f"Batch request {item['custom_id']} failed: {e}")
+            line["error"] = {"code": "server_error", "message": str(e)}
+            return line, False
+        line["response"] = {"status_code": 200, "request_id": response.id, "body": response.model_dump(mode="json")}
+        return line, True
+
+    async def _finalize(self, batch_id: str, status: str, counts: Dict[str, int], output_path: Path, error_path: Path):
+        """登记输出文件和错误文件，写入最终状态"""
+        await asyncio.to_thread(
+            self.store.update_batch, batch_id, status=BATCH_FINALIZING,
+            finalizing_at=int(time.time()), request_counts=counts,
+        )
+        fields: Dict[str, Any] = {"status": status, f"{status}_at": int(time.time())}
+        # 文件 id 由批处理 id 决定，重启后重复登记时直接复用
+        suffix = batch_id[len("batch_"):]
+        for path, file_id, column in (
+            (output_path, f"file-{suffix}-output", "output_file_id"),
+            (error_path, f"file-{suffix}-errors", "error_file_id"),
+        ):
+            size = path.stat().st_size if path.exists() else 0
+            if not size:
+                continue
+            if await asyncio.to_thread(self.store.get_file, file_id) is None:
+                batch = await asyncio.to_thread(self.store.get_batch, batch_id)
+                await asyncio.to_thread(
+                    self.store.create_file, file_id, path.name, "batch_output", str(path), size, batch["owner"]
+                )
+            fields[column] = file_id
+        await asyncio.to_thread(self.store.update_batch, batch_id, **fields)
+        logger.info(f"Batch {batch_id} {status}: {counts['completed']} completed, {counts['failed']} failed")
+
+
+# 全局批处理管理器（在应用生命周期中启动和停止）
+batch_manager = BatchManager()
+
+
+# ---------- 文件 ----------
+
+@router.post("/v1/files", response_model=FileObject)
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    authorization: str = Header(None),
+):
+    """上传批处理输入文件（JSONL，purpose 为 batch）"""
+    caller = verify_auth(authorization)
+
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="Only purpose 'batch' is supported")
+    return _file_object(await batch_manager.save_file(file, purpose, caller))
+
+
+@router.get("/v1/files")
+async def list_files(purpose: Optional[str] = None, authorization: str = Header(None)):
+    """列出当前密钥的文件"""
+    caller = verify_auth(authorization)
+
+    files = await batch_manager.list_files(caller, purpose)
+    return {"object": "list", "data": [_file_object(record) for record in files]}
+
+
+@router.get("/v1/files/{file_id}", response_model=FileObject)
+async def get_file(file_id: str, authorization: str = Header(None)):
+    """查询文件信息"""
+    caller = verify_auth(authorization)
+
+    record = await batch_manager.get_file(file_id, caller)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+    return _file_object(record)
+
+
+@router.get("/v1/files/{file_id}/content")
+async def get_file_content(file_id: str, authorization: str = Header(None)):
+    """下载文件内容（如批处理的输出文件）"""
+    caller = verify_auth(authorization)
+
+    record = await batch_manager.get_file(file_id, caller)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+    return FileResponse(record["path"], media_type="application/jsonl", filename=record["filename"])
+
+
+@router.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str, authorization: str = Header(None)):
+    """删除文件"""
+    caller = verify_auth(authorization)
+
+    record = await batch_manager.get_file(file_id, caller)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"File {file_id} not found")
+    await batch_manager.delete_file(record)
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+# ---------- 批处理 ----------
+
+@router.post("/v1/batches", response_model=BatchObject)
+async def create_batch(request: BatchCreateRequest, authorization: str = Header(None)):
+    """创建批处理，立即返回，在后台运行"""
+    caller = verify_auth(authorization)
+
+    return BatchObject(**await batch_manager.create(request, caller))
+
+
+@router.get("/v1/batches")
+async def list_batches(
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    authorization: str = Header(None),
+):
+    """分页列出当前密钥的批处理（按创建时间倒序）"""
+    caller = verify_auth(authorization)
+
+    # 多取一条判断是否还有下一页
+    batches = await batch_manager.list_batches(caller, after, limit + 1)
+    data = [BatchObject(**record) for record in batches[:limit]]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0].id if data else None,
+        "last_id": data[-1].id if data else None,
+        "has_more": len(batches) > limit,
+    }
+
+
+@router.get("/v1/batches/{batch_id}", response_model=BatchObject)
+async def get_batch(batch_id: str, authorization: str = Header(None)):
+    """查询批处理状态和请求计数"""
+    caller = verify_auth(authorization)
+
+    batch = await batch_manager.get(batch_id, caller)
+    if not batch:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    return BatchObject(**batch)
+
+
+@router.post("/v1/batches/{batch_id}/cancel", response_model=BatchObject)
+async def cancel_batch(batch_id: str, authorization: str = Header(None)):
+    """取消批处理，已完成的请求结果仍会写入输出文件"""
+    caller = verify_auth(authorization)
+
+    batch = await batch_manager.get(batch_id, caller)
+    if not batch:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found")
+    if batch["status"] not in (BATCH_VALIDATING, BATCH_IN_PROGRESS):
+        raise HTTPException(status_code=409, detail=f"Cannot cancel a batch with status {batch['status']}")
+    return BatchObject(**await batch_manager.cancel(batch))
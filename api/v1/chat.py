@@ -2,113 +2,40 @@
 OpenAI 兼容的 Chat Completion API
 支持 DeepThink 和 UltraThink 模式
 """
+import asyncio
+import json
 import time
 import uuid
-import json
 import logging
-import asyncio
-from typing import AsyncIterator, Dict, Any, List
-from fastapi import APIRouter, HTTPException, Header
-from fastapi.responses import StreamingResponse, JSONResponse
+from contextlib import nullcontext
+from typing import Optional, Callable, Tuple
+from fastapi import APIRouter, HTTPException, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 
 from models import (
     ChatCompletionRequest, ChatCompletionResponse, ChatCompletionChoice, 
-    Message, Usage, MessageContent, extract_text_from_content
+    Message, Usage, ProgressEvent
 )
-from config import config
-from utils.openai_client import create_client
+from config import config, ApiKeyConfig
+from utils.sse_writer import SSEWriter
+from utils.engine_run import EngineRun, run_registry, parse_event_id
+from utils.single_flight import single_flight
+from utils.response_cache import response_cache, cache_directives, CachedEngine, EngineResult
+from utils.idempotency import idempotency_store, IdempotencyEntry
+from utils.admission import admission_controller, AdmissionRejected, AdmissionTicket
+from utils.client_pool import provider_clients
 from utils.summary_think import ThinkingSummaryGenerator, UltraThinkSummaryGenerator, generate_simple_thinking_tag
-from engine.deep_think import DeepThinkEngine
-from engine.ultra_think import UltraThinkEngine
+from api.v1.pipeline import PreparedRequest, prepare_request, build_engine, canonical_hash, resolve_timeout
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
-def extract_llm_params(request: ChatCompletionRequest) -> Dict[str, Any]:
-    """从请求中提取 LLM 参数"""
-    params = {}
-    
-    # 只提取 temperature 和 max_tokens 参数
-    if request.temperature is not None:
-        params['temperature'] = request.temperature
-    if request.max_tokens is not None:
-        params['max_tokens'] = request.max_tokens
-    
-    return params
-
-
-def process_user_messages(messages: List[Message]) -> List[Message]:
-    """
-    处理用户发送的消息列表：
-    1. 提取所有 system role 消息并合并
-    2. 将合并后的 system 消息转为 user 消息
-    3. 放在第一条 user role 消息的最前面
-    
-    Args:
-        messages: 原始消息列表
-    
-    Returns:
-        处理后的消息列表（不包含 system role）
-    """
-    system_messages = []
-    non_system_messages = []
-    
-    # 分离 system 消息和其他消息
-    for msg in messages:
-        if msg.role == "system":
-            system_messages.append(msg)
-        else:
-            non_system_messages.append(msg)
-    
-    # 如果没有 system 消息，直接返回原列表
-    if not system_messages:
-        return messages
-    
-    # 合并所有 system 消息
-    merged_system_content = []
-    for msg in system_messages:
-        content_text = extract_text_from_content(msg.content)
-        if content_text.strip():
-            merged_system_content.append(content_text)
-    
-    # 如果合并后为空，直接返回非 system 消息
-    if not merged_system_content:
-        return non_system_messages
-    
-    # 创建转换后的 user 消息（带有明确的标识）
-    system_as_user_content = "# System Instructions\n\n" + "\n\n---\n\n".join(merged_system_content)
-    system_as_user_msg = Message(
-        role="user",
-        content=system_as_user_content
-    )
-    
-    # 找到第一条 user 消息的位置
-    first_user_index = None
-    for i, msg in enumerate(non_system_messages):
-        if msg.role == "user":
-            first_user_index = i
-            break
-    
-    # 插入转换后的消息
-    if first_user_index is not None:
-        # 在第一条 user 消息之前插入
-        processed_messages = (
-            non_system_messages[:first_user_index] +
-            [system_as_user_msg] +
-            non_system_messages[first_user_index:]
-        )
-    else:
-        # 如果没有 user 消息，放在最前面
-        processed_messages = [system_as_user_msg] + non_system_messages
-    
-    return processed_messages
-
-
-def verify_auth(authorization: str = Header(None)) -> bool:
-    """验证 API 密钥"""
-    if not config.api_key:
-        return True  # 未设置密钥则不验证
+def verify_auth(authorization: str = Header(None)) -> Optional[ApiKeyConfig]:
+    """验证 API 密钥，返回调用方的密钥配置（未设置密钥时返回 None）"""
+    if not config.auth_enabled:
+        return None  # 未设置密钥则不验证
     
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing authorization header")
@@ -116,268 +43,197 @@ def verify_auth(authorization: str = Header(None)) -> bool:
     # 支持 "Bearer xxx" 或直接 "xxx"
     token = authorization.replace("Bearer ", "").strip()
     
-    if not config.validate_api_key(token):
+    caller = config.lookup_api_key(token)
+    if caller is None:
         raise HTTPException(status_code=401, detail="Invalid API key")
     
-    return True
-
-
-async def _run_engine_with_streaming(
-    engine,
-    request_id: str,
-    created: int,
-    model: str,
-    thinking_generator
-) -> AsyncIterator[str]:
-    """运行引擎并流式输出结果"""
-    progress_queue = []
-    
-    def on_progress(event):
-        """捕获进度事件"""
-        progress_queue.append(event)
-    
-    # 设置进度回调
-    engine.on_progress = on_progress
-    
-    # UltraThink 特殊处理
-    if hasattr(engine, 'on_agent_update'):
-        def on_agent_update(agent_id: str, update: Dict[str, Any]):
-            """捕获 Agent 更新"""
-            from models import ProgressEvent
-            progress_queue.append(ProgressEvent(
-                type="agent-update",
-                data={"agentId": agent_id, **update}
-            ))
-        engine.on_agent_update = on_agent_update
-    
-    # 在后台运行引擎
-    engine_task = asyncio.create_task(engine.run())
-    
+    return caller
+
+
+def create_thinking_generator(prepared: PreparedRequest):
+    """如果启用了 summary_think 或草稿流式输出,创建思维链生成器"""
+    model_config = prepared.model_config
+    if not (model_config.has_summary_think or prepared.stream_drafts):
+        return None
+    if model_config.level == "ultrathink":
+        return UltraThinkSummaryGenerator()
+    return ThinkingSummaryGenerator(mode="deepthink", stream_drafts=prepared.stream_drafts)
+
+
+def check_circuit(prepared: PreparedRequest):
+    """模型的主提供商熔断中、且没有可用的备用提供商或多目标路由时返回 503，请求不再排队占用资源"""
+    model_config = prepared.model_config
+    breaker = provider_clients.breaker(model_config.provider)
+    if not breaker.is_open or model_config.stage_targets:
+        return
+    provider_config = config.get_provider(model_config.provider)
+    if provider_config and provider_config.fallback and not provider_clients.breaker(provider_config.fallback).is_open:
+        return
+    retry_after = max(1, round(breaker.retry_after()))
+    raise HTTPException(
+        status_code=503,
+        detail=f"Provider {model_config.provider} is unavailable (circuit open)",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def admit(prepared: PreparedRequest) -> Optional[AdmissionTicket]:
+    """准入检查，提供商熔断时返回 503，排队时间超过最长等待时间或调用方密钥超出配额时返回 429"""
+    check_circuit(prepared)
     try:
-        # 流式发送进度
-        while not engine_task.done():
-            # 处理队列中的进度事件
-            while progress_queue:
-                event = progress_queue.pop(0)
-                # 如果启用了 summary_think,将事件转换为思维链
-                if thinking_generator:
-                    thinking_text = thinking_generator.process_event(event)
-                    if thinking_text:
-                        # 使用 reasoning_content 字段输出推理过程
-                        delta = {"reasoning_content": thinking_text}
-                        chunk_data = {
-                            "id": request_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": delta,
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-            await asyncio.sleep(0.1)  # 短暂等待避免busy loop
-        
-        # 获取最终结果
-        result = await engine_task
-        
-        # 处理剩余的进度事件
-        while progress_queue:
-            event = progress_queue.pop(0)
-            if thinking_generator:
-                thinking_text = thinking_generator.process_event(event)
-                if thinking_text:
-                    delta = {"reasoning_content": thinking_text}
-                    chunk_data = {
-                        "id": request_id,
-                        "object": "chat.completion.chunk",
-                        "created": created,
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": delta,
-                            "finish_reason": None
-                        }]
-                    }
-                    yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-        
-        # 流式发送最终答案
-        final_text = result.summary or result.final_solution
-        for i in range(0, len(final_text), 50):
-            chunk = final_text[i:i+50]
-            delta = {"content": chunk}
-            chunk_data = {
-                "id": request_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": model,
-                "choices": [{
-                    "index": 0,
-                    "delta": delta,
-                    "finish_reason": None
-                }]
-            }
-            yield f"data: {json.dumps(chunk_data)}\n\n"
-            
-    except GeneratorExit:
-        # 客户端断开连接，取消引擎任务
-        logger.info(f"Client disconnected for request {request_id}, cancelling engine task")
-        if engine_task and not engine_task.done():
-            engine_task.cancel()
-            try:
-                await engine_task
-            except asyncio.CancelledError:
-                pass  # 预期的取消异常
-        # 不重新抛出 GeneratorExit，让生成器正常结束
-    except (asyncio.CancelledError, Exception) as e:
-        # 其他异常情况，记录日志并取消任务
-        logger.error(f"Error during streaming for request {request_id}: {e}")
-        if engine_task and not engine_task.done():
-            engine_task.cancel()
-            try:
-                await engine_task
-            except asyncio.CancelledError:
-                pass
-        raise  # 重新抛出异常
+        return admission_controller.admit(
+            prepared.model_config, prepared.max_wait, prepared.usage, prepared.caller
+        )
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected request for model {prepared.request.model}: {e.reason}")
+        raise HTTPException(
+            status_code=429,
+            detail=e.reason,
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
 
-async def stream_chat_completion(
-    request: ChatCompletionRequest,
-    model_config,
-    provider_config,
-) -> AsyncIterator[str]:
-    """流式聊天补全"""
-    request_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+def create_stream_run(
+    prepared: PreparedRequest,
+    cached_result: Optional[EngineResult] = None,
+    controllable: bool = False,
+) -> EngineRun:
+    """创建流式聊天补全的引擎运行（尚未启动），缓存命中时直接输出缓存结果"""
+    # 运行 id 同时用于断线重连，使用完整的随机 id
+    request_id = f"chatcmpl-{uuid.uuid4().hex}"
     created = int(time.time())
     
-    # 提取 LLM 参数
-    llm_params = extract_llm_params(request)
-    
-    # 保留完整的对话历史
-    if not request.messages:
-        raise HTTPException(status_code=400, detail="No messages found")
-    
-    # 处理用户消息：将 system role 合并后转为 user 消息
-    processed_messages = process_user_messages(request.messages)
-    
-    # 提取最后一个用户消息作为当前问题
-    user_messages = [msg for msg in processed_messages if msg.role == "user"]
-    if not user_messages:
-        raise HTTPException(status_code=400, detail="No user message found")
-    
-    last_user_message = user_messages[-1]
-    # 保留原始的多模态内容（如果有图片）
-    problem_statement_raw = last_user_message.content
-    # 同时提取纯文本版本用于日志和摘要
-    problem_statement_text = extract_text_from_content(problem_statement_raw)
-    
-    # 构建结构化的对话历史（排除最后一条用户消息）
-    conversation_history = []
-    if len(processed_messages) > 1:
-        context_messages = processed_messages[:-1]  # 排除最后一条消息
-        for msg in context_messages:
-            conversation_history.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-    
-    # 创建后端客户端集合（支持每个阶段选择不同提供商）
-    max_retry = model_config.get_max_retry(default=config.max_retry)
-    provider_ids = {model_config.provider}
-    if hasattr(model_config, 'providers_by_stage') and model_config.providers_by_stage:
-        provider_ids.update([pid for pid in model_config.providers_by_stage.values() if pid])
-    clients_by_provider = {}
-    for pid in provider_ids:
-        pc = config.get_provider(pid)
-        if not pc:
-            raise HTTPException(status_code=500, detail=f"Provider {pid} not configured")
-        clients_by_provider[pid] = create_client(pc.base_url, pc.key, model_config.rpm, max_retry, pc.response_api)
-    # 默认客户端
-    client = clients_by_provider[model_config.provider]
-    
-    # 不再直接注入提示词，而是通过标志传递给引擎
-    # 引擎会在正确的时机执行 Ask 和 Plan 阶段
-    
-    # 如果启用了 summary_think,创建思维链生成器
-    thinking_generator = None
-    if model_config.has_summary_think:
-        if model_config.level == "ultrathink":
-            thinking_generator = UltraThinkSummaryGenerator()
-        else:
-            thinking_generator = ThinkingSummaryGenerator(mode="deepthink")
-    
+    if cached_result is not None:
+        engine, ticket = CachedEngine(cached_result), None
+    else:
+        engine = build_engine(prepared)
+        ticket = admit(prepared)
+    writer = SSEWriter(request_id, created, prepared.request.model)
+    return EngineRun(
+        engine, writer, create_thinking_generator(prepared),
+        usage=prepared.usage_dict if prepared.include_stream_usage else None,
+        admission=ticket,
+        controllable=controllable,
+        owner=prepared.caller.name if prepared.caller else None,
+    )
+
+
+async def run_completion(
+    prepared: PreparedRequest,
+    on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+    cache_ttl: Optional[float] = None,
+) -> ChatCompletionResponse:
+    """非流式运行引擎并构建响应，可选接收进度事件（后台任务使用）和写入响应缓存"""
+    engine = build_engine(prepared)
+    if on_progress:
+        engine.on_progress = on_progress
+    # 获得运行名额后才开始
+    async with admit(prepared) or nullcontext():
+        result = await engine.run()
+    if cache_ttl:
+        await response_cache.set(prepared.cache_key, result, cache_ttl)
+    return build_completion_response(prepared, result)
+
+
+def build_completion_response(prepared: PreparedRequest, result: EngineResult) -> ChatCompletionResponse:
+    """由引擎结果构建非流式响应"""
+    model_config = prepared.model_config
     
-    # 根据模型级别选择引擎
+    # 根据模型级别处理
+    reasoning_text = None
     if model_config.level == "ultrathink":
-        # UltraThink 模式
-        engine = UltraThinkEngine(
-            client=client,
-            model=model_config.model,
-            problem_statement=problem_statement_raw,
-            conversation_history=conversation_history,
-            max_iterations=model_config.max_iterations,
-            required_successful_verifications=model_config.required_verifications,
-            num_agents=model_config.num_agent,
-            parallel_run_agent=model_config.parallel_run_agent,
-            model_stages=model_config.models,
-            enable_parallel_check=model_config.parallel_check,
-            llm_params=llm_params,
-            clients_by_provider=clients_by_provider,
-            default_provider_id=model_config.provider,
-            provider_stages=getattr(model_config, 'providers_by_stage', {}),
-        )
+        response_text = result.summary or result.final_solution
+        
+        # 如果启用 summary_think,生成推理内容
+        if model_config.has_summary_think:
+            reasoning_text = generate_simple_thinking_tag("ultrathink")
     else:  # deepthink
-        # DeepThink 模式
-        engine = DeepThinkEngine(
-            client=client,
-            model=model_config.model,
-            problem_statement=problem_statement_raw,
-            conversation_history=conversation_history,
-            max_iterations=model_config.max_iterations,
-            required_successful_verifications=model_config.required_verifications,
-            model_stages=model_config.models,
-            enable_planning=model_config.has_plan_mode,
-            enable_parallel_check=model_config.parallel_check,
-            llm_params=llm_params,
-            clients_by_provider=clients_by_provider,
-            default_provider_id=model_config.provider,
-            provider_stages=getattr(model_config, 'providers_by_stage', {}),
-        )
+        #response_text = result.summary or result.final_solution
+        response_text = result.final_solution
     
-    # 使用统一的流式处理函数
-    async for chunk in _run_engine_with_streaming(
-        engine, request_id, created, request.model, thinking_generator
-    ):
-        yield chunk
+    # 构建响应
+    request_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+    created = int(time.time())
     
-    # 发送结束标记
-    chunk_data = {
-        "id": request_id,
-        "object": "chat.completion.chunk",
-        "created": created,
-        "model": request.model,
-        "choices": [{
-            "index": 0,
-            "delta": {},
-            "finish_reason": "stop"
-        }]
+    return ChatCompletionResponse(
+        id=request_id,
+        object="chat.completion",
+        created=created,
+        model=prepared.request.model,
+        choices=[
+            ChatCompletionChoice(
+                index=0,
+                message=Message(
+                    role="assistant",
+                    content=response_text,
+                    reasoning_content=reasoning_text
+                ),
+                finish_reason="stop"
+            )
+        ],
+        usage=Usage(**prepared.usage_dict())
+    )
+
+
+def _sse_response(
+    run: EngineRun,
+    after_seq: int,
+    http_request: Request,
+    cache_status: Optional[str] = None,
+) -> StreamingResponse:
+    """订阅运行输出的 SSE 响应"""
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "X-Run-Id": run.run_id,
     }
-    yield f"data: {json.dumps(chunk_data)}\n\n"
-    yield "data: [DONE]\n\n"
+    if cache_status:
+        headers["X-Cache"] = cache_status
+    return StreamingResponse(
+        run.subscribe(after_seq, is_disconnected=http_request.is_disconnected),
+        media_type="text/event-stream",
+        headers=headers,
+    )
+
+
+def _start_run(
+    prepared: PreparedRequest,
+    cached_result: Optional[EngineResult] = None,
+    controllable: bool = False,
+) -> EngineRun:
+    """启动流式运行并登记到运行注册表（供断线重连）"""
+    run = create_stream_run(prepared, cached_result, controllable).start()
+    run_registry.add(run)
+    return run
+
+
+def _cache_on_finish(run: EngineRun, key: str, ttl: float):
+    """流式运行成功结束后把结果写入响应缓存"""
+    def store(run: EngineRun):
+        if run.result is not None and run.error is None:
+            response_cache.set_later(key, run.result, ttl)
+    run.on_finish(store)
 
 
 @router.post("/v1/chat/completions")
 async def chat_completions(
     request: ChatCompletionRequest,
-    authorization: str = Header(None)
+    http_request: Request,
+    response: Response,
+    authorization: str = Header(None),
+    last_event_id: Optional[str] = Header(None),
+    cache_control: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+    x_request_timeout: Optional[str] = Header(None),
+    x_priority: Optional[int] = Header(None),
 ):
     """
     OpenAI 兼容的聊天补全端点
     支持 DeepThink、UltraThink 和直接代理模式
     """
     # 验证 API 密钥
-    verify_auth(authorization)
+    caller = verify_auth(authorization)
     
     # 获取模型配置
     model_config = config.get_model(request.model)
@@ -392,139 +248,298 @@ async def chat_completions(
             detail=f"Provider {model_config.provider} not configured"
         )
     
-    # 流式响应
+    # 断线重连：Last-Event-ID 指向仍在运行（或刚结束）的流时直接补发，不重新运行引擎
     if request.stream:
-        return StreamingResponse(
-            stream_chat_completion(request, model_config, provider_config),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
-            }
+        resume = parse_event_id(last_event_id)
+        run = run_registry.get(resume[0]) if resume else None
+        if run and run_registry.get(run.run_id, caller) is None:
+            # 其他密钥发起的运行不能补发
+            raise HTTPException(status_code=404, detail=f"Stream {run.run_id} not found or expired")
+        if run:
+            logger.info(f"Client resumed run {run.run_id} after chunk {resume[1]}")
+            return _sse_response(run, resume[1], http_request)
+    
+    # 流式与非流式共用同一份预处理结果
+    # 客户端期限：X-Request-Timeout 头 > deep_think_options.timeout，未给出时后端调用不设期限，
+    # 准入排队最多等待 admission_max_wait
+    timeout = resolve_timeout(x_request_timeout, request)
+    # 优先级：X-Priority 头 > 模型配置
+    prepared = prepare_request(
+        request, model_config, timeout=timeout, priority=x_priority, caller=caller,
+        max_wait=timeout or config.admission_max_wait,
+    )
+    
+    # 幂等键：同一个键 + 相同请求体的重试直接加入原运行或返回保存的结果
+    # 键按调用方密钥隔离，不同密钥使用相同的键互不影响
+    if not idempotency_key:
+        return await _chat_completion(prepared, http_request, response, cache_control)
+    if caller:
+        idempotency_key = f"{caller.name}:{idempotency_key}"
+    body_hash = canonical_hash(request.model_dump(exclude_none=True))
+    while True:
+        entry = idempotency_store.get(idempotency_key)
+        if entry is None:
+            break
+        if entry.body_hash != body_hash:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key has already been used with a different request body"
+            )
+        if not entry.ready.is_set():
+            # 相同的请求正在处理，等它登记运行后再加入
+            await entry.ready.wait()
+            continue
+        logger.info(f"Idempotent retry for key {idempotency_key}")
+        replay = await _idempotent_replay(entry, prepared, http_request)
+        if replay is not None:
+            return replay
+        # 原运行失败或被取消：释放键，作为新请求重新运行
+        idempotency_store.discard(idempotency_key, entry)
+    # 在第一次 await 之前预留键，并发的相同请求不会各自启动运行
+    entry = idempotency_store.reserve(idempotency_key, body_hash)
+    try:
+        return await _chat_completion(
+            prepared, http_request, response, cache_control, (idempotency_key, entry)
         )
+    finally:
+        idempotency_store.release(idempotency_key, entry)
+
+
+async def _idempotent_replay(entry: IdempotencyEntry, prepared: PreparedRequest, http_request: Request):
+    """按幂等键保存的运行或结果响应重试，原运行已失败（键已释放）时返回 None"""
+    if prepared.request.stream:
+        if entry.run is not None:
+            return _sse_response(entry.run, 0, http_request)
+        if entry.result is not None:
+            return _sse_response(_start_run(prepared, entry.result), 0, http_request)
+    else:
+        if entry.response is not None:
+            return entry.response
+        if entry.task is not None:
+            try:
+                return await asyncio.shield(entry.task)
+            except asyncio.CancelledError:
+                if entry.task.cancelled():
+                    return None  # 原请求被取消，键已释放
+                raise
+        if entry.result is not None:
+            return build_completion_response(prepared, entry.result)
+        if entry.run is not None:
+            await entry.run.wait()
+            if entry.run.result is not None and entry.run.error is None:
+                return build_completion_response(prepared, entry.run.result)
+            return None
+    return None
+
+
+async def _chat_completion(
+    prepared: PreparedRequest,
+    http_request: Request,
+    response: Response,
+    cache_control: Optional[str],
+    idempotency: Optional[Tuple[str, IdempotencyEntry]] = None,
+):
+    """运行（或加入、或从缓存返回）一次聊天补全，idempotency 为预留的 (幂等键, 记录)"""
+    request = prepared.request
+    model_config = prepared.model_config
+    
+    # 响应缓存：模型设置了 cache_ttl 时启用，Cache-Control: no-cache 跳过读取，no-store 同时跳过写入
+    cache_status = None
+    cache_ttl = None
+    cached = None
+    if model_config.cache_ttl:
+        cache_read, cache_write = cache_directives(cache_control)
+        cache_ttl = model_config.cache_ttl if cache_write else None
+        cached = await response_cache.get(prepared.cache_key) if cache_read else None
+        cache_status = "HIT" if cached is not None else "MISS"
+        if cached is not None:
+            logger.info(f"Response cache hit for model {request.model}")
+    
+    # 相同请求合并：重复提交直接加入进行中的运行（流式与非流式分开，输出形式不同）
+    flight_key = None
+    if config.single_flight:
+        mode = f"stream:{int(prepared.include_stream_usage)}" if request.stream else "completion"
+        flight_key = f"{mode}:{prepared.scoped_hash}"
+    
+    # 流式响应
+    if request.stream:
+        if cached is not None:
+            run = _start_run(prepared, cached)
+        elif flight_key and single_flight.get(flight_key):
+            run = single_flight.get(flight_key)
+            logger.info(f"Duplicate request joined in-flight run {run.run_id}")
+        else:
+            run = _start_run(prepared)
+            if flight_key:
+                single_flight.add(flight_key, run, run.on_finish)
+            if cache_ttl:
+                _cache_on_finish(run, prepared.cache_key, cache_ttl)
+        if idempotency:
+            idempotency_store.add_run(*idempotency, run)
+        return _sse_response(run, 0, http_request, cache_status)
     
     # 非流式响应
+    if cache_status:
+        response.headers["X-Cache"] = cache_status
+    if cached is not None:
+        completion = build_completion_response(prepared, cached)
+        if idempotency:
+            idempotency_store.add_response(*idempotency, completion)
+        return completion
+    task = single_flight.get(flight_key) if flight_key else None
+    if task is None:
+        task = asyncio.create_task(run_completion(prepared, cache_ttl=cache_ttl))
+        if flight_key:
+            single_flight.add(flight_key, task, task.add_done_callback)
     else:
-        # 提取 LLM 参数
-        llm_params = extract_llm_params(request)
-        
-        # 保留完整的对话历史
-        if not request.messages:
-            raise HTTPException(status_code=400, detail="No messages found")
-        
-        # 处理用户消息：将 system role 合并后转为 user 消息
-        processed_messages = process_user_messages(request.messages)
-        
-        # 提取最后一个用户消息作为当前问题
-        user_messages = [msg for msg in processed_messages if msg.role == "user"]
-        if not user_messages:
-            raise HTTPException(status_code=400, detail="No user message found")
-        
-        last_user_message = user_messages[-1]
-        # 保留原始的多模态内容（如果有图片）
-        problem_statement_raw = last_user_message.content
-        # 同时提取纯文本版本用于日志和摘要
-        problem_statement_text = extract_text_from_content(problem_statement_raw)
-        
-        # 构建结构化的对话历史（排除最后一条用户消息）
-        conversation_history = []
-        if len(processed_messages) > 1:
-            context_messages = processed_messages[:-1]  # 排除最后一条消息
-            for msg in context_messages:
-                conversation_history.append({
-                    "role": msg.role,
-                    "content": msg.content
+        logger.info("Duplicate request joined in-flight completion")
+    if idempotency:
+        idempotency_store.add_task(*idempotency, task)
+    # shield：某个调用方取消不影响其他等待同一结果的调用方
+    return await asyncio.shield(task)
+
+
+@router.get("/v1/chat/completions/{run_id}/stream")
+async def resume_chat_completion_stream(
+    run_id: str,
+    http_request: Request,
+    authorization: str = Header(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    重新连接到仍在运行（或刚结束）的流式补全
+    从 Last-Event-ID 之后开始补发，未携带时从头回放
+    """
+    caller = verify_auth(authorization)
+    
+    # 只能重新连接自己的密钥发起的运行
+    run = run_registry.get(run_id, caller)
+    if not run:
+        raise HTTPException(status_code=404, detail=f"Stream {run_id} not found or expired")
+    
+    resume = parse_event_id(last_event_id)
+    after_seq = resume[1] if resume and resume[0] == run_id else 0
+    return _sse_response(run, after_seq, http_request)
+
+
+def _set_run_deadline(run: EngineRun, prepared: PreparedRequest, timeout: float):
+    """设置新的截止时间：后端调用按新期限排队，到期时采纳当前草稿"""
+    prepared.timeout = time.monotonic() + timeout - prepared.created_at
+    engine = run.engine
+    for client in {engine.client, *engine.clients_by_provider.values()}:
+        client.deadline = prepared.deadline
+    run.set_deadline(timeout)
+
+
+async def _ws_send_run(websocket: WebSocket, run: EngineRun):
+    """把运行输出逐块发给 WebSocket 客户端，载荷与 SSE 的 data 相同"""
+    try:
+        async for frames in run.frames(0, config.stream_heartbeat_interval):
+            if not frames:
+                await websocket.send_json({"type": "heartbeat"})
+                continue
+            for _, payload in frames:
+                if payload == SSEWriter.DONE_PAYLOAD:
+                    continue
+                await websocket.send_text(payload.decode())
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        # 引擎运行出错
+        await websocket.send_json({"type": "error", "message": str(e)})
+        return
+    if run.error is not None:
+        await websocket.send_json({"type": "cancelled"})
+    else:
+        await websocket.send_json({"type": "done"})
+
+
+async def _ws_receive_controls(websocket: WebSocket, run: EngineRun, prepared: PreparedRequest):
+    """处理客户端控制消息：cancel、accept（采纳当前草稿）、deadline（新的截止时间）"""
+    while True:
+        try:
+            message = json.loads(await websocket.receive_text())
+        except ValueError:
+            await websocket.send_json({"type": "error", "message": "Control messages must be JSON"})
+            continue
+        kind = message.get("type") if isinstance(message, dict) else None
+        if kind == "cancel":
+            run.cancel()
+            await websocket.send_json({"type": "ack", "control": kind})
+        elif kind == "accept":
+            reason = run.accept_draft()
+            if reason:
+                await websocket.send_json({"type": "error", "control": kind, "message": reason})
+            else:
+                await websocket.send_json({"type": "ack", "control": kind})
+        elif kind == "deadline":
+            timeout = message.get("timeout")
+            if not isinstance(timeout, (int, float)) or timeout < 0:
+                await websocket.send_json({
+                    "type": "error", "control": kind, "message": "timeout must be a non-negative number of seconds"
                 })
-        
-        # 创建后端客户端集合（支持每个阶段选择不同提供商）
-        max_retry = model_config.get_max_retry(default=config.max_retry)
-        provider_ids = {model_config.provider}
-        if hasattr(model_config, 'providers_by_stage') and model_config.providers_by_stage:
-            provider_ids.update([pid for pid in model_config.providers_by_stage.values() if pid])
-        clients_by_provider = {}
-        for pid in provider_ids:
-            pc = config.get_provider(pid)
-            if not pc:
-                raise HTTPException(status_code=500, detail=f"Provider {pid} not configured")
-            clients_by_provider[pid] = create_client(pc.base_url, pc.key, model_config.rpm, max_retry, pc.response_api)
-        # 默认客户端
-        client = clients_by_provider[model_config.provider]
-        
-        # 根据模型级别处理
-        reasoning_text = None
-        if model_config.level == "ultrathink":
-            engine = UltraThinkEngine(
-                client=client,
-                model=model_config.model,
-                problem_statement=problem_statement_raw,  # 传递多模态内容
-                conversation_history=conversation_history,  # 传递结构化的消息历史
-                max_iterations=model_config.max_iterations,
-                required_successful_verifications=model_config.required_verifications,
-                num_agents=model_config.num_agent,
-                parallel_run_agent=model_config.parallel_run_agent,
-                model_stages=model_config.models,
-                enable_parallel_check=model_config.parallel_check,
-                llm_params=llm_params,
-                clients_by_provider=clients_by_provider,
-                default_provider_id=model_config.provider,
-                provider_stages=getattr(model_config, 'providers_by_stage', {}),
-            )
-            result = await engine.run()
-            response_text = result.summary or result.final_solution
-            
-            # 如果启用 summary_think,生成推理内容
-            if model_config.has_summary_think:
-                reasoning_text = generate_simple_thinking_tag("ultrathink")
-        
-        else:  # deepthink
-            engine = DeepThinkEngine(
-                client=client,
-                model=model_config.model,
-                problem_statement=problem_statement_raw,  # 传递多模态内容
-                conversation_history=conversation_history,  # 传递结构化的消息历史
-                max_iterations=model_config.max_iterations,
-                required_successful_verifications=model_config.required_verifications,
-                model_stages=model_config.models,
-                enable_planning=model_config.has_plan_mode,
-                enable_parallel_check=model_config.parallel_check,
-                llm_params=llm_params,
-                clients_by_provider=clients_by_provider,
-                default_provider_id=model_config.provider,
-                provider_stages=getattr(model_config, 'providers_by_stage', {}),
-            )
-            result = await engine.run()
-            #response_text = result.summary or result.final_solution
-            response_text = result.final_solution
-            
-            # 如果启用 summary_think,生成推理内容
-            #if model_config.has_summary_think:
-            #    reasoning_text = generate_simple_thinking_tag("deepthink")
-        
-        # 构建响应
-        request_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-        created = int(time.time())
-        
-        return ChatCompletionResponse(
-            id=request_id,
-            object="chat.completion",
-            created=created,
-            model=request.model,
-            choices=[
-                ChatCompletionChoice(
-                    index=0,
-                    message=Message(
-                        role="assistant",
-                        content=response_text,
-                        reasoning_content=reasoning_text
-                    ),
-                    finish_reason="stop"
-                )
-            ],
-            usage=Usage(
-                prompt_tokens=0,  # 简化处理
-                completion_tokens=0,
-                total_tokens=0
-            )
-        )
+                continue
+            _set_run_deadline(run, prepared, float(timeout))
+            await websocket.send_json({"type": "ack", "control": kind, "timeout": timeout})
+        else:
+            await websocket.send_json({"type": "error", "message": f"Unknown control message: {kind}"})
 
+
+@router.websocket("/v1/chat/ws")
+async def chat_websocket(websocket: WebSocket, token: Optional[str] = Query(None)):
+    """
+    WebSocket 聊天补全
+    第一条消息为聊天补全请求体，之后推送与 SSE 相同的输出块，
+    运行期间可发送 cancel、accept、deadline 控制消息
+    """
+    # 浏览器无法设置请求头时可用 token 查询参数
+    authorization = websocket.headers.get("authorization") or (f"Bearer {token}" if token else None)
+    try:
+        caller = verify_auth(authorization)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    await websocket.accept()
+    
+    try:
+        request = ChatCompletionRequest(**await websocket.receive_json())
+        model_config = config.get_model(request.model)
+        if not model_config:
+            raise HTTPException(status_code=404, detail=f"Model {request.model} not found")
+        timeout = resolve_timeout(None, request)
+        prepared = prepare_request(
+            request, model_config, timeout=timeout, caller=caller, max_wait=timeout or config.admission_max_wait
+        )
+        # 每个连接独占自己的运行（控制消息只作用于本连接），不参与合并与缓存
+        run = _start_run(prepared, controllable=True)
+    except WebSocketDisconnect:
+        return
+    except (ValueError, ValidationError) as e:
+        await websocket.send_json({"type": "error", "status_code": 400, "message": str(e)})
+        await websocket.close(code=1003)
+        return
+    except HTTPException as e:
+        error = {"type": "error", "status_code": e.status_code, "message": e.detail}
+        if e.headers and "Retry-After" in e.headers:
+            error["retry_after"] = int(e.headers["Retry-After"])
+        await websocket.send_json(error)
+        await websocket.close(code=1013 if e.status_code in (429, 503) else 1008)
+        return
+    
+    logger.info(f"WebSocket client started run {run.run_id}")
+    await websocket.send_json({"type": "run", "run_id": run.run_id})
+    sender = asyncio.create_task(_ws_send_run(websocket, run))
+    receiver = asyncio.create_task(_ws_receive_controls(websocket, run, prepared))
+    try:
+        await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        receiver.cancel()
+        sender.cancel()
+    # 客户端断开时运行照常进入宽限期，可凭 run_id 通过 SSE 重新连接
+    for task in (sender, receiver):
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                logger.warning(f"WebSocket for run {run.run_id} closed: {task.exception()!r}")
+            return
+    if sender.done() and not sender.cancelled():
+        await websocket.close()
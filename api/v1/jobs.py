@@ -0,0 +1,193 @@
+"""
+后台任务 API
+POST /v1/jobs 立即返回任务 id，由有界 worker 池在后台运行引擎，
+GET /v1/jobs/{id} 查询状态、进度和结果；长时间运行的请求不再占用 HTTP 连接
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Optional, Dict, Any, List, Set
+
+import httpx
+from fastapi import APIRouter, HTTPException, Header
+
+from models import JobCreateRequest, JobObject, ChatCompletionRequest, ProgressEvent
+from config import config, ApiKeyConfig
+from utils.job_store import JobStore, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED
+from api.v1.pipeline import prepare_request
+from .chat import verify_auth, run_completion
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# 完成回调的最大尝试次数（指数退避）
+WEBHOOK_ATTEMPTS = 3
+
+
+def _job_object(job: Dict[str, Any], progress: Optional[Dict[str, Any]] = None) -> JobObject:
+    """存储记录 -> 对外的任务对象（不暴露原始请求和回调地址）"""
+    return JobObject(
+        id=job["id"],
+        model=job["model"],
+        status=job["status"],
+        created_at=job["created_at"],
+        started_at=job["started_at"],
+        finished_at=job["finished_at"],
+        progress=progress or job["progress"],
+        result=job["result"],
+        error=job["error"],
+    )
+
+
+class JobManager:
+    """后台任务管理：持久化存储 + 固定数量的 worker"""
+
+    def __init__(self):
+        self.store: Optional[JobStore] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        # 运行中任务的实时进度（只在内存中，结束时写入存储）
+        self._progress: Dict[str, Dict[str, Any]] = {}
+        # 进行中的回调请求，保持引用避免被回收
+        self._webhooks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        """打开存储，恢复上次未完成的任务并启动 worker"""
+        self.store = await asyncio.to_thread(JobStore, config.job_db_path)
+        requeued = await asyncio.to_thread(self.store.requeue_interrupted)
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted jobs")
+        self._queue = asyncio.Queue()
+        for job_id in await asyncio.to_thread(self.store.queued_ids):
+            self._queue.put_nowait(job_id)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(config.job_workers, 1))]
+        logger.info(f"Job workers started: {len(self._workers)}, queued: {self._queue.qsize()}")
+
+    async def stop(self):
+        """停止 worker；运行中的任务保持 running 状态，下次启动时重新排队"""
+        for task in [*self._workers, *self._webhooks]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._webhooks, return_exceptions=True)
+        self._workers = []
+        if self.store:
+            self.store.close()
+            self.store = None
+
+    async def submit(self, request: JobCreateRequest, caller: Optional[ApiKeyConfig] = None) -> JobObject:
+        job_id = f"job-{uuid.uuid4().hex}"
+        payload = request.model_dump(exclude={"webhook_url"}, exclude_none=True)
+        payload["stream"] = False
+        job = await asyncio.to_thread(
+            self.store.create, job_id, request.model, payload, request.webhook_url,
+            caller.name if caller else None,
+        )
+        self._queue.put_nowait(job_id)
+        return _job_object(job)
+
+    async def get(self, job_id: str, caller: Optional[ApiKeyConfig] = None) -> Optional[JobObject]:
+        """查询任务；指定 caller 时只返回该密钥提交的任务（管理员密钥可查看全部）"""
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if not job:
+            return None
+        if caller and not caller.admin and job["owner"] != caller.name:
+            return None
+        return _job_object(job, self._progress.get(job_id))
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job {job_id} crashed: {e}")
+
+    async def _run_job(self, job_id: str):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if not job or job["status"] != JOB_QUEUED:
+            return
+        await asyncio.to_thread(self.store.update, job_id, status=JOB_RUNNING, started_at=time.time())
+        logger.info(f"Job {job_id} started")
+
+        def on_progress(event: ProgressEvent):
+            self._progress[job_id] = {
+                "type": event.type,
+                "message": event.data.get("message"),
+                "updated_at": time.time(),
+            }
+
+        try:
+            request = ChatCompletionRequest(**job["request"])
+            model_config = config.get_model(request.model)
+            if not model_config:
+                raise HTTPException(status_code=404, detail=f"Model {request.model} not found")
+            # 按提交任务的密钥计入配额和公平排队（密钥已从配置中删除时不再限制）
+            caller = config.get_api_key(job["owner"]) if job["owner"] else None
+            prepared = prepare_request(request, model_config, caller=caller)
+            response = await run_completion(prepared, on_progress=on_progress)
+            fields = {"status": JOB_SUCCEEDED, "result": response.model_dump()}
+        except asyncio.CancelledError:
+            # 服务关闭：保持 running，下次启动时重新排队
+            self._progress.pop(job_id, None)
+            raise
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Job {job_id} failed: {error}")
+            fields = {"status": JOB_FAILED, "error": error}
+
+        fields["finished_at"] = time.time()
+        fields["progress"] = self._progress.pop(job_id, None)
+        await asyncio.to_thread(self.store.update, job_id, **fields)
+        logger.info(f"Job {job_id} {fields['status']}")
+
+        if job["webhook_url"]:
+            task = asyncio.create_task(self._send_webhook(job_id, job["webhook_url"]))
+            self._webhooks.add(task)
+            task.add_done_callback(self._webhooks.discard)
+
+    async def _send_webhook(self, job_id: str, url: str):
+        """把最终任务对象 POST 到回调地址，失败时指数退避重试"""
+        job = await self.get(job_id)
+        body = job.model_dump(mode="json")
+        async with httpx.AsyncClient(timeout=config.job_webhook_timeout) as client:
+            for attempt in range(WEBHOOK_ATTEMPTS):
+                try:
+                    response = await client.post(url, json=body)
+                    response.raise_for_status()
+                    return
+                except httpx.HTTPError as e:
+                    logger.warning(f"Job {job_id} webhook attempt {attempt + 1} failed: {e}")
+                    if attempt + 1 < WEBHOOK_ATTEMPTS:
+                        await asyncio.sleep(2 ** attempt)
+        logger.error(f"Job {job_id} webhook gave up after {WEBHOOK_ATTEMPTS} attempts")
+
+
+# 全局任务管理器（在应用生命周期中启动和停止）
+job_manager = JobManager()
+
+
+@router.post("/v1/jobs", status_code=202, response_model=JobObject)
+async def create_job(request: JobCreateRequest, authorization: str = Header(None)):
+    """提交后台任务，立即返回任务 id"""
+    caller = verify_auth(authorization)
+
+    model_config = config.get_model(request.model)
+    if not model_config:
+        raise HTTPException(status_code=404, detail=f"Model {request.model} not found")
+    # 提交时先校验消息，避免排队后才失败
+    prepare_request(request, model_config)
+
+    return await job_manager.submit(request, caller)
+
+
+@router.get("/v1/jobs/{job_id}", response_model=JobObject)
+async def get_job(job_id: str, authorization: str = Header(None)):
+    """查询任务状态、进度和结果（只能查询本密钥提交的任务）"""
+    caller = verify_auth(authorization)
+
+    job = await job_manager.get(job_id, caller)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
@@ -0,0 +1,367 @@
+"""
+请求预处理流水线
+流式与非流式路径共用：每个请求只做一次消息处理、文本提取和字典转换，
+得到的 PreparedRequest 直接用于创建客户端和引擎
+"""
+import hashlib
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Dict, Any, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from models import ChatCompletionRequest, Message, MessageContent, extract_text_from_content
+from config import config, ModelConfig, ApiKeyConfig
+from utils.openai_client import OpenAIClient, create_client
+from utils.client_pool import provider_clients
+from utils.usage import UsageTracker
+from utils.retry import RetryBudget
+from utils.routing import StageRouter
+from engine.deep_think import DeepThinkEngine
+from engine.ultra_think import UltraThinkEngine
+
+
+def extract_llm_params(request: ChatCompletionRequest) -> Dict[str, Any]:
+    """从请求中提取 LLM 参数"""
+    params = {}
+
+    # 只提取 temperature 和 max_tokens 参数
+    if request.temperature is not None:
+        params['temperature'] = request.temperature
+    if request.max_tokens is not None:
+        params['max_tokens'] = request.max_tokens
+
+    return params
+
+
+def process_user_messages(messages: List[Message]) -> List[Message]:
+    """
+    处理用户发送的消息列表：
+    1. 提取所有 system role 消息并合并
+    2. 将合并后的 system 消息转为 user 消息
+    3. 放在第一条 user role 消息的最前面
+
+    Args:
+        messages: 原始消息列表
+
+    Returns:
+        处理后的消息列表（不包含 system role）
+    """
+    system_messages = []
+    non_system_messages = []
+
+    # 分离 system 消息和其他消息
+    for msg in messages:
+        if msg.role == "system":
+            system_messages.append(msg)
+        else:
+            non_system_messages.append(msg)
+
+    # 如果没有 system 消息，直接返回原列表
+    if not system_messages:
+        return messages
+
+    # 合并所有 system 消息
+    merged_system_content = []
+    for msg in system_messages:
+        content_text = extract_text_from_content(msg.content)
+        if content_text.strip():
+            merged_system_content.append(content_text)
+
+    # 如果合并后为空，直接返回非 system 消息
+    if not merged_system_content:
+        return non_system_messages
+
+    # 创建转换后的 user 消息（带有明确的标识）
+    system_as_user_content = "# System Instructions\n\n" + "\n\n---\n\n".join(merged_system_content)
+    system_as_user_msg = Message(
+        role="user",
+        content=system_as_user_content
+    )
+
+    # 找到第一条 user 消息的位置
+    first_user_index = None
+    for i, msg in enumerate(non_system_messages):
+        if msg.role == "user":
+            first_user_index = i
+            break
+
+    # 插入转换后的消息
+    if first_user_index is not None:
+        # 在第一条 user 消息之前插入
+        processed_messages = (
+            non_system_messages[:first_user_index] +
+            [system_as_user_msg] +
+            non_system_messages[first_user_index:]
+        )
+    else:
+        # 如果没有 user 消息，放在最前面
+        processed_messages = [system_as_user_msg] + non_system_messages
+
+    return processed_messages
+
+
+def canonical_hash(obj: Any) -> str:
+    """对象的规范化哈希（键排序、紧凑分隔符），相同内容得到相同结果"""
+    data = json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def resolve_stream_drafts(request: ChatCompletionRequest, model_config: ModelConfig) -> bool:
+    """
+    是否把中间草稿逐 token 输出到 reasoning_content
+    请求中的 deep_think_options.stream_drafts 优先，其次是模型的 stream_drafts 特性
+    仅 DeepThink 支持（UltraThink 的多个 Agent 并行，草稿会交错）
+    """
+    if model_config.level == "ultrathink":
+        return False
+    options = request.deep_think_options or {}
+    if options.get("stream_drafts") is not None:
+        return bool(options["stream_drafts"])
+    return model_config.has_stream_drafts
+
+
+
+def resolve_timeout(header: Optional[str], request: ChatCompletionRequest) -> Optional[float]:
+    """
+    客户端期限(秒)：X-Request-Timeout 头优先，其次是 deep_think_options.timeout，都没有时返回 None
+    不是正数时返回 400
+    """
+    value = header if header is not None else (request.deep_think_options or {}).get("timeout")
+    if value is None:
+        return None
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        timeout = float(value)
+    except (TypeError, ValueError):
+        timeout = math.nan
+    if not math.isfinite(timeout) or timeout <= 0:
+        raise HTTPException(status_code=400, detail=f"Invalid timeout {value!r}: must be a positive number of seconds")
+    return timeout
+
+@dataclass
+class PreparedRequest:
+    """预处理后的请求，每个请求只构建一次"""
+    request: ChatCompletionRequest
+    model_config: ModelConfig
+    llm_params: Dict[str, Any]
+    # 处理后的消息（system 已合并为 user），已转换为字典
+    messages: List[Dict[str, Any]]
+    # 最后一条用户消息的原始内容（可能是多模态）
+    problem_statement: MessageContent
+    # 除最后一条消息外的结构化历史
+    conversation_history: List[Dict[str, Any]] = field(default_factory=list)
+    # 本请求所有后端调用的 token 用量
+    usage: UsageTracker = field(default_factory=UsageTracker)
+    # 本请求所有后端调用共享的重试预算
+    retry_budget: RetryBudget = field(default_factory=RetryBudget)
+    # 客户端给出的期限(秒)，None 表示不限；后端调用据此排队，超过期限的重试直接放弃
+    timeout: Optional[float] = None
+    # 准入排队最长等待时间(秒)，None 表示不拒绝（如后台任务）
+    max_wait: Optional[float] = None
+    # 后端调用排队优先级，越大越先获得 RPM 配额
+    priority: int = 0
+    # 发起请求的 API 密钥（未启用鉴权时为 None）
+    caller: Optional[ApiKeyConfig] = None
+    created_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """截止时间点(time.monotonic)"""
+        return self.created_at + self.timeout if self.timeout else None
+
+    @cached_property
+    def problem_statement_text(self) -> str:
+        """问题的纯文本版本（用于日志、提示词和摘要）"""
+        return extract_text_from_content(self.problem_statement)
+
+    @property
+    def options(self) -> Dict[str, Any]:
+        """deep_think_options"""
+        return self.request.deep_think_options or {}
+
+    @cached_property
+    def request_hash(self) -> str:
+        """模型、处理后的消息、LLM 参数和 deep_think_options 的规范化哈希，相同的请求得到相同结果"""
+        return canonical_hash({
+            "model": self.request.model,
+            "messages": self.messages,
+            "llm_params": self.llm_params,
+            "options": self.options,
+        })
+
+    @cached_property
+    def scoped_hash(self) -> str:
+        """按调用方密钥隔离的请求哈希：不同密钥的相同请求不会共享运行，各自经过准入并计入各自的用量"""
+        if self.caller is None:
+            return self.request_hash
+        return canonical_hash({"caller": self.caller.name, "request": self.request_hash})
+
+    @property
+    def cache_key(self) -> str:
+        """响应缓存键：默认按调用方密钥隔离，配置 response_cache_shared 时所有密钥共享"""
+        return self.request_hash if config.response_cache_shared else self.scoped_hash
+
+    @cached_property
+    def stream_drafts(self) -> bool:
+        return resolve_stream_drafts(self.request, self.model_config)
+
+    @property
+    def usage_breakdown(self) -> bool:
+        """是否在 usage 中返回按阶段的明细"""
+        return bool(self.options.get("usage_breakdown"))
+
+    @property
+    def include_stream_usage(self) -> bool:
+        """流式响应是否在结束前发送 usage 块"""
+        stream_options = self.request.stream_options or {}
+        return bool(stream_options.get("include_usage")) or self.usage_breakdown
+
+    def usage_dict(self) -> Dict[str, Any]:
+        return self.usage.to_dict(include_stages=self.usage_breakdown)
+
+
+def prepare_request(
+    request: ChatCompletionRequest,
+    model_config: ModelConfig,
+    timeout: Optional[float] = None,
+    priority: Optional[int] = None,
+    caller: Optional[ApiKeyConfig] = None,
+    max_wait: Optional[float] = None,
+) -> PreparedRequest:
+    """校验并预处理请求"""
+    if not request.messages:
+        raise HTTPException(status_code=400, detail="No messages found")
+
+    # 处理用户消息：将 system role 合并后转为 user 消息
+    processed_messages = process_user_messages(request.messages)
+
+    # 一次遍历完成字典转换，并找到最后一条用户消息
+    messages: List[Dict[str, Any]] = []
+    last_user_content = None
+    for msg in processed_messages:
+        messages.append({"role": msg.role, "content": msg.content})
+        if msg.role == "user":
+            last_user_content = msg.content
+    if last_user_content is None:
+        raise HTTPException(status_code=400, detail="No user message found")
+
+    return PreparedRequest(
+        request=request,
+        model_config=model_config,
+        llm_params=extract_llm_params(request),
+        messages=messages,
+        # 保留原始的多模态内容（如果有图片）
+        problem_statement=last_user_content,
+        # 构建结构化的对话历史（排除最后一条消息）
+        conversation_history=messages[:-1],
+        timeout=timeout,
+        max_wait=max_wait,
+        priority=model_config.priority if priority is None else priority,
+        caller=caller,
+    )
+
+
+def create_stage_clients(prepared: PreparedRequest) -> Tuple[OpenAIClient, Dict[str, OpenAIClient]]:
+    """创建后端客户端集合（支持每个阶段选择不同提供商），返回 (默认客户端, 按提供商的客户端)"""
+    model_config = prepared.model_config
+    max_retry = model_config.get_max_retry(default=config.max_retry)
+    provider_ids = {model_config.provider}
+    if model_config.providers_by_stage:
+        provider_ids.update([pid for pid in model_config.providers_by_stage.values() if pid])
+    for targets in model_config.stage_targets.values():
+        provider_ids.update(target.provider for target in targets)
+    if model_config.hedge and model_config.hedge_provider:
+        provider_ids.add(model_config.hedge_provider)
+    providers = {}
+    for pid in provider_ids:
+        pc = config.get_provider(pid)
+        if not pc:
+            raise HTTPException(status_code=500, detail=f"Provider {pid} not configured")
+        providers[pid] = pc
+    # 熔断时使用的备用提供商
+    for pc in list(providers.values()):
+        if pc.fallback and pc.fallback not in providers:
+            fallback = config.get_provider(pc.fallback)
+            if not fallback:
+                raise HTTPException(status_code=500, detail=f"Provider {pc.fallback} not configured")
+            providers[pc.fallback] = fallback
+    clients_by_provider = {}
+    for pid, pc in providers.items():
+        clients_by_provider[pid] = create_client(
+            pc.base_url, pc.key, model_config.rpm, max_retry, pc.response_api,
+            usage=prepared.usage, stream_usage=pc.stream_usage,
+            priority=prepared.priority, deadline=prepared.deadline, caller=prepared.caller,
+            client=provider_clients.get(pc),
+            provider_id=pid, tpm=model_config.tpm, max_inflight=model_config.max_inflight,
+            retry_budget=prepared.retry_budget, breaker=provider_clients.breaker(pid),
+        )
+    for pid, client in clients_by_provider.items():
+        if providers[pid].fallback:
+            client.fallback_client = clients_by_provider[providers[pid].fallback]
+    if model_config.hedge:
+        for client in clients_by_provider.values():
+            client.hedge = True
+            client.hedge_client = clients_by_provider.get(model_config.hedge_provider)
+            client.hedge_models = model_config.hedge_models
+    return clients_by_provider[model_config.provider], clients_by_provider
+
+
+def create_stage_routers(model_config: ModelConfig, clients_by_provider: Dict[str, OpenAIClient]) -> Dict[str, StageRouter]:
+    """为配置了多个目标的阶段创建路由"""
+    return {
+        stage: StageRouter([(target, clients_by_provider[target.provider]) for target in targets])
+        for stage, targets in model_config.stage_targets.items()
+        if len(targets) > 1
+    }
+
+
+def build_engine(prepared: PreparedRequest):
+    """根据模型级别创建引擎"""
+    model_config = prepared.model_config
+    client, clients_by_provider = create_stage_clients(prepared)
+    stage_routers = create_stage_routers(model_config, clients_by_provider)
+
+    if model_config.level == "ultrathink":
+        # UltraThink 模式
+        return UltraThinkEngine(
+            client=client,
+            model=model_config.model,
+            problem_statement=prepared.problem_statement,  # 传递多模态内容
+            problem_statement_text=prepared.problem_statement_text,
+            conversation_history=prepared.conversation_history,  # 传递结构化的消息历史
+            max_iterations=model_config.max_iterations,
+            required_successful_verifications=model_config.required_verifications,
+            num_agents=model_config.num_agent,
+            parallel_run_agent=model_config.parallel_run_agent,
+            model_stages=model_config.models,
+            enable_parallel_check=model_config.parallel_check,
+            llm_params=prepared.llm_params,
+            clients_by_provider=clients_by_provider,
+            default_provider_id=model_config.provider,
+            provider_stages=model_config.providers_by_stage,
+            stage_routers=stage_routers,
+        )
+
+    # DeepThink 模式
+    return DeepThinkEngine(
+        client=client,
+        model=model_config.model,
+        problem_statement=prepared.problem_statement,  # 传递多模态内容
+        problem_statement_text=prepared.problem_statement_text,
+        conversation_history=prepared.conversation_history,  # 传递结构化的消息历史
+        max_iterations=model_config.max_iterations,
+        required_successful_verifications=model_config.required_verifications,
+        model_stages=model_config.models,
+        enable_planning=model_config.has_plan_mode,
+        enable_parallel_check=model_config.parallel_check,
+        llm_params=prepared.llm_params,
+        clients_by_provider=clients_by_provider,
+        default_provider_id=model_config.provider,
+        provider_stages=model_config.providers_by_stage,
+        stage_routers=stage_routers,
+    )
@@ -0,0 +1,26 @@
+"""
+用量查询 API
+按调用方 API 密钥返回服务启动以来的运行次数、token 用量和当日预算
+"""
+from fastapi import APIRouter, Header
+
+from utils.admission import admission_controller
+from .chat import verify_auth
+
+router = APIRouter()
+
+
+@router.get("/v1/usage")
+async def get_usage(authorization: str = Header(None)):
+    """
+    查询当前密钥的用量
+    管理员密钥（system.key 或 admin: true）返回所有密钥的用量
+    """
+    caller = verify_auth(authorization)
+
+    usage = admission_controller.key_usage(None if caller is None or caller.admin else caller)
+
+    return {
+        "object": "list",
+        "data": [{"api_key": name, **stats} for name, stats in usage.items()],
+    }
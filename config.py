@@ -2,6 +2,8 @@
 配置管理模块
 负责加载和管理 YAML 配置文件
 """
+import hashlib
+import hmac
 import os
 from typing import Dict, Any, Optional, List
 import yaml
@@ -9,6 +11,26 @@ from pathlib import Path
 from dataclasses import dataclass, field
 
 
+@dataclass
+class StageTarget:
+    """阶段路由目标：一个 (模型, 提供商) 及其权重"""
+    model: str
+    provider: str
+    weight: float = 1.0
+
+    @classmethod
+    def parse(cls, value: Any, default_provider: str) -> 'StageTarget':
+        """解析 "模型"、"模型,提供商" 或 {model, provider, weight}"""
+        if isinstance(value, dict):
+            return cls(
+                model=value["model"],
+                provider=value.get("provider") or default_provider,
+                weight=float(value.get("weight", 1.0)),
+            )
+        parts = [p.strip() for p in str(value).split(",") if p.strip()]
+        return cls(model=parts[0], provider=parts[1] if len(parts) >= 2 else default_provider)
+
+
 @dataclass
 class ModelConfig:
     """单个模型的配置"""
@@ -18,11 +40,21 @@ class ModelConfig:
     model: str
     level: str = "deepthink"  # deepthink, ultrathink
     rpm: Optional[int] = None  # 每分钟请求限制
+    tpm: Optional[int] = None  # 每分钟 token 限制（按预估的 prompt token 数加 max_tokens 占用）
+    max_inflight: Optional[int] = None  # 同时进行的后端调用数量上限
     max_iterations: int = 30
     required_verifications: int = 3
     max_errors: int = 10
     parallel_check: bool = False  # 并行验证模式
     max_retry: Optional[int] = None  # 最大重试次数
+    cache_ttl: Optional[int] = None  # 响应缓存有效期(秒)，不设置则不缓存
+    max_concurrent: Optional[int] = None  # 同时运行的引擎数量上限，不设置则不限制
+    max_queue: Optional[int] = None  # 等待队列长度上限，默认 max_concurrent 的 4 倍
+    priority: int = 0  # 后端调用排队优先级，越大越先获得 RPM 配额
+    hedge: bool = False  # 调用超过 p95 耗时时发出对冲请求
+    hedge_provider: Optional[str] = None  # 对冲请求发往的提供商，不设置则发往原提供商
+    # 对冲提供商上的模型 id（原后端模型 -> 对冲模型），没有对应的模型仍在原提供商上对冲
+    hedge_models: Dict[str, str] = field(default_factory=dict)
     
     # UltraThink 配置
     num_agent: Optional[int] = None
@@ -33,23 +65,33 @@ class ModelConfig:
     has_summary_think: bool = False
     has_plan_mode: bool = False
     has_web_search: bool = False
+    has_stream_drafts: bool = False  # 中间草稿逐 token 输出到 reasoning_content
     
     # 分阶段模型配置
     models: Dict[str, str] = field(default_factory=dict)
     # 分阶段提供商配置（阶段 -> 提供商ID）
     providers_by_stage: Dict[str, str] = field(default_factory=dict)
+    # 配置为列表的阶段的多个路由目标（第一个目标同时记入 models / providers_by_stage）
+    stage_targets: Dict[str, List[StageTarget]] = field(default_factory=dict)
     
     @classmethod
     def from_dict(cls, model_id: str, config: Dict[str, Any]) -> 'ModelConfig':
-        """从字典创建配置并解析阶段配置中可选的"模型,提供商"形式"""
+        """从字典创建配置并解析阶段配置中可选的"模型,提供商"形式和多目标列表"""
         feature = config.get("feature", {})
 
         # 解析阶段模型与提供商
         raw_stage_models = config.get("models", {}) or {}
         parsed_stage_models: Dict[str, str] = {}
         providers_by_stage: Dict[str, str] = {}
+        stage_targets: Dict[str, List[StageTarget]] = {}
         for stage, value in raw_stage_models.items():
-            if isinstance(value, str) and "," in value:
+            if isinstance(value, list):
+                targets = [StageTarget.parse(item, config.get("provider")) for item in value]
+                if targets:
+                    stage_targets[stage] = targets
+                    parsed_stage_models[stage] = targets[0].model
+                    providers_by_stage[stage] = targets[0].provider
+            elif isinstance(value, str) and "," in value:
                 parts = [p.strip() for p in value.split(",") if p.strip()]
                 if len(parts) >= 2:
                     parsed_stage_models[stage] = parts[0]
@@ -66,19 +108,30 @@ class ModelConfig:
             model=config.get("model"),
             level=config.get("level", "deepthink"),
             rpm=config.get("rpm"),
+            tpm=config.get("tpm"),
+            max_inflight=config.get("max_inflight"),
             max_iterations=config.get("max_iterations", 30),
             required_verifications=config.get("required_verifications", 3),
             max_errors=config.get("max_errors_before_give_up", 10),
             parallel_check=config.get("parallel_check", False),
             max_retry=config.get("max_retry"),
+            cache_ttl=config.get("cache_ttl"),
+            max_concurrent=config.get("max_concurrent"),
+            max_queue=config.get("max_queue"),
+            priority=config.get("priority", 0),
+            hedge=config.get("hedge", False),
+            hedge_provider=config.get("hedge_provider"),
+            hedge_models=config.get("hedge_models") or {},
             num_agent=config.get("num_agent"),
             parallel_run_agent=config.get("parallel_run_agent", 3),
             has_vision=feature.get("vision", False),
             has_summary_think=feature.get("summary_think", False),
             has_plan_mode=feature.get("plan_mode", False),
             has_web_search=feature.get("web_search", False),
+            has_stream_drafts=feature.get("stream_drafts", False),
             models=parsed_stage_models,
             providers_by_stage=providers_by_stage,
+            stage_targets=stage_targets,
         )
     
     def get_stage_model(self, stage: str) -> str:
@@ -101,6 +154,10 @@ class ProviderConfig:
     base_url: str = ""
     key: str = ""
     response_api: bool = True
+    # 流式调用时是否发送 stream_options.include_usage（不支持该参数的提供商需关闭）
+    stream_usage: bool = True
+    # 熔断时改用的备用提供商ID
+    fallback: Optional[str] = None
     
     @classmethod
     def from_dict(cls, provider_id: str, config: Dict[str, Any]) -> 'ProviderConfig':
@@ -109,7 +166,40 @@ class ProviderConfig:
             provider_id=provider_id,
             base_url=config.get("base_url", ""),
             key=config.get("key", ""),
-            response_api=config.get("response_api", True)
+            response_api=config.get("response_api", True),
+            stream_usage=config.get("stream_usage", True),
+            fallback=config.get("fallback"),
+        )
+
+
+def hash_api_key(key: str) -> str:
+    """API 密钥的 SHA-256 摘要（十六进制）"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ApiKeyConfig:
+    """调用方 API 密钥的配置（只保存密钥摘要）"""
+    name: str
+    key_hash: str
+    weight: float = 1.0  # 后端调用排队时的公平份额权重
+    max_concurrent: Optional[int] = None  # 同时运行的引擎数量上限
+    rpm: Optional[int] = None  # 每分钟后端调用次数上限
+    daily_tokens: Optional[int] = None  # 每日(UTC) token 预算
+    admin: bool = False  # 可查看所有密钥的用量
+    
+    @classmethod
+    def from_dict(cls, name: str, config: Dict[str, Any]) -> 'ApiKeyConfig':
+        """从字典创建配置，密钥可以是明文 key 或摘要 key_sha256"""
+        key_hash = config.get("key_sha256") or hash_api_key(str(config.get("key", "")))
+        return cls(
+            name=name,
+            key_hash=key_hash.lower(),
+            weight=float(config.get("weight", 1.0)),
+            max_concurrent=config.get("max_concurrent"),
+            rpm=config.get("rpm"),
+            daily_tokens=config.get("daily_tokens"),
+            admin=config.get("admin", False),
         )
 
 
@@ -130,6 +220,8 @@ class Config:
             self._config: Dict[str, Any] = {}
             self._models: Dict[str, ModelConfig] = {}
             self._providers: Dict[str, ProviderConfig] = {}
+            # 密钥摘要 -> 配置
+            self._api_keys: Dict[str, ApiKeyConfig] = {}
             self.load()
     
     def load(self, config_path: Optional[Path] = None):
@@ -155,6 +247,15 @@ class Config:
         models = self._config.get("model", {})
         for model_id, model_config in models.items():
             self._models[model_id] = ModelConfig.from_dict(model_id, model_config)
+        
+        # 加载 API 密钥：system.key 作为不限额的管理员密钥，api_keys 为各调用方的密钥
+        self._api_keys = {}
+        if self.api_key:
+            default_key = ApiKeyConfig(name="default", key_hash=hash_api_key(self.api_key), admin=True)
+            self._api_keys[default_key.key_hash] = default_key
+        for name, key_config in (self._config.get("api_keys") or {}).items():
+            api_key = ApiKeyConfig.from_dict(name, key_config)
+            self._api_keys[api_key.key_hash] = api_key
     
     @property
     def api_key(self) -> str:
@@ -181,6 +282,187 @@ class Config:
         """默认最大重试次数"""
         return self._config.get("system", {}).get("max_retry", 3)
     
+    @property
+    def job_db_path(self) -> str:
+        """后台任务 SQLite 数据库路径"""
+        return self._config.get("system", {}).get("job_db_path", "data/jobs.db")
+    
+    @property
+    def job_workers(self) -> int:
+        """后台任务并发执行的 worker 数量"""
+        return int(self._config.get("system", {}).get("job_workers", 2))
+    
+    @property
+    def job_webhook_timeout(self) -> float:
+        """任务完成回调的请求超时(秒)"""
+        return float(self._config.get("system", {}).get("job_webhook_timeout", 10))
+    
+    @property
+    def batch_data_dir(self) -> str:
+        """批处理数据目录：SQLite 数据库、上传的文件和各批处理的输出"""
+        return self._config.get("system", {}).get("batch_data_dir", "data/batches")
+    
+    @property
+    def batch_concurrency(self) -> int:
+        """每个批处理同时运行的请求数量"""
+        return int(self._config.get("system", {}).get("batch_concurrency", 8))
+    
+    @property
+    def batch_priority(self) -> int:
+        """批处理请求的后端调用排队优先级，低于交互请求以便让路"""
+        return int(self._config.get("system", {}).get("batch_priority", -10))
+    
+    @property
+    def file_max_mb(self) -> float:
+        """上传文件大小上限(MB)"""
+        return float(self._config.get("system", {}).get("file_max_mb", 200))
+    
+    @property
+    def stream_flush_interval(self) -> float:
+        """流式输出合并窗口(秒)，窗口内到达的增量合并为一次写入"""
+        return float(self._config.get("system", {}).get("stream_flush_interval", 0.03))
+    
+    @property
+    def stream_heartbeat_interval(self) -> float:
+        """流式输出心跳间隔(秒)，引擎长时间无输出时发送 SSE 注释保活"""
+        return float(self._config.get("system", {}).get("stream_heartbeat_interval", 15))
+    
+    @property
+    def stream_resume_grace(self) -> float:
+        """客户端断开后引擎继续运行、等待重连的宽限期(秒)，0 表示立即取消"""
+        return float(self._config.get("system", {}).get("stream_resume_grace", 60))
+    
+    @property
+    def stream_replay_size(self) -> int:
+        """每个流式运行保留的可回放块数量上限"""
+        return int(self._config.get("system", {}).get("stream_replay_size", 4096))
+    
+    @property
+    def response_cache_memory_mb(self) -> float:
+        """响应缓存内存层容量(MB)，超出后淘汰最久未使用的条目"""
+        return float(self._config.get("system", {}).get("response_cache_memory_mb", 64))
+    
+    @property
+    def response_cache_dir(self) -> str:
+        """响应缓存磁盘层目录，留空则只使用内存层"""
+        return self._config.get("system", {}).get("response_cache_dir", "data/cache")
+    
+    @property
+    def response_cache_shared(self) -> bool:
+        """不同 API 密钥是否共享缓存结果（命中时不经过准入、不计入用量），默认按密钥隔离"""
+        return bool(self._config.get("system", {}).get("response_cache_shared", False))
+    
+    @property
+    def idempotency_ttl(self) -> float:
+        """Idempotency-Key 的保留时长(秒)，过期后同一个键视为新请求"""
+        return float(self._config.get("system", {}).get("idempotency_ttl", 86400))
+    
+    @property
+    def admission_max_wait(self) -> float:
+        """客户端未指定期限时，愿意排队等待的最长时间(秒)"""
+        return float(self._config.get("system", {}).get("admission_max_wait", 300))
+    
+    @property
+    def scheduler_aging_seconds(self) -> float:
+        """后端调用排队每等待这么多秒，优先级提升一级（防止低优先级请求饿死）"""
+        return float(self._config.get("system", {}).get("scheduler_aging_seconds", 30))
+    
+    @property
+    def single_flight(self) -> bool:
+        """进行中的相同请求是否共享同一次引擎运行"""
+        return bool(self._config.get("system", {}).get("single_flight", True))
+    
+    @property
+    def rate_limit_backend(self) -> str:
+        """限流状态存储：memory（进程内，默认）或 sqlite（同一主机的多个 worker 进程共享）"""
+        return self._config.get("system", {}).get("rate_limit_backend", "memory")
+    
+    @property
+    def rate_limit_db_path(self) -> str:
+        """rate_limit_backend 为 sqlite 时的数据库路径"""
+        return self._config.get("system", {}).get("rate_limit_db_path", "data/ratelimit.db")
+    
+    @property
+    def retry_backoff_base(self) -> float:
+        """重试退避的基准时间(秒)，第 n 次重试前随机等待 0 ~ base × 2^(n-1)"""
+        return float(self._config.get("system", {}).get("retry_backoff_base", 0.5))
+    
+    @property
+    def retry_backoff_max(self) -> float:
+        """单次重试退避的最长时间(秒)"""
+        return float(self._config.get("system", {}).get("retry_backoff_max", 20))
+    
+    @property
+    def retry_budget_ratio(self) -> float:
+        """单个请求的重试预算：重试次数不超过 retry_budget_min + 该比例 × 后端调用数"""
+        return float(self._config.get("system", {}).get("retry_budget_ratio", 0.2))
+    
+    @property
+    def retry_budget_min(self) -> int:
+        """单个请求无论调用多少次都允许的重试次数"""
+        return int(self._config.get("system", {}).get("retry_budget_min", 3))
+    
+    @property
+    def hedge_min_samples(self) -> int:
+        """同一 (提供商, 模型, 阶段) 至少有多少次成功调用后才开始对冲"""
+        return int(self._config.get("system", {}).get("hedge_min_samples", 20))
+    
+    @property
+    def circuit_breaker(self) -> bool:
+        """是否启用提供商熔断"""
+        return bool(self._config.get("system", {}).get("circuit_breaker", True))
+    
+    @property
+    def circuit_failure_rate(self) -> float:
+        """最近调用中失败（含慢调用）比例达到该值时熔断"""
+        return float(self._config.get("system", {}).get("circuit_failure_rate", 0.5))
+    
+    @property
+    def circuit_min_calls(self) -> int:
+        """计算失败率所需的最少调用数"""
+        return int(self._config.get("system", {}).get("circuit_min_calls", 10))
+    
+    @property
+    def circuit_slow_call(self) -> Optional[float]:
+        """耗时超过该秒数的调用按失败计，不设置则不按耗时判断"""
+        value = self._config.get("system", {}).get("circuit_slow_call")
+        return float(value) if value else None
+    
+    @property
+    def circuit_open_seconds(self) -> float:
+        """熔断后多久(秒)放行探测调用"""
+        return float(self._config.get("system", {}).get("circuit_open_seconds", 30))
+    
+    @property
+    def adaptive_rate_limit(self) -> bool:
+        """是否根据提供商的 429 和限流响应头自动降低并逐步恢复后端 RPM"""
+        return bool(self._config.get("system", {}).get("adaptive_rate_limit", True))
+    
+    @property
+    def rate_limiter_idle_ttl(self) -> float:
+        """后端限流器空闲多久(秒)后被回收"""
+        return float(self._config.get("system", {}).get("rate_limiter_idle_ttl", 600))
+    
+    @property
+    def http_max_connections(self) -> int:
+        """每个提供商连接池的最大连接数"""
+        return int(self._config.get("system", {}).get("http_max_connections", 200))
+    
+    @property
+    def http_max_keepalive(self) -> int:
+        """每个提供商连接池保持的空闲连接数"""
+        return int(self._config.get("system", {}).get("http_max_keepalive", 50))
+    
+    @property
+    def http_keepalive_expiry(self) -> float:
+        """空闲连接保持时间(秒)"""
+        return float(self._config.get("system", {}).get("http_keepalive_expiry", 60))
+    
+    @property
+    def http2(self) -> bool:
+        """提供商支持时是否使用 HTTP/2（需安装 h2）"""
+        return bool(self._config.get("system", {}).get("http2", True))
+    
     def get_model(self, model_id: str) -> Optional[ModelConfig]:
         """获取模型配置"""
         return self._models.get(model_id)
@@ -189,6 +471,10 @@ class Config:
         """获取提供商配置"""
         return self._providers.get(provider_id)
     
+    def list_providers(self) -> List[ProviderConfig]:
+        """所有已配置的提供商"""
+        return list(self._providers.values())
+    
     def list_models(self) -> List[Dict[str, Any]]:
         """列出所有可用模型"""
         return [
@@ -204,12 +490,32 @@ class Config:
             for model_id, model in self._models.items()
         ]
     
+    @property
+    def auth_enabled(self) -> bool:
+        """是否配置了 API 密钥（未配置则不验证）"""
+        return bool(self._api_keys)
+    
+    def get_api_key(self, name: str) -> Optional[ApiKeyConfig]:
+        """按名称获取 API 密钥配置"""
+        return next((k for k in self._api_keys.values() if k.name == name), None)
+    
+    def lookup_api_key(self, key: str) -> Optional[ApiKeyConfig]:
+        """
+        按摘要查找 API 密钥
+        只对密钥的 SHA-256 摘要做查找和比较，耗时与明文密钥的内容无关
+        """
+        digest = hash_api_key(key)
+        api_key = self._api_keys.get(digest)
+        if api_key and hmac.compare_digest(api_key.key_hash, digest):
+            return api_key
+        return None
+    
     def validate_api_key(self, key: str) -> bool:
         """验证API密钥"""
-        if not self.api_key:
+        if not self.auth_enabled:
             # 如果未设置密钥,则不验证
             return True
-        return key == self.api_key
+        return self.lookup_api_key(key) is not None
 
 
 # 全局配置实例
@@ -17,6 +17,7 @@ from models import (
     extract_text_from_content
 )
 from utils.openai_client import OpenAIClient, EmptyResponseError
+from utils.routing import StageRouter
 
 logger = logging.getLogger(__name__)
 from engine.prompts import (
@@ -55,11 +56,25 @@ class DeepThinkEngine:
         clients_by_provider: Optional[Dict[str, OpenAIClient]] = None,
         default_provider_id: Optional[str] = None,
         provider_stages: Optional[Dict[str, str]] = None,
+        # 配置了多个目标的阶段的路由（优先于 provider_stages）
+        stage_routers: Optional[Dict[str, StageRouter]] = None,
+        # 预先提取好的问题纯文本（不传则自行提取）
+        problem_statement_text: Optional[str] = None,
+        # 最终答案的正文增量回调（设置后最终阶段走流式接口）
+        on_content: Optional[Callable[[str], None]] = None,
+        # 中间草稿（初始、改进、修正）的增量回调（设置后这些阶段走流式接口）
+        on_draft: Optional[Callable[[str], None]] = None,
+        # 用量统计的阶段前缀（作为 UltraThink 子引擎时区分 agent_thinking / synthesis）
+        usage_stage_prefix: str = "",
     ):
         self.client = client
         self.model = model
         self.problem_statement = problem_statement  # 可能是字符串或多模态内容
-        self.problem_statement_text = extract_text_from_content(problem_statement)  # 提取纯文本版本
+        # 纯文本版本，调用方已提取过时直接复用
+        self.problem_statement_text = (
+            problem_statement_text if problem_statement_text is not None
+            else extract_text_from_content(problem_statement)
+        )
         self.conversation_history = conversation_history or []  # 结构化的消息历史
         self.other_prompts = other_prompts or []  # 向后兼容
         self.knowledge_context = knowledge_context
@@ -77,18 +92,32 @@ class DeepThinkEngine:
         self.clients_by_provider = clients_by_provider or {}
         self.default_provider_id = default_provider_id
         self.provider_stages = provider_stages or {}
+        self.stage_routers = stage_routers or {}
+        self.on_content = on_content
+        self.on_draft = on_draft
+        self.usage_stage_prefix = usage_stage_prefix
+        # 最新的草稿（初始、改进或修正后的解答），提前结束时作为结果
+        self.current_solution: Optional[str] = None
+        # 历史最后一条是否就是当前问题（各阶段构建消息时复用，只判断一次）
+        self._problem_in_history_tail = self._history_tail_is_problem()
     
     def _get_model_for_stage(self, stage: str) -> str:
         """获取特定阶段的模型"""
         return self.model_stages.get(stage, self.model)
 
     def _get_client_for_stage(self, stage: str) -> OpenAIClient:
-        """根据阶段选择对应提供商的客户端，默认回退为初始化客户端"""
+        """根据阶段选择多目标路由或对应提供商的客户端，默认回退为初始化客户端"""
+        if stage in self.stage_routers:
+            return self.stage_routers[stage]
         provider_id = self.provider_stages.get(stage, self.default_provider_id)
         if provider_id and provider_id in self.clients_by_provider:
             return self.clients_by_provider[provider_id]
         return self.client
 
+    def _usage_stage(self, stage: str) -> str:
+        """用量统计中记录的阶段名"""
+        return f"{self.usage_stage_prefix}{stage}"
+
     def _aggregate_statistics(self) -> Dict[str, int]:
         """聚合所有客户端统计信息"""
         seen = set()
@@ -108,9 +137,68 @@ class DeepThinkEngine:
     
     def _emit(self, event_type: str, data: Dict[str, Any]):
         """发送进度事件"""
+        if event_type == "solution":
+            self.current_solution = data["solution"]
         if self.on_progress:
             self.on_progress(ProgressEvent(type=event_type, data=data))
     
+    async def _generate_draft(
+        self,
+        stage: str,
+        system: str,
+        messages: List[Dict[str, Any]]
+    ) -> str:
+        """生成中间草稿，设置了 on_draft 时流式生成并把 token 实时推送出去"""
+        model = self._get_model_for_stage(stage)
+        client = self._get_client_for_stage(stage)
+        if not self.on_draft:
+            return await client.generate_text(
+                model=model,
+                stage=self._usage_stage(stage),
+                system=system,
+                messages=messages,
+                **self.llm_params
+            )
+        
+        chunks: List[str] = []
+        async for text in client.stream_text(
+            model=model,
+            stage=self._usage_stage(stage),
+            messages=messages,
+            system=system,
+            **self.llm_params
+        ):
+            chunks.append(text)
+            self.on_draft(text)
+        if not chunks:
+            raise EmptyResponseError(f"流式响应没有返回内容，模型: {model}")
+        return "".join(chunks)
+    
+    async def _generate_final_text(self, stage: str, prompt: str) -> str:
+        """生成最终答案，设置了 on_content 时流式生成并逐块推送"""
+        model = self._get_model_for_stage(stage)
+        client = self._get_client_for_stage(stage)
+        if not self.on_content:
+            return await client.generate_text(
+                model=model,
+                stage=self._usage_stage(stage),
+                prompt=prompt,
+                **self.llm_params
+            )
+        
+        chunks: List[str] = []
+        async for text in client.stream_text(
+            model=model,
+            stage=self._usage_stage(stage),
+            messages=[{"role": "user", "content": prompt}],
+            **self.llm_params
+        ):
+            chunks.append(text)
+            self.on_content(text)
+        if not chunks:
+            raise EmptyResponseError(f"流式响应没有返回内容，模型: {model}")
+        return "".join(chunks)
+    
     def _extract_detailed_solution(
         self,
         solution: str,
@@ -126,6 +214,21 @@ class DeepThinkEngine:
         else:
             return solution[:idx].strip()
     
+    def _history_tail_is_problem(self) -> bool:
+        """判断历史最后一条用户消息是否与当前问题相同"""
+        if not self.conversation_history:
+            return False
+        last_msg = self.conversation_history[-1]
+        if not isinstance(last_msg, dict) or last_msg.get("role") != "user":
+            return False
+        content = last_msg.get("content")
+        if content is self.problem_statement:
+            return True
+        try:
+            return extract_text_from_content(content).strip() == self.problem_statement_text.strip()
+        except Exception:
+            return self._is_same_content(content, self.problem_statement)
+    
     def _is_same_content(self, a: MessageContent, b: MessageContent) -> bool:
         """判断两段content在文本层面是否相同（忽略多模态结构差异）"""
         try:
@@ -140,9 +243,8 @@ class DeepThinkEngine:
         self._emit("progress", {"message": "Generating thinking plan..."})
         logger.info("planning stage: start")
         
-        # 提取文本用于构建提示词
-        problem_text = extract_text_from_content(problem_statement)
-        prompt = build_thinking_plan_prompt(problem_text)
+        # 使用缓存的文本版本构建提示词
+        prompt = build_thinking_plan_prompt(self.problem_statement_text)
         
         # 直接使用 prompt 参数传递多模态内容
         planning_model = self._get_model_for_stage("planning")
@@ -150,6 +252,7 @@ class DeepThinkEngine:
             client = self._get_client_for_stage("planning")
             plan = await client.generate_text(
                 model=planning_model,
+                stage=self._usage_stage("planning"),
                 prompt=problem_statement,  # 保留多模态内容
                 **self.llm_params
             )
@@ -166,10 +269,8 @@ class DeepThinkEngine:
         """验证解决方案 - 实现基类接口"""
         #detailed_solution = self._extract_detailed_solution(solution)
         detailed_solution = solution
-        # 提取文本用于构建提示词
-        problem_text = extract_text_from_content(self.problem_statement)
         verification_prompt = build_verification_prompt(
-            problem_text,
+            self.problem_statement_text,
             detailed_solution,
             self.conversation_history  # 传入对话历史
         )
@@ -184,6 +285,7 @@ class DeepThinkEngine:
             client = self._get_client_for_stage("verification")
             verification_output = await client.generate_text(
                 model=verification_model,
+                stage=self._usage_stage("verification"),
                 system=VERIFICATION_SYSTEM_PROMPT,
                 prompt=verification_prompt,
                 **self.llm_params
@@ -198,6 +300,7 @@ class DeepThinkEngine:
             
             good_verify = await client.generate_text(
                 model=verification_model,
+                stage=self._usage_stage("verification"),
                 prompt=check_prompt,
                 **self.llm_params
             )
@@ -224,10 +327,8 @@ class DeepThinkEngine:
     ) -> Dict[str, str]:
         """并行验证解决方案 - 同时启动required_verifications个验证LLM调用，全部通过才算成功"""
         detailed_solution = self._extract_detailed_solution(solution)
-        # 提取文本用于构建提示词
-        problem_text = extract_text_from_content(self.problem_statement)
         verification_prompt = build_verification_prompt(
-            problem_text,
+            self.problem_statement_text,
             detailed_solution,
             self.conversation_history  # 传入对话历史
         )
@@ -244,6 +345,7 @@ class DeepThinkEngine:
             verification_tasks = [
                 client.generate_text(
                     model=verification_model,
+                    stage=self._usage_stage("verification"),
                     system=VERIFICATION_SYSTEM_PROMPT,
                     prompt=verification_prompt,
                     **self.llm_params
@@ -265,6 +367,7 @@ class DeepThinkEngine:
                 check_tasks.append(
                     client.generate_text(
                         model=verification_model,
+                        stage=self._usage_stage("verification"),
                         prompt=check_prompt,
                         **self.llm_params
                     )
@@ -331,9 +434,6 @@ class DeepThinkEngine:
         """初始探索阶段"""
         self._emit("thinking", {"iteration": 0, "phase": "initial-exploration"})
         
-        # 使用初始阶段的模型
-        initial_model = self._get_model_for_stage("initial")
-        
         # 构建系统提示词，包含知识库
         system_prompt = DEEP_THINK_INITIAL_PROMPT
         
@@ -358,25 +458,16 @@ class DeepThinkEngine:
         
         # 如历史最后一条就是相同的用户问题，则不再追加
         should_add_problem = True
-        if self.conversation_history:
-            last_msg = self.conversation_history[-1]
-            if isinstance(last_msg, dict) and last_msg.get("role") == "user":
-                if self._is_same_content(last_msg.get("content"), problem_statement):
-                    should_add_problem = False
-                    logger.info("init stage: detected duplicate problem_statement in history tail, skip appending")
+        if self._problem_in_history_tail:
+            should_add_problem = False
+            logger.info("init stage: detected duplicate problem_statement in history tail, skip appending")
         
         if should_add_problem:
             messages.append({"role": "user", "content": problem_statement})
         logger.info("init stage: send first message")
         # 第一次思考 - 使用完整的消息历史
         try:
-            client = self._get_client_for_stage("initial")
-            first_solution = await client.generate_text(
-                model=initial_model,
-                system=system_prompt,
-                messages=messages,
-                **self.llm_params
-            )
+            first_solution = await self._generate_draft("initial", system_prompt, messages)
         except EmptyResponseError:
             # init 失败 -> 由上层统一处理
             logger.info("init stage: failed due to empty response after retry")
@@ -387,8 +478,6 @@ class DeepThinkEngine:
         # 自我改进
         self._emit("thinking", {"iteration": 0, "phase": "self-improvement"})
         
-        improvement_model = self._get_model_for_stage("improvement")
-        
         # 构建系统提示词，包含知识库
         system_prompt = DEEP_THINK_INITIAL_PROMPT
         if self.knowledge_context:
@@ -409,12 +498,9 @@ class DeepThinkEngine:
             improvement_messages.extend(self.conversation_history)
         
         add_problem_for_improve = True
-        if self.conversation_history:
-            last_msg = self.conversation_history[-1]
-            if isinstance(last_msg, dict) and last_msg.get("role") == "user":
-                if self._is_same_content(last_msg.get("content"), problem_statement):
-                    add_problem_for_improve = False
-                    logger.info("optimize stage: duplicate problem_statement in history tail, skip appending")
+        if self._problem_in_history_tail:
+            add_problem_for_improve = False
+            logger.info("optimize stage: duplicate problem_statement in history tail, skip appending")
         if add_problem_for_improve:
             improvement_messages.append({"role": "user", "content": problem_statement})
         improvement_messages.extend([
@@ -423,13 +509,7 @@ class DeepThinkEngine:
         ])
         logger.info("optimize stage: send improvement request")
         try:
-            client = self._get_client_for_stage("improvement")
-            improved_solution = await client.generate_text(
-                model=improvement_model,
-                system=system_prompt,
-                messages=improvement_messages,
-                **self.llm_params
-            )
+            improved_solution = await self._generate_draft("improvement", system_prompt, improvement_messages)
         except EmptyResponseError:
             # optimize 失败 -> 跳过优化，使用第一次解答
             improved_solution = first_solution
@@ -455,6 +535,20 @@ class DeepThinkEngine:
         })
         return {"solution": improved_solution, "verification": verification}
     
+    def draft_result(self) -> DeepThinkResult:
+        """以当前草稿构建结果（运行被提前结束时使用）"""
+        return DeepThinkResult(
+            mode="deep-think",
+            initial_thought=self.current_solution,
+            iterations=[],
+            verifications=[],
+            final_solution=self.current_solution,
+            total_iterations=0,
+            successful_verifications=0,
+            sources=self.sources if self.sources else None,
+            knowledge_enhanced=len(self.sources) > 0,
+        )
+
     async def run(self) -> DeepThinkResult:
         """运行 Deep Think 引擎"""
         import logging
@@ -542,8 +636,6 @@ class DeepThinkEngine:
                     # 修正
                     self._emit("correction", {"iteration": i})
                     
-                    correction_model = self._get_model_for_stage("correction")
-                    
                     # 构建系统提示词，包含知识库
                     system_prompt = DEEP_THINK_INITIAL_PROMPT
                     if self.knowledge_context:
@@ -563,12 +655,9 @@ class DeepThinkEngine:
                     if self.conversation_history:
                         correction_messages.extend(self.conversation_history)
                     add_problem_for_correction = True
-                    if self.conversation_history:
-                        last_msg = self.conversation_history[-1]
-                        if isinstance(last_msg, dict) and last_msg.get("role") == "user":
-                            if self._is_same_content(last_msg.get("content"), self.problem_statement):
-                                add_problem_for_correction = False
-                                logger.info("correction stage: duplicate problem_statement in history tail, skip appending")
+                    if self._problem_in_history_tail:
+                        add_problem_for_correction = False
+                        logger.info("correction stage: duplicate problem_statement in history tail, skip appending")
                     if add_problem_for_correction:
                         correction_messages.append({"role": "user", "content": self.problem_statement})
                     correction_messages.extend([
@@ -576,13 +665,7 @@ class DeepThinkEngine:
                         {"role": "user", "content": CORRECTION_PROMPT + "\n\n" + verification["bug_report"]},
                     ])
                     
-                    client = self._get_client_for_stage("correction")
-                    solution = await client.generate_text(
-                        model=correction_model,
-                        system=system_prompt,
-                        messages=correction_messages,
-                        **self.llm_params
-                    )
+                    solution = await self._generate_draft("correction", system_prompt, correction_messages)
                     
                     self._emit("solution", {"solution": solution, "iteration": i + 1})
                 else:
@@ -607,6 +690,7 @@ class DeepThinkEngine:
                             client = self._get_client_for_stage("summary")
                             final_summary = await client.generate_text(
                                 model=summary_model,
+                                stage=self._usage_stage("summary"),
                                 prompt=summary_prompt,
                                 **self.llm_params
                             )
@@ -623,6 +707,10 @@ class DeepThinkEngine:
                         "statistics": stats
                     })
                     
+                    # 通过验证的解答已经完整生成，直接作为正文推送
+                    if self.on_content:
+                        self.on_content(solution)
+                    
                     return DeepThinkResult(
                         mode="deep-think",
                         plan=plan,
@@ -653,7 +741,6 @@ class DeepThinkEngine:
             # 失败 - 仍然生成摘要
             self._emit("summarizing", {"message": "Generating final summary..."})
             
-            summary_model = self._get_model_for_stage("summary")
             # 提取文本用于构建摘要提示词
             summary_prompt = build_final_summary_prompt(
                 self.problem_statement_text,
@@ -661,15 +748,12 @@ class DeepThinkEngine:
             )
             
             try:
-                client = self._get_client_for_stage("summary")
-                final_summary = await client.generate_text(
-                    model=summary_model,
-                    prompt=summary_prompt,
-                    **self.llm_params
-                )
+                final_summary = await self._generate_final_text("summary", summary_prompt)
             except EmptyResponseError:
                 # summary 失败 -> 直接返回 solution 作为最终答案
                 final_summary = solution
+                if self.on_content:
+                    self.on_content(solution)
             
             # 获取统计信息
             stats = self._aggregate_statistics()
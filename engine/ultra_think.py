@@ -3,7 +3,7 @@ Ultra Think 引擎
 多 Agent 并行探索引擎
 """
 import asyncio
-from typing import Optional, Callable, List, Dict, Any
+from typing import Optional, Callable, List, Dict, Any, Tuple
 import json
 
 from models import (
@@ -14,7 +14,8 @@ from models import (
     MessageContent,
     extract_text_from_content
 )
-from utils.openai_client import OpenAIClient
+from utils.openai_client import OpenAIClient, EmptyResponseError
+from utils.routing import StageRouter
 from engine.prompts import (
     ULTRA_THINK_PLAN_PROMPT,
     GENERATE_AGENT_PROMPTS_PROMPT,
@@ -49,11 +50,21 @@ class UltraThinkEngine:
         clients_by_provider: Optional[Dict[str, OpenAIClient]] = None,
         default_provider_id: Optional[str] = None,
         provider_stages: Optional[Dict[str, str]] = None,
+        # 配置了多个目标的阶段的路由（优先于 provider_stages）
+        stage_routers: Optional[Dict[str, StageRouter]] = None,
+        # 预先提取好的问题纯文本（不传则自行提取）
+        problem_statement_text: Optional[str] = None,
+        # 最终摘要的正文增量回调（设置后摘要阶段走流式接口）
+        on_content: Optional[Callable[[str], None]] = None,
     ):
         self.client = client
         self.model = model
         self.problem_statement = problem_statement  # 可能是字符串或多模态内容
-        self.problem_statement_text = extract_text_from_content(problem_statement)  # 提取纯文本版本
+        # 纯文本版本，调用方已提取过时直接复用
+        self.problem_statement_text = (
+            problem_statement_text if problem_statement_text is not None
+            else extract_text_from_content(problem_statement)
+        )
         self.conversation_history = conversation_history or []  # 结构化的消息历史
         self.other_prompts = other_prompts or []  # 向后兼容
         self.knowledge_context = knowledge_context
@@ -72,17 +83,79 @@ class UltraThinkEngine:
         self.clients_by_provider = clients_by_provider or {}
         self.default_provider_id = default_provider_id
         self.provider_stages = provider_stages or {}
+        self.stage_routers = stage_routers or {}
+        self.on_content = on_content
+        # 运行中的计划、Agent 与综合引擎，提前结束时从中取当前最好的草稿
+        self._plan: Optional[str] = None
+        self._agents: List[Tuple[AgentResult, DeepThinkEngine]] = []
+        self._synthesis_engine: Optional[DeepThinkEngine] = None
     
+    @property
+    def current_solution(self) -> Optional[str]:
+        """当前最好的草稿：综合阶段的草稿 > 已完成 Agent 的解答 > 任一 Agent 的最新草稿"""
+        if self._synthesis_engine and self._synthesis_engine.current_solution:
+            return self._synthesis_engine.current_solution
+        for result, _ in self._agents:
+            if result.solution:
+                return result.solution
+        for _, engine in self._agents:
+            if engine.current_solution:
+                return engine.current_solution
+        return None
+
+    def draft_result(self) -> UltraThinkResult:
+        """以当前草稿构建结果（运行被提前结束时使用）"""
+        draft = self.current_solution
+        agent_results = [result for result, _ in self._agents]
+        return UltraThinkResult(
+            mode="ultra-think",
+            plan=self._plan or "",
+            agent_results=agent_results,
+            synthesis=draft,
+            final_solution=draft,
+            total_agents=len(agent_results),
+            completed_agents=len([r for r in agent_results if r.status == "completed"]),
+            sources=self.sources if self.sources else None,
+            knowledge_enhanced=len(self.sources) > 0,
+        )
+
     def _get_model_for_stage(self, stage: str) -> str:
         """获取特定阶段的模型"""
         return self.model_stages.get(stage, self.model)
 
     def _get_client_for_stage(self, stage: str) -> OpenAIClient:
+        if stage in self.stage_routers:
+            return self.stage_routers[stage]
         provider_id = self.provider_stages.get(stage, self.default_provider_id)
         if provider_id and provider_id in self.clients_by_provider:
             return self.clients_by_provider[provider_id]
         return self.client
     
+    async def _generate_final_text(self, stage: str, prompt: str) -> str:
+        """生成最终摘要，设置了 on_content 时流式生成并逐块推送"""
+        model = self._get_model_for_stage(stage)
+        client = self._get_client_for_stage(stage)
+        if not self.on_content:
+            return await client.generate_text(
+                model=model,
+                stage=stage,
+                prompt=prompt,
+                **self.llm_params
+            )
+        
+        chunks: List[str] = []
+        async for text in client.stream_text(
+            model=model,
+            stage=stage,
+            messages=[{"role": "user", "content": prompt}],
+            **self.llm_params
+        ):
+            chunks.append(text)
+            self.on_content(text)
+        if not chunks:
+            raise EmptyResponseError(f"流式响应没有返回内容，模型: {model}")
+        return "".join(chunks)
+    
     def _emit(self, event_type: str, data: Dict[str, Any]):
         """发送进度事件"""
         if self.on_progress:
@@ -104,6 +177,7 @@ class UltraThinkEngine:
         client = self._get_client_for_stage("planning")
         plan = await client.generate_text(
             model=planning_model,
+            stage="planning",
             messages=messages,
             **self.llm_params
         )
@@ -121,6 +195,7 @@ class UltraThinkEngine:
             client = self._get_client_for_stage("agent_config")
             result = await client.generate_object(
                 model=agent_config_model,
+                stage="agent_config",
                 prompt=GENERATE_AGENT_PROMPTS_PROMPT.replace("{plan}", plan),
                 response_format={"type": "json_object"},
                 **self.llm_params
@@ -140,6 +215,7 @@ class UltraThinkEngine:
             # 回退到文本解析
             text = await client.generate_text(
                 model=agent_config_model,
+                stage="agent_config",
                 prompt=GENERATE_AGENT_PROMPTS_PROMPT.replace("{plan}", plan),
                 **self.llm_params
             )
@@ -216,6 +292,7 @@ class UltraThinkEngine:
                 client=self.client,
                 model=agent_thinking_model,
                 problem_statement=problem_statement,
+                problem_statement_text=self.problem_statement_text,
                 conversation_history=agent_history,
                 other_prompts=[specific_prompt],  # agent 特定提示词作为额外上下文
                 knowledge_context=self.knowledge_context,
@@ -229,7 +306,10 @@ class UltraThinkEngine:
                 clients_by_provider=self.clients_by_provider,
                 default_provider_id=self.default_provider_id,
                 provider_stages=self.provider_stages,
+                stage_routers=self.stage_routers,
+                usage_stage_prefix="agent_thinking.",
             )
+            self._agents.append((result, engine))
             
             deep_think_result = await engine.run()
             
@@ -272,6 +352,7 @@ class UltraThinkEngine:
             
             # 生成计划 (UltraThink 内置功能) - 传递多模态内容
             plan = await self._generate_plan(self.problem_statement)
+            self._plan = plan
             
             # 生成 agent 配置
             configs = await self._generate_agent_configs(plan)
@@ -367,7 +448,10 @@ Please analyze all approaches, identify the best insights from each, resolve any
                 clients_by_provider=self.clients_by_provider,
                 default_provider_id=self.default_provider_id,
                 provider_stages=self.provider_stages,
+                stage_routers=self.stage_routers,
+                usage_stage_prefix="synthesis.",
             )
+            self._synthesis_engine = synthesis_engine
             
             synthesis_result = await synthesis_engine.run()
             synthesis = synthesis_result.summary  # 使用 DeepThink 的摘要作为综合结果
@@ -379,19 +463,13 @@ Please analyze all approaches, identify the best insights from each, resolve any
             # 生成最终摘要
             self._emit("summarizing", {"message": "Creating final summary for user..."})
             
-            summary_model = self._get_model_for_stage("summary")
             # 使用文本版本构建摘要提示词
             summary_prompt = build_final_summary_prompt(
                 self.problem_statement_text,
                 synthesis
             )
             
-            client = self._get_client_for_stage("summary")
-            final_summary = await client.generate_text(
-                model=summary_model,
-                prompt=summary_prompt,
-                **self.llm_params
-            )
+            final_summary = await self._generate_final_text("summary", summary_prompt)
             
             # 获取统计信息
             stats = self.client.get_statistics()
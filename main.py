@@ -2,13 +2,19 @@
 Deep Think API 主应用
 FastAPI 应用程序入口
 """
+import asyncio
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
 from config import config
-from api.v1 import chat, models
+from api.v1 import chat, models, jobs, usage, batches
+from utils.response_cache import response_cache
+from utils.client_pool import provider_clients
+from utils.rate_limiter import rate_limiter
+from utils.admission import admission_controller
+from utils.latency import latency_tracker, provider_health
 
 # 配置日志
 logging.basicConfig(
@@ -23,8 +29,18 @@ async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     logger.info("Starting Deep Think API...")
     logger.info(f"Loaded {len(config.list_models())} models")
+    provider_clients.start()
+    await jobs.job_manager.start()
+    await batches.batch_manager.start()
+    purged = await asyncio.to_thread(response_cache.purge_expired)
+    if purged:
+        logger.info(f"Purged {purged} expired response cache entries")
     yield
     logger.info("Shutting down Deep Think API...")
+    await batches.batch_manager.stop()
+    await jobs.job_manager.stop()
+    await provider_clients.close()
+    rate_limiter.close()
 
 
 # 创建 FastAPI 应用
@@ -47,6 +63,9 @@ app.add_middleware(
 # 注册路由
 app.include_router(chat.router, tags=["Chat"])
 app.include_router(models.router, tags=["Models"])
+app.include_router(jobs.router, tags=["Jobs"])
+app.include_router(usage.router, tags=["Usage"])
+app.include_router(batches.router, tags=["Batches"])
 
 
 @app.get("/")
@@ -58,15 +77,46 @@ async def root():
         "description": "OpenAI-compatible API with DeepThink and UltraThink reasoning engines",
         "endpoints": {
             "chat": "/v1/chat/completions",
+            "chat_ws": "/v1/chat/ws",
             "models": "/v1/models",
+            "jobs": "/v1/jobs",
+            "usage": "/v1/usage",
+            "files": "/v1/files",
+            "batches": "/v1/batches",
+            "metrics": "/metrics",
         }
     }
 
 
 @app.get("/health")
 async def health():
-    """健康检查"""
-    return {"status": "healthy"}
+    """健康检查：有提供商熔断时状态为 degraded，并列出各提供商的熔断状态"""
+    circuits = provider_clients.circuit_stats()
+    degraded = any(stats["state"] != "closed" for stats in circuits.values())
+    return {
+        "status": "degraded" if degraded else "healthy",
+        "providers": {provider_id: stats["state"] for provider_id, stats in circuits.items()},
+    }
+
+
+@app.get("/metrics")
+async def metrics(authorization: str = Header(None)):
+    """
+    运行指标：各模型的准入排队情况，各后端限流器（提供商:密钥:模型）的配置限制、
+    自适应调整后的实际 RPM、收到的 429 次数和当前占用，各 (提供商, 模型, 阶段) 的调用耗时，
+    各 (提供商, 模型) 用于路由的错误率和延迟，以及各提供商的熔断状态；
+    启用鉴权时仅管理员密钥可访问
+    """
+    caller = chat.verify_auth(authorization)
+    if caller is not None and not caller.admin:
+        raise HTTPException(status_code=403, detail="Admin API key required")
+    return {
+        "admission": admission_controller.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "latency": latency_tracker.stats(),
+        "targets": provider_health.stats(),
+        "circuits": provider_clients.circuit_stats(),
+    }
 
 
 if __name__ == "__main__":
@@ -61,6 +61,8 @@ class ChatCompletionRequest(BaseModel):
     frequency_penalty: Optional[float] = 0
     logit_bias: Optional[Dict[str, float]] = None
     user: Optional[str] = None
+    # 流式选项（include_usage 为 true 时在结束前发送 usage 块）
+    stream_options: Optional[Dict[str, Any]] = None
     
     # DeepThink 特定参数
     deep_think_options: Optional[Dict[str, Any]] = None
@@ -78,6 +80,8 @@ class Usage(BaseModel):
     prompt_tokens: int
     completion_tokens: int
     total_tokens: int
+    # 按阶段的用量明细（deep_think_options.usage_breakdown 为 true 时返回）
+    stage_usage: Optional[Dict[str, Dict[str, int]]] = None
 
 
 class ChatCompletionResponse(BaseModel):
@@ -99,6 +103,81 @@ class ChatCompletionChunk(BaseModel):
     choices: List[Dict[str, Any]]
 
 
+# ============ 后台任务模型 ============
+
+class JobCreateRequest(ChatCompletionRequest):
+    """后台任务创建请求：聊天补全参数 + 可选的完成回调地址"""
+    webhook_url: Optional[str] = None
+
+
+class JobObject(BaseModel):
+    """后台任务状态"""
+    id: str
+    object: str = "deep_think.job"
+    model: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    progress: Optional[Dict[str, Any]] = None
+    result: Optional[ChatCompletionResponse] = None
+    error: Optional[str] = None
+
+
+# ============ 文件与批处理模型（OpenAI Files / Batch API） ============
+
+class FileObject(BaseModel):
+    """上传的文件"""
+    id: str
+    object: str = "file"
+    bytes: int
+    created_at: int
+    filename: str
+    purpose: str
+
+
+class BatchCreateRequest(BaseModel):
+    """批处理创建请求"""
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchRequestCounts(BaseModel):
+    """批处理中各状态的请求数量"""
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    """批处理状态"""
+    id: str
+    object: str = "batch"
+    endpoint: str
+    errors: Optional[Dict[str, Any]] = None
+    input_file_id: str
+    completion_window: str
+    status: Literal[
+        "validating", "failed", "in_progress", "finalizing",
+        "completed", "expired", "cancelling", "cancelled",
+    ]
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = BatchRequestCounts()
+    metadata: Optional[Dict[str, str]] = None
+
+
 # ============ Deep Think 内部模型 ============
 
 class Verification(BaseModel):
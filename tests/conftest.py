@@ -0,0 +1,153 @@
+"""
+测试公共配置
+config 模块导入时读取当前目录的 config.yaml，这里先在临时目录写入最小配置再导入项目模块；
+另外提供各测试共用的模拟流式响应、客户端和熔断配置
+"""
+import asyncio
+import inspect
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TEST_CONFIG = """
+system:
+  key: "test-admin-key"
+  max_retry: 0
+
+provider:
+  p1:
+    base_url: "http://127.0.0.1:9/v1"
+    key: "sk-test"
+
+model:
+  m1:
+    name: "Test Model"
+    provider: p1
+    model: backend-model
+"""
+
+_workdir = tempfile.mkdtemp(prefix="deepthink-test-")
+Path(_workdir, "config.yaml").write_text(TEST_CONFIG, encoding="utf-8")
+os.chdir(_workdir)
+
+# 以下导入依赖上面写入的配置
+from types import SimpleNamespace  # noqa: E402
+
+import httpx  # noqa: E402
+import openai  # noqa: E402
+import pytest  # noqa: E402
+
+from config import config  # noqa: E402
+from models import DeepThinkResult  # noqa: E402
+from utils.circuit_breaker import CircuitBreaker  # noqa: E402
+from utils.latency import HealthTracker  # noqa: E402
+from utils.openai_client import create_client  # noqa: E402
+import utils.openai_client as openai_client  # noqa: E402
+import utils.routing as routing  # noqa: E402
+
+
+class FakeStream:
+    """模拟 SDK 的流式响应：依次输出 texts，之后抛出 error（如有）"""
+
+    def __init__(self, texts, error=None):
+        self._texts = list(texts)
+        self._error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._texts:
+            text = self._texts.pop(0)
+            return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+        if self._error is not None:
+            raise self._error
+        raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+def completion(text: str):
+    """模拟 SDK 的非流式响应"""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+
+
+def status_error(status: int, headers=None) -> openai.APIStatusError:
+    """提供商返回的 HTTP 错误"""
+    request = httpx.Request("POST", "http://test/v1/chat/completions")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def make_client(provider_id: str, respond, **options):
+    """
+    带独立熔断器、默认不重试的客户端；每次调用以请求参数调用 respond，
+    返回值（可以是协程）作为 SDK 的响应，respond 抛出的异常即调用失败
+    """
+    options = {"max_retry": 0, "breaker": CircuitBreaker(provider_id), **options}
+    client = create_client("http://test", "k", provider_id=provider_id, **options)
+
+    async def create(**request):
+        result = respond(**request)
+        return await result if inspect.isawaitable(result) else result
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return client
+
+
+@pytest.fixture
+def provider_health(monkeypatch):
+    """启用熔断（3 次调用、50% 失败率即熔断），并使用独立的健康状况统计"""
+    system = config._config.setdefault("system", {})
+    for name, value in (("circuit_breaker", True), ("circuit_min_calls", 3), ("circuit_failure_rate", 0.5)):
+        monkeypatch.setitem(system, name, value)
+    health = HealthTracker()
+    monkeypatch.setattr(openai_client, "provider_health", health)
+    monkeypatch.setattr(routing, "provider_health", health)
+    return health
+
+
+class FakeEngine:
+    """模拟引擎：记录运行次数，等待 delay 秒后返回固定答案或抛出 error"""
+
+    def __init__(self, runs: list, delay: float = 0.0, error: Exception = None):
+        self.runs = runs
+        self.delay = delay
+        self.error = error
+        self.on_progress = None
+        self.on_content = None
+
+    async def run(self):
+        self.runs.append(self)
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return DeepThinkResult(
+            initial_thought="", iterations=[], verifications=[], final_solution=f"answer {len(self.runs)}",
+            total_iterations=0, successful_verifications=0,
+        )
+
+
+@pytest.fixture
+def fake_engine(monkeypatch):
+    """让聊天补全使用 FakeEngine，返回可调整 delay / error 的设置和运行记录"""
+    import api.v1.chat as chat
+
+    settings = SimpleNamespace(runs=[], delay=0.0, error=None)
+    monkeypatch.setattr(
+        chat, "build_engine", lambda prepared: FakeEngine(settings.runs, settings.delay, settings.error)
+    )
+    return settings
+
+
+ADMIN_HEADERS = {"Authorization": "Bearer test-admin-key"}
+
+
+def chat_body(content: str = "hi", **extra):
+    """最小的聊天补全请求体"""
+    return {"model": "m1", "messages": [{"role": "user", "content": content}], **extra}
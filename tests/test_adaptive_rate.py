@@ -0,0 +1,66 @@
+"""自适应限速：429 时按 AIMD 降低 RPM 并暂停，成功响应逐步恢复"""
+import pytest
+
+from config import config
+from utils.rate_limiter import CompositeLimiter, parse_duration, retry_after, AIMD_DECREASE_COOLDOWN
+
+
+@pytest.fixture(autouse=True)
+def adaptive(monkeypatch):
+    monkeypatch.setitem(config._config.setdefault("system", {}), "adaptive_rate_limit", True)
+
+
+def test_429_halves_rate_and_pauses():
+    limiter = CompositeLimiter(rpm=60, key="p1")
+    limiter.feedback(429, {"retry-after": "3"})
+    assert limiter.effective_rpm == 30
+    assert limiter.throttled == 1
+    assert 2 < limiter.stats()["paused_for"] <= 3
+    assert not limiter.has_capacity()
+    # 冷却期内的并发 429 不再继续减半
+    limiter.feedback(429, {})
+    assert (limiter.effective_rpm, limiter.throttled) == (30, 2)
+
+
+def test_successes_recover_to_configured_rpm():
+    limiter = CompositeLimiter(rpm=4, key="p1")
+    limiter.feedback(429, {})
+    assert limiter.effective_rpm == 2
+    limiter.feedback(200, {})
+    assert limiter.effective_rpm == 3
+    limiter.feedback(200, {})
+    assert limiter.effective_rpm == 4
+    assert limiter._adaptive is None
+
+
+def test_second_429_after_cooldown_halves_again():
+    limiter = CompositeLimiter(rpm=40, key="p1")
+    limiter.feedback(429, {})
+    limiter._last_decrease -= AIMD_DECREASE_COOLDOWN
+    limiter.feedback(429, {})
+    assert limiter.effective_rpm == 10
+
+
+def test_exhausted_quota_header_pauses_until_reset():
+    limiter = CompositeLimiter(rpm=60, key="p1")
+    limiter.feedback(200, {"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s"})
+    assert 1 < limiter.stats()["paused_for"] <= 2
+    # 只暂停，不降低速率
+    assert limiter.effective_rpm == 60
+
+
+def test_disabled_adaptive_ignores_feedback(monkeypatch):
+    monkeypatch.setitem(config._config["system"], "adaptive_rate_limit", False)
+    limiter = CompositeLimiter(rpm=60, key="p1")
+    limiter.feedback(429, {"retry-after": "3"})
+    assert (limiter.effective_rpm, limiter.throttled) == (60, 0)
+
+
+def test_parse_rate_limit_headers():
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1.5") == 1.5
+    assert parse_duration("soon") is None
+    assert retry_after({"retry-after-ms": "250"}) == 0.25
+    assert retry_after({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "4s"}) == 4
+    assert retry_after({}) is None
@@ -0,0 +1,102 @@
+"""AdmissionController 的模型并发闸门与密钥配额"""
+import asyncio
+
+import pytest
+
+from config import ApiKeyConfig, ModelConfig
+from utils.admission import AdmissionController, AdmissionRejected
+
+
+def model(max_concurrent=None) -> ModelConfig:
+    return ModelConfig(model_id="m1", name="m1", provider="p1", model="m", max_concurrent=max_concurrent)
+
+
+def key(max_concurrent=None, daily_tokens=None) -> ApiKeyConfig:
+    return ApiKeyConfig(name="team", key_hash="x", max_concurrent=max_concurrent, daily_tokens=daily_tokens)
+
+
+def test_timed_request_rejected_when_key_is_full():
+    controller = AdmissionController()
+    caller = key(max_concurrent=1)
+    controller.admit(model(), timeout=30, caller=caller)
+    with pytest.raises(AdmissionRejected):
+        controller.admit(model(), timeout=30, caller=caller)
+    assert controller._key_gates["team"].active == 1
+
+
+def test_untimed_requests_wait_for_key_slot():
+    """后台任务（没有期限）不被拒绝，但同一密钥同时运行的数量不超过 max_concurrent"""
+    state = {"running": 0, "peak": 0}
+
+    async def job(controller, caller):
+        async with controller.admit(model(), timeout=None, caller=caller):
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            await asyncio.sleep(0.01)
+            state["running"] -= 1
+
+    async def scenario():
+        controller = AdmissionController()
+        caller = key(max_concurrent=2)
+        await asyncio.gather(*[job(controller, caller) for _ in range(6)])
+        return controller._key_gates["team"]
+
+    key_gate = asyncio.run(scenario())
+    assert state["peak"] == 2
+    assert (key_gate.active, key_gate.running, key_gate.runs) == (0, 0, 6)
+
+
+def test_timed_request_rejected_while_untimed_work_queues():
+    async def scenario():
+        controller = AdmissionController()
+        caller = key(max_concurrent=1)
+        release = asyncio.Event()
+
+        async def job():
+            async with controller.admit(model(), timeout=None, caller=caller):
+                await release.wait()
+
+        tasks = [asyncio.create_task(job()) for _ in range(3)]
+        await asyncio.sleep(0)
+        key_gate = controller._key_gates["team"]
+        assert (key_gate.running, key_gate.stats()["waiting"]) == (1, 2)
+        with pytest.raises(AdmissionRejected):
+            controller.admit(model(), timeout=30, caller=caller)
+        release.set()
+        await asyncio.gather(*tasks)
+        return key_gate
+
+    key_gate = asyncio.run(scenario())
+    assert (key_gate.active, key_gate.running) == (0, 0)
+
+
+def test_cancelled_waiter_returns_key_and_model_slots():
+    async def scenario():
+        controller = AdmissionController()
+        caller = key(max_concurrent=1)
+        release = asyncio.Event()
+
+        async def job():
+            async with controller.admit(model(max_concurrent=1), timeout=None, caller=caller):
+                await release.wait()
+
+        first = asyncio.create_task(job())
+        second = asyncio.create_task(job())
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        release.set()
+        await first
+        return controller._key_gates["team"], controller._gates["m1"]
+
+    key_gate, gate = asyncio.run(scenario())
+    assert (key_gate.active, key_gate.running) == (0, 0)
+    assert (gate.queued, gate.running, gate.waiting) == (0, 0, 0)
+
+
+def test_daily_budget_rejects_even_untimed_requests():
+    controller = AdmissionController()
+    caller = key(daily_tokens=100)
+    controller._key_gate(caller).day_tokens = 100
+    with pytest.raises(AdmissionRejected):
+        controller.admit(model(), timeout=None, caller=caller)
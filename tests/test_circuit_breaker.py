@@ -0,0 +1,79 @@
+"""熔断器状态转换：closed -> open -> half_open -> closed，熔断时改用备用提供商"""
+import asyncio
+
+import openai
+import pytest
+
+from conftest import completion, make_client, status_error
+from config import config
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+def expire(breaker: CircuitBreaker):
+    """跳过熔断等待时间"""
+    breaker._opened_at -= config.circuit_open_seconds
+
+
+def test_breaker_opens_probes_and_closes(provider_health):
+    breaker = CircuitBreaker("p1")
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.record(True)
+    assert breaker.state == OPEN
+    assert not breaker.allow() and breaker.rejected == 1
+    expire(breaker)
+    # 半开时只放行一个探测调用
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["failure_rate"] == 0.0
+
+
+def test_failed_probe_reopens(provider_health):
+    breaker = CircuitBreaker("p1")
+    for _ in range(3):
+        breaker.record(True)
+    expire(breaker)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == OPEN and breaker.opened == 2
+    assert breaker.retry_after() > 0
+
+
+def test_slow_calls_count_as_failures(provider_health, monkeypatch):
+    monkeypatch.setitem(config._config["system"], "circuit_slow_call", 1.0)
+    breaker = CircuitBreaker("p1")
+    for _ in range(3):
+        breaker.record(False, latency=2.0)
+    assert breaker.state == OPEN
+
+
+def provider(provider_id: str, calls: list, fail: bool):
+    def respond(**_):
+        calls.append(provider_id)
+        if fail:
+            raise status_error(503)
+        return completion(provider_id)
+    return make_client(provider_id, respond)
+
+
+def test_open_circuit_fails_fast_or_uses_fallback(provider_health):
+    calls = []
+    primary = provider("primary", calls, fail=True)
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(openai.APIStatusError):
+                await primary.generate_text("m", prompt="hi")
+        assert primary.breaker.state == OPEN
+        # 没有备用提供商时立即失败，不再调用提供商
+        with pytest.raises(CircuitOpenError):
+            await primary.generate_text("m", prompt="hi")
+        assert len(calls) == 3
+        primary.fallback_client = provider("backup", calls, fail=False)
+        return await primary.generate_text("m", prompt="hi")
+
+    assert asyncio.run(scenario()) == "backup"
+    assert calls == ["primary"] * 3 + ["backup"]
@@ -0,0 +1,82 @@
+"""EngineRun 的准入名额归还"""
+import asyncio
+from types import SimpleNamespace
+
+from config import ApiKeyConfig, ModelConfig
+from utils.admission import AdmissionController
+from utils.engine_run import EngineRun
+from utils.sse_writer import SSEWriter
+
+
+class FakeEngine:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.started = False
+
+    async def run(self):
+        self.started = True
+        await asyncio.sleep(self.delay)
+        return SimpleNamespace(summary=None, final_solution="answer")
+
+
+def make_run(controller: AdmissionController, engine: FakeEngine):
+    model_config = ModelConfig(model_id="m1", name="m1", provider="p1", model="m", max_concurrent=1)
+    caller = ApiKeyConfig(name="team", key_hash="x", max_concurrent=2)
+    ticket = controller.admit(model_config, timeout=None, caller=caller)
+    run = EngineRun(engine, SSEWriter("run", 0, "m1"), admission=ticket, grace_period=0)
+    gate = controller._gates["m1"]
+    key_gate = controller._key_gates["team"]
+    return run, gate, key_gate
+
+
+def test_cancel_before_engine_starts_returns_ticket():
+    async def scenario():
+        controller = AdmissionController()
+        engine = FakeEngine()
+        run, gate, key_gate = make_run(controller, engine)
+        run.start()
+        # 引擎任务还没有执行第一步就被取消
+        run.cancel()
+        await run.wait()
+        return engine, gate, key_gate
+
+    engine, gate, key_gate = asyncio.run(scenario())
+    assert not engine.started
+    assert (gate.queued, gate.running) == (0, 0)
+    assert key_gate.active == 0
+
+
+def test_cancel_while_queued_and_running_returns_ticket():
+    async def scenario():
+        controller = AdmissionController()
+        first, gate, key_gate = make_run(controller, FakeEngine(delay=10))
+        second, _, _ = make_run(controller, FakeEngine())
+        first.start()
+        second.start()
+        await asyncio.sleep(0.01)
+        assert (gate.running, gate.waiting) == (1, 1)
+        second.cancel()
+        await second.wait()
+        first.cancel()
+        await first.wait()
+        return gate, key_gate
+
+    gate, key_gate = asyncio.run(scenario())
+    assert (gate.queued, gate.running, gate.waiting) == (0, 0, 0)
+    assert key_gate.active == 0
+
+
+def test_completed_run_releases_ticket_once():
+    async def scenario():
+        controller = AdmissionController()
+        run, gate, key_gate = make_run(controller, FakeEngine())
+        run.start()
+        await run.wait()
+        # 已进入过 async with 的凭证再次归还不应重复扣减
+        run.admission.discard()
+        return run, gate, key_gate
+
+    run, gate, key_gate = asyncio.run(scenario())
+    assert run.result.final_solution == "answer"
+    assert (gate.queued, gate.running, gate.completed) == (0, 0, 1)
+    assert key_gate.active == 0
@@ -0,0 +1,56 @@
+"""ProgressEventBus 的容量与溢出策略"""
+import asyncio
+
+from models import ProgressEvent
+from utils.event_bus import ProgressEventBus
+
+
+def drain(bus: ProgressEventBus):
+    async def collect():
+        events = []
+        async for event in bus:
+            events.append(event)
+        return events
+    return asyncio.run(collect())
+
+
+def test_progress_events_dropped_when_full():
+    bus = ProgressEventBus(maxsize=2)
+    for i in range(5):
+        bus.publish(ProgressEvent(type="thinking", data={"i": i}))
+    bus.close()
+    events = drain(bus)
+    assert [e.data["i"] for e in events] == [0, 1]
+    assert bus.dropped == 3
+
+
+def test_content_coalesced_not_dropped_and_queue_bounded():
+    bus = ProgressEventBus(maxsize=2)
+    for text in "abcdefg":
+        bus.publish_content(text)
+    bus.publish(ProgressEvent(type="thinking", data={}))
+    bus.publish_draft("x")
+    bus.close()
+    assert bus._queue.qsize() == 2
+    events = drain(bus)
+    assert [e.type for e in events] == ["content", "content", "content", "draft"]
+    assert "".join(e.data["text"] for e in events if e.type == "content") == "abcdefg"
+    assert bus.dropped == 1
+
+
+def test_get_batch_refills_overflow_in_order():
+    bus = ProgressEventBus(maxsize=1)
+    for text in ("a", "b", "c"):
+        bus.publish_content(text)
+    bus.close()
+
+    async def batches():
+        result = []
+        while True:
+            batch = await bus.get_batch()
+            if batch is None:
+                return result
+            result.extend(e.data["text"] for e in batch)
+    assert "".join(asyncio.run(batches())) == "abc"
+    # 关闭后重复读取仍然返回 None
+    assert asyncio.run(bus.get()) is None
@@ -0,0 +1,51 @@
+"""对冲请求发往其他提供商时使用该提供商的模型 id"""
+import asyncio
+
+import pytest
+
+from conftest import completion, make_client
+from utils.latency import LatencyTracker
+import utils.openai_client as openai_client
+
+
+def recording_client(provider_id: str, calls: list, delay: float = 0.0):
+    """记录 (提供商, 模型)；第一次调用等待 delay 秒，之后的调用立即返回"""
+    async def respond(model, **_):
+        calls.append((provider_id, model))
+        await asyncio.sleep(delay if len(calls) == 1 else 0)
+        return completion(provider_id)
+    return make_client(provider_id, respond)
+
+
+@pytest.fixture(autouse=True)
+def latency(monkeypatch):
+    tracker = LatencyTracker()
+    monkeypatch.setattr(openai_client, "latency_tracker", tracker)
+    # 主调用的 p95 很短，之后较慢的调用会触发对冲
+    for _ in range(20):
+        tracker.record(("primary", "gpt-4o", "default"), 0.01)
+    return tracker
+
+
+def hedged_call(hedge_models):
+    calls = []
+    primary = recording_client("primary", calls, delay=5)
+    backup = recording_client("backup", calls)
+    primary.hedge = True
+    primary.hedge_client = backup
+    primary.hedge_models = hedge_models
+    text = asyncio.run(primary.generate_text("gpt-4o", prompt="hi"))
+    return text, calls, primary
+
+
+def test_cross_provider_hedge_uses_the_target_model_id():
+    text, calls, primary = hedged_call({"gpt-4o": "openai/gpt-4o"})
+    assert calls == [("primary", "gpt-4o"), ("backup", "openai/gpt-4o")]
+    assert text == "backup"
+    assert (primary.hedges, primary.hedge_wins) == (1, 1)
+
+
+def test_unmapped_model_hedges_on_the_same_provider():
+    text, calls, _ = hedged_call({})
+    assert calls == [("primary", "gpt-4o"), ("primary", "gpt-4o")]
+    assert text == "primary"
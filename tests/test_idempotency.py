@@ -0,0 +1,63 @@
+"""Idempotency-Key：重试加入原运行或返回保存的结果，不同请求体返回 422"""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import ADMIN_HEADERS, chat_body
+from config import config
+from main import app
+
+
+def headers(key: str):
+    return {**ADMIN_HEADERS, "Idempotency-Key": key}
+
+
+@pytest.fixture(autouse=True)
+def no_single_flight(monkeypatch):
+    # 关闭相同请求合并，只验证幂等键本身
+    monkeypatch.setitem(config._config.setdefault("system", {}), "single_flight", False)
+
+
+def test_retry_replays_the_saved_response(fake_engine):
+    client = TestClient(app)
+    first = client.post("/v1/chat/completions", json=chat_body("replay"), headers=headers("k-replay"))
+    second = client.post("/v1/chat/completions", json=chat_body("replay"), headers=headers("k-replay"))
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert len(fake_engine.runs) == 1
+
+
+def test_same_key_with_different_body_is_rejected(fake_engine):
+    client = TestClient(app)
+    assert client.post("/v1/chat/completions", json=chat_body("one"), headers=headers("k-conflict")).status_code == 200
+    response = client.post("/v1/chat/completions", json=chat_body("two"), headers=headers("k-conflict"))
+    assert response.status_code == 422
+    assert len(fake_engine.runs) == 1
+
+
+def test_concurrent_retries_share_one_run(fake_engine):
+    fake_engine.delay = 0.05
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*[
+                client.post("/v1/chat/completions", json=chat_body("race"), headers=headers("k-race"))
+                for _ in range(3)
+            ])
+
+    responses = asyncio.run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert len({r.json()["choices"][0]["message"]["content"] for r in responses}) == 1
+    assert len(fake_engine.runs) == 1
+
+
+def test_failed_run_releases_the_key(fake_engine):
+    client = TestClient(app, raise_server_exceptions=False)
+    fake_engine.error = RuntimeError("backend down")
+    assert client.post("/v1/chat/completions", json=chat_body("fail"), headers=headers("k-fail")).status_code == 500
+    fake_engine.error = None
+    assert client.post("/v1/chat/completions", json=chat_body("fail"), headers=headers("k-fail")).status_code == 200
+    assert len(fake_engine.runs) == 2
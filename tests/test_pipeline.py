@@ -0,0 +1,63 @@
+"""客户端期限的解析：只在客户端给出时作为后端调用期限"""
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from config import config
+from models import ChatCompletionRequest, Message
+from api.v1.pipeline import prepare_request, resolve_timeout
+from main import app
+
+
+def make_request(**options) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model="m1",
+        messages=[Message(role="user", content="hi")],
+        deep_think_options=options or None,
+    )
+
+
+def test_timeout_from_header_or_options():
+    assert resolve_timeout(None, make_request()) is None
+    assert resolve_timeout("30", make_request(timeout=5)) == 30.0
+    assert resolve_timeout(None, make_request(timeout=5)) == 5.0
+
+
+@pytest.mark.parametrize("header, options", [
+    ("abc", {}),
+    ("0", {}),
+    ("-5", {}),
+    ("nan", {}),
+    (None, {"timeout": "soon"}),
+    (None, {"timeout": True}),
+])
+def test_invalid_timeout_is_rejected(header, options):
+    with pytest.raises(HTTPException) as e:
+        resolve_timeout(header, make_request(**options))
+    assert e.value.status_code == 400
+
+
+def test_no_client_timeout_means_no_run_deadline():
+    model_config = config.get_model("m1")
+    prepared = prepare_request(make_request(), model_config, max_wait=config.admission_max_wait)
+    # admission_max_wait 只限制准入排队，不会成为重试和排队的截止时间
+    assert prepared.deadline is None
+    assert prepared.max_wait == config.admission_max_wait
+    timed = prepare_request(make_request(), model_config, timeout=30, max_wait=30)
+    assert timed.deadline == pytest.approx(timed.created_at + 30)
+
+
+def test_invalid_timeout_returns_400():
+    client = TestClient(app)
+    response = client.post(
+        "/v1/chat/completions",
+        json={"model": "m1", "messages": [{"role": "user", "content": "hi"}]},
+        headers={"Authorization": "Bearer test-admin-key", "X-Request-Timeout": "abc"},
+    )
+    assert response.status_code == 400
+    response = client.post(
+        "/v1/chat/completions",
+        json={"model": "m1", "messages": [{"role": "user", "content": "hi"}], "deep_think_options": {"timeout": "x"}},
+        headers={"Authorization": "Bearer test-admin-key"},
+    )
+    assert response.status_code == 400
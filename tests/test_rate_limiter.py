@@ -0,0 +1,84 @@
+"""RateLimiterManager 按键和限制划分限流器"""
+import asyncio
+
+from utils.rate_limiter import RateLimiterManager
+
+KEY = "p1:abcd1234:backend-model"
+
+
+def test_different_limits_on_same_backend_are_independent():
+    manager = RateLimiterManager()
+    # 先调用普通版再调用快速版，快速版不会被压到普通版的限制
+    slow = manager._get_scheduler(KEY, 10, None, 2)
+    fast = manager._get_scheduler(KEY, 50, 100000, None)
+    assert slow is not fast
+    assert (slow.limiter.rpm, slow.limiter.tpm, slow.limiter.max_inflight) == (10, None, 2)
+    assert (fast.limiter.rpm, fast.limiter.tpm, fast.limiter.max_inflight) == (50, 100000, None)
+    # 反过来的顺序得到同样的结果
+    other = RateLimiterManager()
+    assert other._get_scheduler(KEY, 50, 100000, None).limiter.rpm == 50
+    assert other._get_scheduler(KEY, 10, None, 2).limiter.rpm == 10
+
+
+def test_same_limits_share_one_limiter():
+    manager = RateLimiterManager()
+    first = manager._get_scheduler(KEY, 10, None, None)
+    assert manager._get_scheduler(KEY, 10, None, None) is first
+    assert len(manager._schedulers) == 1
+
+
+def test_max_inflight_enforced_per_limit():
+    state = {"running": 0, "peak": 0}
+
+    async def call(manager):
+        permit = await manager.acquire(KEY, max_inflight=2)
+        state["running"] += 1
+        state["peak"] = max(state["peak"], state["running"])
+        await asyncio.sleep(0.01)
+        state["running"] -= 1
+        permit.release()
+
+    async def scenario():
+        manager = RateLimiterManager()
+        await asyncio.gather(*[call(manager) for _ in range(6)])
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert state["peak"] == 2
+    limiter = manager._get_scheduler(KEY, None, None, 2).limiter
+    assert limiter.in_flight == 0
+
+
+def test_has_spare_capacity_uses_the_configured_limits():
+    async def scenario():
+        manager = RateLimiterManager()
+        permit = await manager.acquire(KEY, max_inflight=1)
+        busy = manager.has_spare_capacity(KEY, max_inflight=1)
+        # 限制不同的限流器不受影响
+        other = manager.has_spare_capacity(KEY, max_inflight=4)
+        permit.release()
+        return busy, other, manager.has_spare_capacity(KEY, max_inflight=1)
+
+    assert asyncio.run(scenario()) == (False, True, True)
+
+
+def test_cancel_after_dispatch_returns_the_slot():
+    async def scenario():
+        manager = RateLimiterManager()
+        holder = await manager.acquire(KEY, max_inflight=1)
+        scheduler = manager._get_scheduler(KEY, None, None, 1)
+        task = asyncio.create_task(manager.acquire(KEY, max_inflight=1))
+        await asyncio.sleep(0)
+        waiter = scheduler._waiters[0]
+        holder.release()
+        # 分发任务把名额交给排队的调用后、调用恢复执行前取消它
+        while not waiter.future.done():
+            await asyncio.sleep(0)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return task.cancelled(), scheduler.limiter.in_flight
+
+    assert asyncio.run(scenario()) == (True, 0)
@@ -0,0 +1,68 @@
+"""响应缓存：命中时不再运行引擎，默认按调用方密钥隔离"""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import FakeEngine, chat_body
+from config import config, ApiKeyConfig
+from utils.response_cache import ResponseCache, cache_directives
+import api.v1.chat as chat
+from main import app
+
+KEYS = {"sk-a": ApiKeyConfig(name="team-a", key_hash="a"), "sk-b": ApiKeyConfig(name="team-b", key_hash="b")}
+
+
+@pytest.fixture
+def client(monkeypatch, fake_engine):
+    monkeypatch.setattr(chat, "response_cache", ResponseCache(1024 * 1024))
+    monkeypatch.setattr(config.get_model("m1"), "cache_ttl", 60)
+    monkeypatch.setattr(config, "lookup_api_key", KEYS.get)
+    return TestClient(app)
+
+
+def post(client, key: str, cache_control: str = None):
+    headers = {"Authorization": f"Bearer {key}"}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return client.post("/v1/chat/completions", json=chat_body("cached"), headers=headers)
+
+
+def test_repeat_request_is_served_from_cache(client, fake_engine):
+    first = post(client, "sk-a")
+    second = post(client, "sk-a")
+    assert (first.headers["X-Cache"], second.headers["X-Cache"]) == ("MISS", "HIT")
+    assert second.json()["choices"] == first.json()["choices"]
+    assert len(fake_engine.runs) == 1
+    # no-cache 跳过读取，重新运行
+    assert post(client, "sk-a", "no-cache").headers["X-Cache"] == "MISS"
+    assert len(fake_engine.runs) == 2
+
+
+def test_cache_is_scoped_per_key_unless_shared(client, fake_engine, monkeypatch):
+    post(client, "sk-a")
+    assert post(client, "sk-b").headers["X-Cache"] == "MISS"
+    assert len(fake_engine.runs) == 2
+    monkeypatch.setitem(config._config["system"], "response_cache_shared", True)
+    post(client, "sk-a")
+    assert post(client, "sk-b").headers["X-Cache"] == "HIT"
+    assert len(fake_engine.runs) == 3
+
+
+def test_expired_entries_are_not_returned():
+    async def scenario():
+        cache = ResponseCache(1024 * 1024)
+        result = await FakeEngine([]).run()
+        await cache.set("fresh", result, 60)
+        await cache.set("stale", result, -1)
+        return await cache.get("fresh"), await cache.get("stale")
+
+    fresh, stale = asyncio.run(scenario())
+    assert fresh.final_solution == "answer 1"
+    assert stale is None
+
+
+def test_cache_directives():
+    assert cache_directives(None) == (True, True)
+    assert cache_directives("no-cache") == (False, True)
+    assert cache_directives("No-Store, max-age=0") == (False, False)
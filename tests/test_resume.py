@@ -0,0 +1,54 @@
+"""断线重连只对发起运行的密钥开放"""
+import pytest
+from fastapi.testclient import TestClient
+
+from config import config, ApiKeyConfig
+from utils.engine_run import EngineRun, RunRegistry, run_registry
+from utils.sse_writer import SSEWriter
+from main import app
+
+OWNER = ApiKeyConfig(name="team-a", key_hash="a")
+OTHER = ApiKeyConfig(name="team-b", key_hash="b")
+ADMIN = ApiKeyConfig(name="ops", key_hash="c", admin=True)
+
+
+def make_run(run_id: str, owner=OWNER) -> EngineRun:
+    return EngineRun(None, SSEWriter(run_id, 0, "m1"), owner=owner.name)
+
+
+def test_registry_only_returns_runs_of_the_caller():
+    registry = RunRegistry()
+    run = make_run("chatcmpl-owned")
+    registry._runs[run.run_id] = run
+    assert registry.get(run.run_id, OWNER) is run
+    assert registry.get(run.run_id, ADMIN) is run
+    assert registry.get(run.run_id, OTHER) is None
+    # 未启用鉴权时不区分调用方
+    assert registry.get(run.run_id) is run
+
+
+@pytest.fixture
+def client(monkeypatch):
+    keys = {"sk-a": OWNER, "sk-b": OTHER}
+    monkeypatch.setattr(config, "lookup_api_key", keys.get)
+    run = make_run("chatcmpl-resume-test")
+    run_registry._runs[run.run_id] = run
+    yield TestClient(app)
+    run_registry._runs.pop(run.run_id, None)
+
+
+def test_other_key_cannot_resume_by_run_id(client):
+    response = client.get(
+        "/v1/chat/completions/chatcmpl-resume-test/stream",
+        headers={"Authorization": "Bearer sk-b"},
+    )
+    assert response.status_code == 404
+
+
+def test_other_key_cannot_resume_by_last_event_id(client):
+    response = client.post(
+        "/v1/chat/completions",
+        json={"model": "m1", "messages": [{"role": "user", "content": "hi"}], "stream": True},
+        headers={"Authorization": "Bearer sk-b", "Last-Event-ID": "chatcmpl-resume-test:0"},
+    )
+    assert response.status_code == 404
@@ -0,0 +1,86 @@
+"""重试：按错误类型决定是否重试，指数退避，受次数、请求级预算和客户端期限限制"""
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+from conftest import completion, make_client, status_error
+from config import config
+from utils.retry import (
+    RetryBudget, RetryPolicy, backoff_delay, classify_error, RATE_LIMIT, SERVER_ERROR, TIMEOUT, CONNECTION,
+)
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    system = config._config.setdefault("system", {})
+    monkeypatch.setitem(system, "retry_backoff_base", 0.001)
+    monkeypatch.setitem(system, "retry_backoff_max", 0.01)
+
+
+def test_classify_error():
+    assert classify_error(status_error(429)) == RATE_LIMIT
+    assert classify_error(status_error(503)) == SERVER_ERROR
+    assert classify_error(status_error(400)) is None
+    assert classify_error(status_error(401)) is None
+    assert classify_error(httpx.ReadTimeout("slow")) == TIMEOUT
+    assert classify_error(httpx.RemoteProtocolError("closed")) == CONNECTION
+    assert classify_error(ValueError("bad")) is None
+
+
+def test_backoff_is_bounded_and_respects_retry_after(monkeypatch):
+    monkeypatch.setitem(config._config["system"], "retry_backoff_max", 5)
+    assert all(0 <= backoff_delay(attempt) <= 0.001 * 2 ** (attempt - 1) for attempt in range(1, 6))
+    assert backoff_delay(1, status_error(429, {"retry-after": "2"})) >= 2
+    # retry-after 超过上限时按上限等待
+    assert backoff_delay(1, status_error(429, {"retry-after": "60"})) == 5
+
+
+def test_policy_stops_at_max_retry():
+    policy = RetryPolicy(max_retry=2, budget=None, deadline=None)
+    assert policy.next_delay(status_error(500)) is not None
+    assert policy.next_delay(status_error(500)) is not None
+    assert policy.next_delay(status_error(500)) is None
+    assert RetryPolicy(max_retry=2, budget=None, deadline=None).next_delay(status_error(400)) is None
+
+
+def test_policy_gives_up_past_the_deadline():
+    policy = RetryPolicy(max_retry=3, budget=None, deadline=time.monotonic())
+    assert policy.next_delay(status_error(500)) is None
+
+
+def test_budget_is_shared_across_calls():
+    budget = RetryBudget(ratio=0.5, min_retries=1)
+    first = RetryPolicy(max_retry=5, budget=budget, deadline=None)
+    second = RetryPolicy(max_retry=5, budget=budget, deadline=None)
+    # 两次调用：预算为 1 + 0.5 × 2 = 2 次重试
+    assert first.next_delay(status_error(500)) is not None
+    assert second.next_delay(status_error(500)) is not None
+    assert first.next_delay(status_error(500)) is None
+    assert budget.exhausted == 1
+
+
+def flaky_client(failures: int, **options):
+    calls = []
+
+    def respond(**_):
+        calls.append(1)
+        if len(calls) <= failures:
+            raise status_error(503)
+        return completion("ok")
+    return make_client("p1", respond, **options), calls
+
+
+def test_client_retries_transient_errors():
+    client, calls = flaky_client(failures=2, max_retry=3)
+    assert asyncio.run(client.generate_text("m", prompt="hi")) == "ok"
+    assert (len(calls), client.retries) == (3, 2)
+
+
+def test_client_stops_when_budget_is_exhausted():
+    client, calls = flaky_client(failures=5, max_retry=3, retry_budget=RetryBudget(ratio=0, min_retries=1))
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(client.generate_text("m", prompt="hi"))
+    assert len(calls) == 2
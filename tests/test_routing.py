@@ -0,0 +1,38 @@
+"""StageRouter 按健康状况选择目标：流式中途出错的目标会被避开"""
+import asyncio
+import random
+
+import httpx
+
+from conftest import FakeStream, make_client
+from config import StageTarget
+from utils.circuit_breaker import OPEN
+from utils.routing import StageRouter
+
+
+def test_mid_stream_failures_steer_router_away(provider_health):
+    random.seed(7)
+    error = httpx.RemoteProtocolError("peer closed connection")
+    bad = make_client("bad", lambda **_: FakeStream(["a", "b"], error))
+    good = make_client("good", lambda **_: FakeStream(["a", "b"]))
+    router = StageRouter([(StageTarget("m", "bad"), bad), (StageTarget("m", "good"), good)])
+    messages = [{"role": "user", "content": "hi"}]
+
+    async def call():
+        return [text async for text in router.stream_text("m", messages)]
+
+    async def scenario():
+        for _ in range(50):
+            if bad.breaker.state == OPEN:
+                return
+            try:
+                await call()
+            except httpx.RemoteProtocolError:
+                pass
+
+    asyncio.run(scenario())
+    assert bad.breaker.state == OPEN
+    assert provider_health.get("bad", "m").error_rate > provider_health.get("good", "m").error_rate
+    # 熔断中的目标总是排在最后
+    for _ in range(20):
+        assert router._order(messages, None)[0][1] is good
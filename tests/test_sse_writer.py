@@ -0,0 +1,40 @@
+"""SSEWriter 的预编码信封与增量合并"""
+import json
+
+from utils.sse_writer import SSEWriter, sse_frame
+
+
+def parse(frame: bytes):
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    return json.loads(frame[len(b"data: "):-2])
+
+
+def test_chunk_matches_openai_envelope():
+    writer = SSEWriter("chatcmpl-1", 1700000000, "m1")
+    assert parse(writer.chunk({"content": "你好\n\"x\""})) == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "m1",
+        "choices": [{"index": 0, "delta": {"content": "你好\n\"x\""}, "finish_reason": None}],
+    }
+    finish = parse(writer.finish())
+    assert finish["choices"] == [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    usage = json.loads(writer.usage_payload({"total_tokens": 3}))
+    assert usage["choices"] == [] and usage["usage"] == {"total_tokens": 3}
+
+
+def test_consecutive_deltas_of_the_same_field_are_coalesced():
+    writer = SSEWriter("chatcmpl-1", 0, "m1")
+    items = [
+        ("reasoning_content", "a"), ("reasoning_content", "b"),
+        ("content", "c"), ("content", "d"), ("reasoning_content", "e"),
+    ]
+    frames = writer.deltas(items).split(b"\n\n")[:-1]
+    deltas = [parse(frame + b"\n\n")["choices"][0]["delta"] for frame in frames]
+    assert deltas == [{"reasoning_content": "ab"}, {"content": "cd"}, {"reasoning_content": "e"}]
+    assert writer.deltas([]) == b""
+
+
+def test_sse_frame_with_event_id():
+    assert sse_frame(b"{}", "run:3") == b"id: run:3\ndata: {}\n\n"
@@ -0,0 +1,52 @@
+"""流式调用中途出错计入提供商健康状况和熔断器"""
+import asyncio
+
+import httpx
+import pytest
+
+from conftest import FakeStream, make_client
+from utils.circuit_breaker import OPEN, CLOSED
+
+
+async def consume(client):
+    texts = []
+    async for text in client.stream_text("m", [{"role": "user", "content": "hi"}]):
+        texts.append(text)
+    return texts
+
+
+def test_mid_stream_failures_open_the_circuit(provider_health):
+    error = httpx.RemoteProtocolError("peer closed connection")
+    client = make_client("flaky", lambda **_: FakeStream(["a", "b"], error))
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(httpx.RemoteProtocolError):
+                await consume(client)
+
+    asyncio.run(scenario())
+    assert client.breaker.state == OPEN
+    health = provider_health.get("flaky", "m")
+    assert health.errors == 3 and health.error_rate > 0
+
+
+def test_completed_stream_recorded_as_success(provider_health):
+    client = make_client("healthy", lambda **_: FakeStream(["a", "b"]))
+    assert asyncio.run(consume(client)) == ["a", "b"]
+    health = provider_health.get("healthy", "m")
+    assert (health.calls, health.errors) == (1, 0)
+    assert health.latency is not None
+    assert client.breaker.state == CLOSED
+
+
+def test_consumer_closing_early_is_not_a_failure(provider_health):
+    client = make_client("early", lambda **_: FakeStream(["a", "b", "c"]))
+
+    async def scenario():
+        stream = client.stream_text("m", [{"role": "user", "content": "hi"}])
+        assert await stream.__anext__() == "a"
+        await stream.aclose()
+
+    asyncio.run(scenario())
+    assert provider_health.get("early", "m").calls == 0
+    assert list(client.breaker._outcomes) == []
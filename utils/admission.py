@@ -0,0 +1,378 @@
+"""
+准入控制
+限制每个模型同时运行的引擎数量；超出时进入有界等待队列。
+根据 RPM 限制和历史运行情况估算排队时间，估算超过客户端期限时立即拒绝（429 + Retry-After），
+避免大量引擎挤在后端限流器里等到客户端超时。
+同时按调用方 API 密钥限制同时运行数和每日 token 预算，并累计每个密钥的用量
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Any
+
+from config import ModelConfig, ApiKeyConfig
+from utils.usage import UsageTracker
+
+# 尚无运行记录时的初始估计
+DEFAULT_RUN_SECONDS = 120.0
+DEFAULT_CALLS_PER_RUN = 10.0
+# 运行时长与调用次数的指数移动平均系数
+EWMA_ALPHA = 0.2
+# 密钥并发已满时建议的重试间隔(秒)
+KEY_BUSY_RETRY_AFTER = 5
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class SlotGate:
+    """并发名额：FIFO 等待队列，释放时直接把名额交给下一个等待者；limit 为空时不限制"""
+
+    limit: Optional[int] = None
+
+    def __init__(self):
+        self.running = 0
+        self._waiters: deque = deque()
+
+    async def _acquire(self):
+        if not self.limit or (self.running < self.limit and not self._waiters):
+            self.running += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # 名额由 _release 直接转交，running 计数不变
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # 名额已转交但没用上，继续传给下一个
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class ModelGate(SlotGate):
+    """单个模型的并发闸门"""
+
+    def __init__(self, model_config: ModelConfig):
+        super().__init__()
+        self.model_id = model_config.model_id
+        self.limit = model_config.max_concurrent
+        self.max_queue = model_config.max_queue if model_config.max_queue is not None else self.limit * 4
+        self.rpm = model_config.rpm
+        # 已准入、尚未开始运行的请求数量（含等待中的）
+        self.queued = 0
+        self.avg_run_seconds = DEFAULT_RUN_SECONDS
+        self.avg_calls_per_run = DEFAULT_CALLS_PER_RUN
+        self.completed = 0
+        self.rejected = 0
+
+    def _throughput(self) -> float:
+        """每秒可完成的运行数：并发数受运行时长约束，同时受后端 RPM 约束"""
+        throughput = self.limit / self.avg_run_seconds
+        if self.rpm:
+            throughput = min(throughput, self.rpm / 60 / self.avg_calls_per_run)
+        return throughput
+
+    @property
+    def waiting(self) -> int:
+        """拿不到名额、需要排队的请求数量"""
+        return max(self.running + self.queued - self.limit, 0)
+
+    def estimate_wait(self) -> float:
+        """新请求的预计排队时间(秒)：前面排队的请求加上自己，需要先完成这么多次运行"""
+        if self.running + self.queued < self.limit:
+            return 0.0
+        return (self.waiting + 1) / self._throughput()
+
+    def admit(self, timeout: Optional[float]):
+        """
+        准入检查（非阻塞）
+        timeout 为客户端愿意等待的时间，None 表示不拒绝（如后台任务）
+        """
+        if timeout is not None:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(f"Model {self.model_id} is busy: queue full", 1 / self._throughput())
+            wait = self.estimate_wait()
+            if wait > timeout:
+                self.rejected += 1
+                raise AdmissionRejected(
+                    f"Model {self.model_id} is busy: estimated queue time {wait:.0f}s exceeds deadline {timeout:.0f}s",
+                    wait - timeout,
+                )
+        self.queued += 1
+
+    def _observe(self, seconds: float, calls: int):
+        # 第一次运行直接替换初始估计
+        alpha = EWMA_ALPHA if self.completed else 1.0
+        self.completed += 1
+        self.avg_run_seconds += alpha * (seconds - self.avg_run_seconds)
+        if calls:
+            self.avg_calls_per_run += alpha * (calls - self.avg_calls_per_run)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "estimated_wait": round(self.estimate_wait(), 1),
+        }
+
+
+def _utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _seconds_until_next_utc_day() -> float:
+    return 86400 - time.time() % 86400
+
+
+class KeyGate(SlotGate):
+    """
+    单个 API 密钥的配额：同时运行的引擎数量和每日 token 预算，同时累计该密钥的用量
+    并发已满时有期限的请求直接拒绝，没有期限的请求（后台任务、批处理）排队等待名额
+    """
+
+    def __init__(self, api_key: ApiKeyConfig):
+        super().__init__()
+        self.api_key = api_key
+        # 已准入、尚未结束的运行（含排队中的），running 为其中已占用并发名额的
+        self.active = 0
+        self.runs = 0
+        self.rejected = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.day = _utc_day()
+        self.day_tokens = 0
+
+    @property
+    def limit(self) -> Optional[int]:
+        # 配置重新加载后使用最新的限额
+        return self.api_key.max_concurrent
+
+    def _roll_day(self):
+        day = _utc_day()
+        if day != self.day:
+            self.day = day
+            self.day_tokens = 0
+
+    def admit(self, timeout: Optional[float]):
+        """
+        准入检查（非阻塞）：预算用完时总是拒绝，并发已满时只拒绝有期限的请求，
+        没有期限的请求在 AdmissionTicket 进入时排队等待名额
+        预算在运行结束时才扣除，进行中的运行可能略微超出
+        """
+        self._roll_day()
+        budget = self.api_key.daily_tokens
+        if budget is not None and self.day_tokens >= budget:
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"API key {self.api_key.name} has used its daily token budget ({budget})",
+                _seconds_until_next_utc_day(),
+            )
+        limit = self.api_key.max_concurrent
+        if timeout is not None and limit and self.active >= limit:
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"API key {self.api_key.name} has reached its concurrency limit ({limit})",
+                KEY_BUSY_RETRY_AFTER,
+            )
+        self.active += 1
+        self.runs += 1
+
+    def _finish(self, usage: Optional[UsageTracker]):
+        self.active -= 1
+        if usage is None:
+            return
+        self._roll_day()
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.day_tokens += usage.total_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        self._roll_day()
+        return {
+            "runs": self.runs,
+            "running": self.running,
+            "waiting": self.active - self.running,
+            "rejected": self.rejected,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "daily_tokens": self.day_tokens,
+            "daily_token_budget": self.api_key.daily_tokens,
+        }
+
+
+class AdmissionTicket:
+    """
+    准入凭证：async with 期间占用一个运行名额，结束时记录运行时长和调用次数，
+    并把本次运行的 token 用量计入调用方密钥
+    """
+
+    def __init__(
+        self,
+        gate: Optional[ModelGate],
+        usage: Optional[UsageTracker],
+        key_gate: Optional[KeyGate] = None,
+        on_finish: Optional[Callable[[], None]] = None,
+    ):
+        self._gate = gate
+        self._usage = usage
+        self._key_gate = key_gate
+        # 运行结束（或未能开始）时调用一次，用于交互请求计数
+        self._on_finish = on_finish
+        self._started: Optional[float] = None
+        # 已进入 async with（名额由 __aenter__/__aexit__ 归还）或已归还
+        self._settled = False
+
+    def _finished(self):
+        if self._on_finish:
+            self._on_finish()
+            self._on_finish = None
+
+    def discard(self):
+        """准入后未能开始运行（如创建引擎失败、运行在开始前被取消）时归还排队位置；已进入或已归还时不做任何事"""
+        if self._settled:
+            return
+        self._settled = True
+        if self._gate:
+            self._gate.queued -= 1
+        if self._key_gate:
+            self._key_gate._finish(None)
+        self._finished()
+
+    async def __aenter__(self):
+        self._settled = True
+        key_acquired = False
+        try:
+            # 先等密钥的名额再等模型的名额，排队中的后台任务不占用模型名额
+            if self._key_gate:
+                await self._key_gate._acquire()
+                key_acquired = True
+            if self._gate:
+                await self._gate._acquire()
+        except BaseException:
+            if key_acquired:
+                self._key_gate._release()
+            if self._key_gate:
+                self._key_gate._finish(None)
+            self._finished()
+            raise
+        finally:
+            if self._gate:
+                self._gate.queued -= 1
+        self._started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._key_gate:
+            self._key_gate._release()
+            # 失败的运行同样消耗了 token
+            self._key_gate._finish(self._usage)
+        if self._gate:
+            self._gate._release()
+            if exc_type is None:
+                calls = self._usage.calls if self._usage else 0
+                self._gate._observe(time.monotonic() - self._started, calls)
+        self._finished()
+
+
+class AdmissionController:
+    """
+    按模型管理并发闸门，按调用方密钥管理配额；
+    未设置 max_concurrent 的模型不做模型级准入控制，未启用鉴权时不做密钥级控制。
+    同时统计各模型进行中的交互请求（有客户端期限的请求），供批处理判断是否让路
+    """
+
+    def __init__(self):
+        self._gates: Dict[str, ModelGate] = {}
+        self._key_gates: Dict[str, KeyGate] = {}
+        self._interactive: Dict[str, int] = {}
+
+    def _key_gate(self, api_key: ApiKeyConfig) -> KeyGate:
+        key_gate = self._key_gates.get(api_key.name)
+        if key_gate is None:
+            key_gate = self._key_gates[api_key.name] = KeyGate(api_key)
+        # 配置重新加载后使用最新的限额
+        key_gate.api_key = api_key
+        return key_gate
+
+    def admit(
+        self,
+        model_config: ModelConfig,
+        timeout: Optional[float],
+        usage: Optional[UsageTracker] = None,
+        caller: Optional[ApiKeyConfig] = None,
+    ) -> Optional[AdmissionTicket]:
+        gate = None
+        if model_config.max_concurrent:
+            gate = self._gates.get(model_config.model_id)
+            if gate is None:
+                gate = self._gates[model_config.model_id] = ModelGate(model_config)
+        key_gate = self._key_gate(caller) if caller else None
+        interactive = timeout is not None
+        if gate is None and key_gate is None and not interactive:
+            return None
+        if key_gate:
+            key_gate.admit(timeout)
+        if gate:
+            try:
+                gate.admit(timeout)
+            except AdmissionRejected:
+                if key_gate:
+                    key_gate._finish(None)
+                raise
+        on_finish = None
+        if interactive:
+            model_id = model_config.model_id
+            self._interactive[model_id] = self._interactive.get(model_id, 0) + 1
+            on_finish = lambda: self._finish_interactive(model_id)
+        return AdmissionTicket(gate, usage, key_gate, on_finish)
+
+    def _finish_interactive(self, model_id: str):
+        count = self._interactive.get(model_id, 0) - 1
+        if count > 0:
+            self._interactive[model_id] = count
+        else:
+            self._interactive.pop(model_id, None)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {model_id: gate.stats() for model_id, gate in self._gates.items()}
+
+    def waiting(self, model_id: str) -> int:
+        """该模型拿不到运行名额、正在排队的请求数量"""
+        gate = self._gates.get(model_id)
+        return gate.waiting if gate else 0
+
+    def interactive(self, model_id: str) -> int:
+        """该模型已准入、尚未结束的交互请求数量（不论是否设置 max_concurrent）"""
+        return self._interactive.get(model_id, 0)
+
+    def key_usage(self, api_key: Optional[ApiKeyConfig] = None) -> Dict[str, Dict[str, Any]]:
+        """各密钥的累计用量（服务启动以来），指定 api_key 时只返回该密钥"""
+        if api_key is not None:
+            return {api_key.name: self._key_gate(api_key).stats()}
+        return {name: key_gate.stats() for name, key_gate in self._key_gates.items()}
+
+
+# 全局准入控制器
+admission_controller = AdmissionController()
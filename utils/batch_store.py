@@ -0,0 +1,199 @@
+"""
+文件与批处理持久化存储
+基于本地 SQLite 保存上传文件的元数据和批处理状态，文件内容保存在磁盘上
+所有方法都是同步的，由调用方通过 asyncio.to_thread 放到线程中执行
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+
+# 批处理状态（与 OpenAI Batch API 一致）
+BATCH_VALIDATING = "validating"
+BATCH_FAILED = "failed"
+BATCH_IN_PROGRESS = "in_progress"
+BATCH_FINALIZING = "finalizing"
+BATCH_COMPLETED = "completed"
+BATCH_EXPIRED = "expired"
+BATCH_CANCELLING = "cancelling"
+BATCH_CANCELLED = "cancelled"
+
+# 服务重启后需要继续执行的状态
+BATCH_ACTIVE = (BATCH_VALIDATING, BATCH_IN_PROGRESS, BATCH_FINALIZING, BATCH_CANCELLING)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    owner TEXT,
+    created_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    input_file_id TEXT NOT NULL,
+    completion_window TEXT NOT NULL,
+    output_file_id TEXT,
+    error_file_id TEXT,
+    errors TEXT,
+    request_counts TEXT,
+    metadata TEXT,
+    owner TEXT,
+    created_at INTEGER NOT NULL,
+    in_progress_at INTEGER,
+    expires_at INTEGER,
+    finalizing_at INTEGER,
+    completed_at INTEGER,
+    failed_at INTEGER,
+    expired_at INTEGER,
+    cancelling_at INTEGER,
+    cancelled_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_batches_status ON batches (status);
+"""
+
+# 以 JSON 存储的列
+_JSON_COLUMNS = ("errors", "request_counts", "metadata")
+
+
+class BatchStore:
+    """SQLite 文件与批处理存储（单连接，线程锁串行化访问）"""
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        record = dict(row)
+        for column in _JSON_COLUMNS:
+            if record.get(column) is not None:
+                record[column] = json.loads(record[column])
+        return record
+
+    # ---------- 文件 ----------
+
+    def create_file(
+        self,
+        file_id: str,
+        filename: str,
+        purpose: str,
+        path: str,
+        size: int,
+        owner: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO files (id, filename, purpose, bytes, path, owner, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_id, filename, purpose, size, path, owner, int(time.time())),
+            )
+        return self.get_file(file_id)
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_files(self, owner: Optional[str] = None, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按创建时间倒序列出文件，owner 为 None 时列出全部"""
+        query, params = "SELECT * FROM files WHERE 1 = 1", []
+        if owner is not None:
+            query += " AND owner = ?"
+            params.append(owner)
+        if purpose is not None:
+            query += " AND purpose = ?"
+            params.append(purpose)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY created_at DESC", params).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_file(self, file_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+
+    # ---------- 批处理 ----------
+
+    def create_batch(
+        self,
+        batch_id: str,
+        endpoint: str,
+        input_file_id: str,
+        completion_window: str,
+        expires_at: int,
+        metadata: Optional[Dict[str, Any]] = None,
+        owner: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """新建校验中的批处理"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO batches (id, status, endpoint, input_file_id, completion_window, request_counts, "
+                "metadata, owner, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    batch_id, BATCH_VALIDATING, endpoint, input_file_id, completion_window,
+                    json.dumps({"total": 0, "completed": 0, "failed": 0}),
+                    json.dumps(metadata, ensure_ascii=False) if metadata is not None else None,
+                    owner, int(time.time()), expires_at,
+                ),
+            )
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def update_batch(self, batch_id: str, **fields):
+        """更新批处理字段（JSON 列自动序列化）"""
+        if not fields:
+            return
+        for column in _JSON_COLUMNS:
+            if fields.get(column) is not None:
+                fields[column] = json.dumps(fields[column], ensure_ascii=False)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE batches SET {assignments} WHERE id = ?", (*fields.values(), batch_id))
+
+    def list_batches(
+        self,
+        owner: Optional[str] = None,
+        after: Optional[str] = None,
+        limit: int = 20,
+    ) -> List[Dict[str, Any]]:
+        """按创建时间倒序分页列出批处理，after 为上一页最后一个 id"""
+        query, params = "SELECT * FROM batches WHERE 1 = 1", []
+        if owner is not None:
+            query += " AND owner = ?"
+            params.append(owner)
+        if after is not None:
+            query += " AND (created_at, id) < (SELECT created_at, id FROM batches WHERE id = ?)"
+            params.append(after)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def active_ids(self) -> List[str]:
+        """上次退出时尚未结束的批处理 id"""
+        placeholders = ", ".join("?" for _ in BATCH_ACTIVE)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id FROM batches WHERE status IN ({placeholders}) ORDER BY created_at", BATCH_ACTIVE
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,107 @@
+"""
+提供商熔断器
+每个提供商一个熔断器（由连接池持有），按最近调用的失败率和慢调用比例判断提供商是否故障：
+- closed：正常放行，最近 CIRCUIT_WINDOW 次调用中失败（5xx、超时、连接错误、慢调用）比例达到阈值时打开；
+  流式调用在流读完后按整个流的结果计（中途断开算失败）
+- open：直接拒绝调用（立即失败或改用备用提供商），circuit_open_seconds 秒后进入半开
+- half_open：放行一个探测调用，成功则关闭，失败则重新打开；探测调用被取消时超时后再放行下一个
+"""
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 计算失败率的最近调用数
+CIRCUIT_WINDOW = 20
+
+
+class CircuitOpenError(Exception):
+    """提供商熔断中，调用被直接拒绝"""
+
+    def __init__(self, provider_id: str, retry_after: float):
+        super().__init__(f"Provider {provider_id} circuit is open, retry after {retry_after:.1f}s")
+        self.provider_id = provider_id
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """单个提供商的熔断器"""
+
+    def __init__(self, provider_id: str):
+        self.provider_id = provider_id
+        self.state = CLOSED
+        self._outcomes: deque = deque(maxlen=CIRCUIT_WINDOW)  # True 表示失败
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self.opened = 0
+        self.rejected = 0
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"Provider {self.provider_id} circuit {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self._probe_started = None
+            self.opened += 1
+        elif state == CLOSED:
+            self._outcomes.clear()
+            self._probe_started = None
+
+    def retry_after(self) -> float:
+        """距离下一次允许探测的秒数"""
+        if self.state == OPEN:
+            return max(self._opened_at + config.circuit_open_seconds - time.monotonic(), 0.0)
+        if self.state == HALF_OPEN and self._probe_started is not None:
+            return max(self._probe_started + config.circuit_open_seconds - time.monotonic(), 0.0)
+        return 0.0
+
+    @property
+    def is_open(self) -> bool:
+        """当前调用是否会被拒绝（不改变状态）"""
+        return config.circuit_breaker and self.state != CLOSED and self.retry_after() > 0
+
+    def allow(self) -> bool:
+        """是否放行一次调用；半开时只放行一个探测调用"""
+        if not config.circuit_breaker or self.state == CLOSED:
+            return True
+        if self.retry_after() > 0:
+            self.rejected += 1
+            return False
+        # 打开时间已到，或上一个探测调用迟迟没有结果：放行一个探测
+        self._transition(HALF_OPEN)
+        self._probe_started = time.monotonic()
+        return True
+
+    def record(self, failed: bool, latency: Optional[float] = None):
+        """记录一次调用结果，耗时超过 circuit_slow_call 秒的调用按失败计"""
+        if latency is not None and config.circuit_slow_call and latency > config.circuit_slow_call:
+            failed = True
+        if self.state == HALF_OPEN:
+            self._transition(OPEN if failed else CLOSED)
+            return
+        if self.state == OPEN:
+            return
+        self._outcomes.append(failed)
+        if len(self._outcomes) >= config.circuit_min_calls:
+            failure_rate = sum(self._outcomes) / len(self._outcomes)
+            if failure_rate >= config.circuit_failure_rate:
+                self._transition(OPEN)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failure_rate": round(sum(self._outcomes) / len(self._outcomes), 3) if self._outcomes else 0.0,
+            "retry_after": round(self.retry_after(), 1),
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
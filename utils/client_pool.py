@@ -0,0 +1,94 @@
+"""
+后端提供商客户端池
+进程内每个提供商共用一个 AsyncOpenAI 及其 httpx 连接池（启动时创建，退出时关闭），
+避免每个请求重新建立 TCP/TLS 连接；请求级的统计、限流和用量仍由各请求自己的 OpenAIClient 负责。
+每个 HTTP 响应的状态码和限流响应头会回报给当前调用的限流器，用于自适应限速；
+每个提供商还有一个熔断器，提供商故障时调用立即失败或改用备用提供商
+"""
+import logging
+from typing import Any, Dict
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from config import config, ProviderConfig
+from utils.rate_limiter import current_limiter
+from utils.circuit_breaker import CircuitBreaker
+
+try:
+    import h2  # noqa: F401  可选依赖，存在时启用 HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+async def _report_rate_limit(response: httpx.Response):
+    """httpx 响应钩子：把 429 和 x-ratelimit-* 响应头交给当前调用的后端限流器"""
+    limiter = current_limiter.get()
+    if limiter is not None:
+        limiter.feedback(response.status_code, response.headers)
+
+
+class ProviderClientPool:
+    """按提供商 id 共享的 AsyncOpenAI 客户端"""
+
+    def __init__(self):
+        self._clients: Dict[str, AsyncOpenAI] = {}
+        # 熔断器在服务运行期间保留（关闭连接池时不清除）
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def start(self):
+        """为所有已配置的提供商创建客户端"""
+        for provider in config.list_providers():
+            self._create(provider)
+        logger.info(
+            f"Created pooled clients for {len(self._clients)} providers "
+            f"(HTTP/2 {'enabled' if self._http2 else 'disabled'})"
+        )
+
+    @property
+    def _http2(self) -> bool:
+        return config.http2 and HTTP2_AVAILABLE
+
+    def _create(self, provider: ProviderConfig) -> AsyncOpenAI:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=config.http_max_connections,
+                max_keepalive_connections=config.http_max_keepalive,
+                keepalive_expiry=config.http_keepalive_expiry,
+            ),
+            http2=self._http2,
+            event_hooks={"response": [_report_rate_limit]},
+        )
+        # 重试由 OpenAIClient 负责，每次尝试都经过限流器
+        client = AsyncOpenAI(base_url=provider.base_url, api_key=provider.key, http_client=http_client, max_retries=0)
+        self._clients[provider.provider_id] = client
+        return client
+
+    def get(self, provider: ProviderConfig) -> AsyncOpenAI:
+        """获取提供商的共享客户端（未在启动时创建的提供商按需创建）"""
+        return self._clients.get(provider.provider_id) or self._create(provider)
+
+    def breaker(self, provider_id: str) -> CircuitBreaker:
+        """提供商的熔断器"""
+        breaker = self._breakers.get(provider_id)
+        if breaker is None:
+            breaker = self._breakers[provider_id] = CircuitBreaker(provider_id)
+        return breaker
+
+    def circuit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各提供商的熔断状态"""
+        return {provider_id: breaker.stats() for provider_id, breaker in self._breakers.items()}
+
+    async def close(self):
+        """关闭所有连接池"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.close()
+
+
+# 全局客户端池
+provider_clients = ProviderClientPool()
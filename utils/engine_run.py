@@ -0,0 +1,405 @@
+"""
+引擎运行管理
+一次流式请求对应一个 EngineRun：引擎在后台运行，输出块按序号存入有界回放缓冲区，
+客户端断线后可凭 Last-Event-ID 重新连接并补发错过的块。
+可控制的运行（WebSocket）还支持中途采纳当前草稿、设置截止时间
+"""
+import asyncio
+import logging
+from collections import deque
+from typing import Optional, Callable, Awaitable, AsyncIterator, Dict, Any, List, Tuple
+
+from config import config, ApiKeyConfig
+from models import ProgressEvent
+from utils.event_bus import ProgressEventBus
+from utils.sse_writer import SSEWriter, sse_frame
+
+logger = logging.getLogger(__name__)
+
+# 主动检测客户端断开的轮询间隔(秒)
+DISCONNECT_POLL_INTERVAL = 1.0
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[str, int]]:
+    """解析 SSE 事件 id（格式为 "<run_id>:<seq>"），格式不对时返回 None"""
+    if not event_id or ":" not in event_id:
+        return None
+    run_id, _, seq = event_id.strip().rpartition(":")
+    if not run_id or not seq.isdigit():
+        return None
+    return run_id, int(seq)
+
+
+async def cancel_task(task: Optional[asyncio.Task]):
+    """取消任务并等待其结束（忽略取消异常）"""
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass  # 预期的取消异常
+
+
+class EngineRun:
+    """一次引擎运行：后台执行并缓存已输出的块，支持断线重连"""
+
+    def __init__(
+        self,
+        engine,
+        writer: SSEWriter,
+        thinking_generator=None,
+        replay_size: Optional[int] = None,
+        grace_period: Optional[float] = None,
+        usage: Optional[Callable[[], Dict[str, Any]]] = None,
+        admission=None,
+        controllable: bool = False,
+        owner: Optional[str] = None,
+    ):
+        self.run_id = writer.request_id
+        # 发起运行的 API 密钥名称，只有该密钥（及管理员密钥）可以重新连接
+        self.owner = owner
+        self.engine = engine
+        self.writer = writer
+        self.thinking_generator = thinking_generator
+        self.grace_period = config.stream_resume_grace if grace_period is None else grace_period
+        # 设置时在结束块之后、[DONE] 之前发送 usage 块
+        self.usage = usage
+        # 准入凭证：引擎在获得运行名额后才开始
+        self.admission = admission
+        # 中途控制：set 后以引擎当前草稿结束运行
+        self._accept: Optional[asyncio.Event] = asyncio.Event() if controllable else None
+        self._deadline_handle: Optional[asyncio.TimerHandle] = None
+        # 引擎已开始推送最终正文（此后不再提前结束，避免正文被截断）
+        self._content_started = False
+
+        # 回放缓冲区：(序号, JSON 载荷)，超过上限时丢弃最旧的块
+        self._frames: deque = deque(maxlen=replay_size or config.stream_replay_size)
+        self._seq = 0
+        # 每次追加新块时 set 并替换，唤醒所有订阅者
+        self._changed = asyncio.Event()
+
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._grace_handle: Optional[asyncio.TimerHandle] = None
+        self._engine_task: Optional[asyncio.Task] = None
+        self._pump_task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self._pump_task is not None and self._pump_task.done()
+
+    def start(self) -> "EngineRun":
+        """在后台启动引擎"""
+        bus = ProgressEventBus(
+            accept=self.thinking_generator.filter_event if self.thinking_generator else None
+        )
+        engine = self.engine
+
+        # 未启用 summary_think 时不挂回调，事件根本不会入队
+        if self.thinking_generator:
+            engine.on_progress = bus.publish
+
+            # UltraThink 特殊处理
+            if hasattr(engine, 'on_agent_update'):
+                def on_agent_update(agent_id: str, update: Dict[str, Any]):
+                    """捕获 Agent 更新"""
+                    bus.publish(ProgressEvent(
+                        type="agent-update",
+                        data={"agentId": agent_id, **update}
+                    ))
+                engine.on_agent_update = on_agent_update
+
+        # 最终答案的正文直接从最后一次 LLM 调用流式推送
+        if self._accept is None:
+            engine.on_content = bus.publish_content
+        else:
+            def on_content(text: str):
+                self._content_started = True
+                bus.publish_content(text)
+            engine.on_content = on_content
+
+        # 草稿模式：初始、改进、修正阶段的 token 实时输出到 reasoning_content
+        if self.thinking_generator and self.thinking_generator.stream_drafts and hasattr(engine, 'on_draft'):
+            engine.on_draft = bus.publish_draft
+
+        # 在后台运行引擎，结束时关闭总线唤醒输出端
+        self._engine_task = asyncio.create_task(self._run_engine())
+        self._engine_task.add_done_callback(self._engine_done)
+        self._engine_task.add_done_callback(lambda _: bus.close())
+        self._pump_task = asyncio.create_task(self._pump(bus))
+        return self
+
+    async def _run_engine(self):
+        run = self.engine.run if self._accept is None else self._run_controllable
+        if self.admission is None:
+            return await run()
+        # 排队期间订阅者照常收到心跳
+        async with self.admission:
+            return await run()
+
+    def _engine_done(self, _):
+        # 引擎任务在第一次执行前就被取消（如客户端立即断开）时没有进入 async with，归还准入名额
+        if self.admission is not None:
+            self.admission.discard()
+
+    async def _run_controllable(self):
+        """运行引擎，同时等待采纳草稿的请求；采纳时取消引擎并返回当前草稿"""
+        engine_task = asyncio.create_task(self.engine.run())
+        accept_task = asyncio.create_task(self._accept.wait())
+        try:
+            await asyncio.wait({engine_task, accept_task}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            engine_task.cancel()
+            raise
+        finally:
+            accept_task.cancel()
+        # 引擎已结束或已开始推送正文时照常返回完整结果
+        if engine_task.done() or self._content_started:
+            return await engine_task
+        await cancel_task(engine_task)
+        logger.info(f"Run {self.run_id} stopped early with the current draft")
+        return self.engine.draft_result()
+
+    def accept_draft(self) -> Optional[str]:
+        """请求立即以当前草稿结束运行，返回不能采纳的原因（None 表示已采纳）"""
+        if self._accept is None:
+            return "run does not accept control messages"
+        if self.done:
+            return "run has already finished"
+        if self._content_started:
+            return "final answer is already streaming"
+        if not getattr(self.engine, "current_solution", None):
+            return "no draft available yet"
+        self._accept.set()
+        return None
+
+    def set_deadline(self, timeout: float):
+        """timeout 秒后采纳当前草稿；届时还没有草稿则取消运行"""
+        if self._deadline_handle:
+            self._deadline_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._deadline_handle = loop.call_later(max(timeout, 0), self._deadline_reached)
+
+    def _deadline_reached(self):
+        self._deadline_handle = None
+        if self.done or self._content_started:
+            return
+        if self.accept_draft() is not None:
+            logger.info(f"Run {self.run_id} reached its deadline without a draft, cancelling")
+            self.cancel()
+
+    def _append(self, payloads: List[bytes]):
+        for payload in payloads:
+            self._seq += 1
+            self._frames.append((self._seq, payload))
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _pump(self, bus: ProgressEventBus):
+        """把引擎事件转换为输出块写入回放缓冲区"""
+        writer = self.writer
+        content_streamed = False
+        flush_interval = config.stream_flush_interval
+        try:
+            # 直接等待事件推送，无需轮询；窗口内到达的增量合并为一次写入
+            while True:
+                batch = await bus.get_batch(flush_interval)
+                if batch is None:
+                    break
+                deltas = []
+                for event in batch:
+                    if event.type == "content":
+                        content_streamed = True
+                        deltas.append(("content", event.data["text"]))
+                        continue
+                    # 正文开始后不再插入推理内容
+                    if content_streamed:
+                        continue
+                    thinking_text = self.thinking_generator.process_event(event)
+                    if thinking_text:
+                        # 使用 reasoning_content 字段输出推理过程
+                        deltas.append(("reasoning_content", thinking_text))
+                if deltas:
+                    self._append(writer.payloads(deltas))
+
+            # 获取最终结果
+            result = await self._engine_task
+
+            # 引擎没有推送正文时（如初始化失败），一次性发送最终答案
+            final = []
+            if not content_streamed:
+                final_text = result.summary or result.final_solution
+                if final_text:
+                    final.append(writer.payload({"content": final_text}))
+            final.append(writer.payload({}, "stop"))
+            if self.usage:
+                final.append(writer.usage_payload(self.usage()))
+            final.append(SSEWriter.DONE_PAYLOAD)
+            self.result = result
+            self._append(final)
+        except (asyncio.CancelledError, Exception) as e:
+            if isinstance(e, asyncio.CancelledError):
+                logger.info(f"Engine run {self.run_id} cancelled")
+            else:
+                logger.error(f"Error during streaming for request {self.run_id}: {e}")
+            self.error = e
+            self._notify()
+        finally:
+            await cancel_task(self._engine_task)
+            if self._grace_handle:
+                self._grace_handle.cancel()
+            if self._deadline_handle:
+                self._deadline_handle.cancel()
+
+    def on_finish(self, callback: Callable[["EngineRun"], None]):
+        """注册运行结束（成功、失败或取消）后的回调，参数为本运行；须在 start 之后调用"""
+        self._pump_task.add_done_callback(lambda _: callback(self))
+
+    async def wait(self):
+        """等待运行结束（成功、失败或取消，不抛出引擎异常）；等待方被取消不影响运行"""
+        await asyncio.shield(self._pump_task)
+
+    def cancel(self):
+        """取消引擎运行"""
+        if self._engine_task and not self._engine_task.done():
+            self._engine_task.cancel()
+
+    def _attach(self):
+        self.subscribers += 1
+        if self._grace_handle:
+            self._grace_handle.cancel()
+            self._grace_handle = None
+
+    def _detach(self):
+        self.subscribers -= 1
+        if self.subscribers > 0 or self.done:
+            return
+        # 最后一个订阅者离开：宽限期内没有重连才取消引擎
+        if self.grace_period <= 0:
+            self._cancel_abandoned()
+        else:
+            loop = asyncio.get_running_loop()
+            self._grace_handle = loop.call_later(self.grace_period, self._cancel_abandoned)
+
+    def _cancel_abandoned(self):
+        self._grace_handle = None
+        if self.subscribers == 0 and not self.done:
+            logger.info(f"No client reconnected to run {self.run_id}, cancelling engine task")
+            self.cancel()
+
+    def _frames_after(self, seq: int) -> List[Tuple[int, bytes]]:
+        if not self._frames or self._frames[-1][0] <= seq:
+            return []
+        first = self._frames[0][0]
+        if seq + 1 < first:
+            logger.warning(f"Run {self.run_id}: chunks {seq + 1}..{first - 1} already evicted from replay buffer")
+        start = max(seq + 1 - first, 0)
+        return [self._frames[i] for i in range(start, len(self._frames))]
+
+    async def frames(
+        self,
+        after_seq: int = 0,
+        idle_timeout: Optional[float] = None,
+    ) -> AsyncIterator[List[Tuple[int, bytes]]]:
+        """
+        订阅原始输出块 (序号, 载荷)：先补发序号大于 after_seq 的块，再实时输出新块，直到运行结束
+        idle_timeout 秒内没有新块时输出空列表，调用方可借此发送心跳或检查连接
+        订阅期间计入订阅者；最后一个订阅者离开后引擎在宽限期内继续运行
+        """
+        self._attach()
+        last_seq = after_seq
+        try:
+            while True:
+                frames = self._frames_after(last_seq)
+                if frames:
+                    last_seq = frames[-1][0]
+                    yield frames
+                    continue
+                if self.done:
+                    if self.error is not None and not isinstance(self.error, asyncio.CancelledError):
+                        raise self.error
+                    return
+                try:
+                    await asyncio.wait_for(self._changed.wait(), idle_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                # 超时或被唤醒（如连接已断开）但没有新块
+                if not self._frames_after(last_seq) and not self.done:
+                    yield []
+        finally:
+            self._detach()
+
+    async def subscribe(
+        self,
+        after_seq: int = 0,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        订阅 SSE 输出：先补发序号大于 after_seq 的块，再实时推送新块
+        空闲时发送心跳；客户端断开后引擎在宽限期内继续运行
+        """
+        state = {"closed": False}
+
+        async def watch_disconnect():
+            # 主动检测客户端断开，不必等到下一次写入
+            while not state["closed"] and not self.done:
+                await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+                if await is_disconnected():
+                    logger.info(f"Client disconnected from run {self.run_id}")
+                    state["closed"] = True
+                    self._notify()
+                    return
+
+        watcher_task = asyncio.create_task(watch_disconnect()) if is_disconnected else None
+        frames_iter = self.frames(after_seq, config.stream_heartbeat_interval)
+        try:
+            async for frames in frames_iter:
+                if state["closed"]:
+                    break
+                if not frames:
+                    # 长时间没有输出，发送心跳保活
+                    yield SSEWriter.HEARTBEAT
+                    continue
+                yield b"".join(
+                    sse_frame(payload, f"{self.run_id}:{seq}") for seq, payload in frames
+                )
+        finally:
+            state["closed"] = True
+            if watcher_task:
+                watcher_task.cancel()
+            # 立即结束订阅（计数减一），不等垃圾回收
+            await frames_iter.aclose()
+
+
+class RunRegistry:
+    """进行中（及刚结束）的流式运行，供断线重连查找"""
+
+    def __init__(self):
+        self._runs: Dict[str, EngineRun] = {}
+
+    def add(self, run: EngineRun):
+        self._runs[run.run_id] = run
+        # 运行结束后保留一个宽限期，让刚断线的客户端仍能补发结尾
+        run.on_finish(self._schedule_removal)
+
+    def _schedule_removal(self, run: EngineRun):
+        loop = asyncio.get_running_loop()
+        loop.call_later(max(run.grace_period, 0), self._runs.pop, run.run_id, None)
+
+    def get(self, run_id: str, caller: Optional[ApiKeyConfig] = None) -> Optional[EngineRun]:
+        """查找运行；指定 caller 时只返回该密钥发起的运行（管理员密钥可访问全部）"""
+        run = self._runs.get(run_id)
+        if run is None:
+            return None
+        if caller and not caller.admin and run.owner != caller.name:
+            return None
+        return run
+
+
+# 全局运行注册表
+run_registry = RunRegistry()
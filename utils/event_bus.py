@@ -0,0 +1,143 @@
+"""
+进度事件总线
+每个请求一个有界 asyncio.Queue，引擎回调推送事件，SSE 输出端直接 await
+"""
+import asyncio
+from collections import deque
+from typing import Optional, Callable, List
+
+from models import ProgressEvent
+
+
+# 关闭标记，消费端收到后结束迭代
+_CLOSED = object()
+
+
+class ProgressEventBus:
+    """
+    单请求的推送式进度事件总线
+    队列最多 maxsize 个事件，满了以后：
+    - 进度事件直接丢弃（不阻塞引擎）
+    - 正文和草稿增量不能丢，暂存到溢出区并与相邻的同类增量合并，
+      消费端取走事件腾出位置后按顺序补回队列；事件个数始终有界，文本总量受单次 LLM 输出约束
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        accept: Optional[Callable[[ProgressEvent], Optional[ProgressEvent]]] = None,
+    ):
+        """
+        Args:
+            maxsize: 队列容量
+            accept: 源头过滤函数，返回 None 表示丢弃，可返回裁剪后的事件
+        """
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+        # 队列满时暂存的正文/草稿增量和关闭标记，总在队列中所有事件之后
+        self._overflow: deque = deque()
+        self._accept = accept
+        self._closed = False
+        self.dropped = 0
+        self.coalesced = 0
+
+    def _full(self) -> bool:
+        # 溢出区非空时新事件也必须排在溢出区之后，保持顺序
+        return bool(self._overflow) or self._queue.full()
+
+    def _refill(self):
+        """消费端取走事件后，把溢出区的事件按顺序补回队列"""
+        while self._overflow and not self._queue.full():
+            self._queue.put_nowait(self._overflow.popleft())
+
+    def _put_text(self, event_type: str, text: str):
+        if not self._full():
+            self._queue.put_nowait(ProgressEvent(type=event_type, data={"text": text}))
+            return
+        tail = self._overflow[-1] if self._overflow else None
+        if isinstance(tail, ProgressEvent) and tail.type == event_type:
+            tail.data["text"] += text
+            self.coalesced += 1
+        else:
+            self._overflow.append(ProgressEvent(type=event_type, data={"text": text}))
+
+    def publish(self, event: ProgressEvent):
+        """发布进度事件（同步调用，供引擎回调使用），队列已满时丢弃"""
+        if self._closed:
+            return
+        if self._accept:
+            event = self._accept(event)
+            if event is None:
+                return
+        if self._full():
+            self.dropped += 1
+            return
+        self._queue.put_nowait(event)
+
+    def publish_content(self, text: str):
+        """发布最终答案的正文增量（不过滤、不丢弃，队列满时合并暂存）"""
+        if self._closed or not text:
+            return
+        self._put_text("content", text)
+
+    def publish_draft(self, text: str):
+        """发布中间草稿的 token 增量（同正文一样不丢弃）"""
+        if self._closed or not text:
+            return
+        self._put_text("draft", text)
+
+    def close(self):
+        """关闭总线，已入队的事件仍会被消费完"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._full():
+            self._overflow.append(_CLOSED)
+        else:
+            self._queue.put_nowait(_CLOSED)
+
+    def _take(self, item):
+        """取走一个事件后的处理：补回溢出区，关闭标记放回队列（重复读取仍然返回关闭）"""
+        if item is _CLOSED:
+            self._queue.put_nowait(_CLOSED)
+            return None
+        self._refill()
+        return item
+
+    async def get(self) -> Optional[ProgressEvent]:
+        """等待下一个事件，总线关闭后返回 None"""
+        return self._take(await self._queue.get())
+
+    async def get_batch(
+        self,
+        window: float = 0.0,
+        timeout: Optional[float] = None,
+    ) -> Optional[List[ProgressEvent]]:
+        """
+        等待下一批事件：拿到第一个事件后再等待 window 秒，
+        把期间到达的事件一并取出，便于合并成一次写入。
+        timeout 秒内没有事件时返回空列表（用于发送心跳），总线关闭后返回 None
+        """
+        try:
+            first = self._take(await asyncio.wait_for(self._queue.get(), timeout))
+        except asyncio.TimeoutError:
+            return []
+        if first is None:
+            return None
+        if window > 0:
+            await asyncio.sleep(window)
+        batch = [first]
+        while not self._queue.empty():
+            item = self._take(self._queue.get_nowait())
+            if item is None:
+                break
+            batch.append(item)
+        return batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ProgressEvent:
+        event = await self.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
@@ -0,0 +1,111 @@
+"""
+Idempotency-Key 支持
+记录每个幂等键对应的请求体哈希和运行（进行中的运行、或已完成的结果），
+客户端超时重试时直接加入原运行或返回已保存的结果，不会重新运行引擎。
+键在第一次 await 之前同步预留，并发的相同请求等待预留方登记运行，不会各自启动一次
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from config import config
+
+# 最多保留的键数量，超出时淘汰最早的键
+MAX_ENTRIES = 10000
+
+
+@dataclass
+class IdempotencyEntry:
+    """一个幂等键的记录"""
+    body_hash: str
+    expires_at: float
+    # 流式：进行中的 EngineRun，结束后替换为引擎结果
+    run: Any = None
+    result: Any = None
+    # 非流式：运行任务（结束后保留其结果）或已构建好的响应
+    task: Any = None
+    response: Any = None
+    # 预留后登记运行（或放弃预留）时 set，并发的重试在此之前等待
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class IdempotencyStore:
+    """内存中的幂等键表，键在 ttl 秒后过期；失败的运行不保留，允许重试"""
+
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = config.idempotency_ttl if ttl is None else ttl
+        # 按插入顺序排列，有效期相同，过期的总在最前面
+        self._entries: Dict[str, IdempotencyEntry] = {}
+
+    def _evict_expired(self):
+        now = time.time()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            del self._entries[key]
+
+    def get(self, key: str) -> Optional[IdempotencyEntry]:
+        self._evict_expired()
+        return self._entries.get(key)
+
+    def _add(self, key: str, body_hash: str) -> IdempotencyEntry:
+        self._evict_expired()
+        entry = IdempotencyEntry(body_hash=body_hash, expires_at=time.time() + self.ttl)
+        # 重新登记时移到末尾，保持按过期时间排序
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > MAX_ENTRIES:
+            del self._entries[next(iter(self._entries))]
+        return entry
+
+    def discard(self, key: str, entry: IdempotencyEntry):
+        """删除键（只删除同一条记录，避免误删后来者）"""
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+
+    def reserve(self, key: str, body_hash: str) -> IdempotencyEntry:
+        """预留键（同步调用，须在处理请求的第一次 await 之前），之后用 add_* 登记运行或 release 放弃"""
+        return self._add(key, body_hash)
+
+    def release(self, key: str, entry: IdempotencyEntry):
+        """预留后未能登记运行（如准入被拒绝）时删除键，唤醒等待的重试"""
+        if not entry.ready.is_set():
+            self.discard(key, entry)
+            entry.ready.set()
+
+    def add_run(self, key: str, entry: IdempotencyEntry, run):
+        """登记流式运行：成功结束后只保留结果（释放回放缓冲区），失败则删除"""
+        entry.run = run
+        entry.ready.set()
+
+        def finished(run):
+            if run.result is not None and run.error is None:
+                entry.result = run.result
+                entry.run = None
+            else:
+                self.discard(key, entry)
+        run.on_finish(finished)
+
+    def add_task(self, key: str, entry: IdempotencyEntry, task):
+        """登记非流式运行任务，失败或取消则删除"""
+        entry.task = task
+        entry.ready.set()
+
+        def finished(_):
+            if task.cancelled() or task.exception() is not None:
+                self.discard(key, entry)
+        task.add_done_callback(finished)
+
+    def add_response(self, key: str, entry: IdempotencyEntry, response):
+        """登记已完成的非流式响应（如缓存命中）"""
+        entry.response = response
+        entry.ready.set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# 全局幂等键表
+idempotency_store = IdempotencyStore()
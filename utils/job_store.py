@@ -0,0 +1,117 @@
+"""
+后台任务持久化存储
+基于本地 SQLite，排队中与已完成的任务在服务重启后仍然保留
+所有方法都是同步的，由调用方通过 asyncio.to_thread 放到线程中执行
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    model TEXT NOT NULL,
+    request TEXT NOT NULL,
+    webhook_url TEXT,
+    owner TEXT,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+
+# 以 JSON 存储的列
+_JSON_COLUMNS = ("request", "progress", "result")
+
+
+class JobStore:
+    """SQLite 任务存储（单连接，线程锁串行化访问）"""
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            # 旧版本创建的数据库没有 owner 列
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        for column in _JSON_COLUMNS:
+            if job[column] is not None:
+                job[column] = json.loads(job[column])
+        return job
+
+    def create(
+        self,
+        job_id: str,
+        model: str,
+        request: Dict[str, Any],
+        webhook_url: Optional[str] = None,
+        owner: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """新建排队中的任务，owner 为提交任务的 API 密钥名称"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, model, request, webhook_url, owner, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, model, json.dumps(request, ensure_ascii=False), webhook_url, owner, time.time()),
+            )
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def update(self, job_id: str, **fields):
+        """更新任务字段（JSON 列自动序列化）"""
+        if not fields:
+            return
+        for column in _JSON_COLUMNS:
+            if fields.get(column) is not None:
+                fields[column] = json.dumps(fields[column], ensure_ascii=False)
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def requeue_interrupted(self) -> int:
+        """把上次退出时仍在运行的任务重新置为排队，返回数量"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = NULL, progress = NULL WHERE status = ?",
+                (JOB_QUEUED, JOB_RUNNING),
+            )
+        return cursor.rowcount
+
+    def queued_ids(self) -> List[str]:
+        """按创建顺序返回排队中的任务 id"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (JOB_QUEUED,)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
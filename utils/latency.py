@@ -0,0 +1,103 @@
+"""
+后端调用延迟与健康统计
+按 (提供商, 模型, 阶段) 保留最近的成功调用耗时，用于计算对冲请求的触发阈值(p95)；
+按 (提供商, 模型) 记录错误率和延迟的指数移动平均，用于分阶段多目标路由
+"""
+import math
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# 每个键保留的样本数
+WINDOW = 200
+
+LatencyKey = Tuple[str, str, str]
+
+
+class LatencyTracker:
+    """滑动窗口内的调用耗时分位数"""
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self._samples: Dict[LatencyKey, Deque[float]] = {}
+
+    def record(self, key: LatencyKey, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def quantile(self, key: LatencyKey, q: float, min_samples: int = 1) -> Optional[float]:
+        """耗时的 q 分位数，样本不足 min_samples 时返回 None"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+    def stats(self):
+        """各键的样本数、p50 和 p95(秒)"""
+        return {
+            ":".join(key): {
+                "samples": len(samples),
+                "p50": round(self.quantile(key, 0.5), 3),
+                "p95": round(self.quantile(key, 0.95), 3),
+            }
+            for key, samples in self._samples.items()
+        }
+
+
+# 全局延迟统计
+latency_tracker = LatencyTracker()
+
+
+# 错误率与延迟的指数移动平均系数（新样本的权重）
+EWMA_ALPHA = 0.2
+
+
+class TargetHealth:
+    """单个 (提供商, 模型) 的错误率和延迟 EWMA"""
+
+    def __init__(self):
+        self.error_rate = 0.0
+        self.latency: Optional[float] = None
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok and latency is not None:
+            self.latency = latency if self.latency is None else self.latency + EWMA_ALPHA * (latency - self.latency)
+
+
+class HealthTracker:
+    """进程内各后端目标的实时健康状况"""
+
+    def __init__(self):
+        self._targets: Dict[Tuple[str, str], TargetHealth] = {}
+
+    def get(self, provider_id: str, model: str) -> TargetHealth:
+        health = self._targets.get((provider_id, model))
+        if health is None:
+            health = self._targets[(provider_id, model)] = TargetHealth()
+        return health
+
+    def record(self, provider_id: str, model: str, ok: bool, latency: Optional[float] = None):
+        self.get(provider_id, model).record(ok, latency)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            f"{provider_id}:{model}": {
+                "calls": health.calls,
+                "errors": health.errors,
+                "error_rate": round(health.error_rate, 3),
+                "latency": round(health.latency, 3) if health.latency is not None else None,
+            }
+            for (provider_id, model), health in self._targets.items()
+        }
+
+
+# 全局健康状况（OpenAIClient 每次尝试后记录）
+provider_health = HealthTracker()
@@ -2,41 +2,104 @@
 OpenAI 客户端包装器
 用于调用后端 LLM 提供商
 """
-from typing import Optional, Dict, Any, List, AsyncIterator
+from typing import Optional, Dict, Any, List, AsyncIterator, Awaitable, Callable, Tuple, TypeVar
 from openai import AsyncOpenAI
 import json
 import logging
 import httpx
 import asyncio
+import time
+
+from config import config, ApiKeyConfig, hash_api_key
+from utils.usage import UsageTracker, estimate_messages_tokens, estimate_text_tokens
+from utils.rate_limiter import RatePermit, current_limiter
+from utils.retry import RetryBudget, RetryPolicy, classify_error, PROVIDER_FAILURES
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from utils.latency import latency_tracker, provider_health
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# 对冲请求在调用耗时超过该分位数时发出，且至少等待 HEDGE_MIN_DELAY 秒
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_DELAY = 0.5
+
 
 class EmptyResponseError(Exception):
-    """Raised when the backend returns an empty choices response twice."""
+    """Raised when the backend returns an empty choices response."""
     pass
 
 
 class OpenAIClient:
     """OpenAI 客户端包装器"""
     
-    def __init__(self, base_url: str, api_key: str, rpm: Optional[int] = None, max_retry: int = 3, use_response_api: bool = False):
-        # OpenAI客户端自己会管理连接，不需要我们操心
-        self.client = AsyncOpenAI(
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        rpm: Optional[int] = None,
+        max_retry: int = 3,
+        use_response_api: bool = False,
+        usage: Optional[UsageTracker] = None,
+        stream_usage: bool = True,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+        caller: Optional[ApiKeyConfig] = None,
+        client: Optional[AsyncOpenAI] = None,
+        provider_id: str = "",
+        tpm: Optional[int] = None,
+        max_inflight: Optional[int] = None,
+        retry_budget: Optional[RetryBudget] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        # 优先使用进程内共享的客户端（复用连接池），未提供时单独创建；
+        # 重试由本客户端负责（每次尝试都经过限流器），SDK 不再自行重试
+        self.client = client or AsyncOpenAI(
             base_url=base_url,
             api_key=api_key,
-            max_retries=max_retry,
+            max_retries=0,
         )
+        self.max_retry = max_retry
+        # 请求级重试预算（同一请求的所有客户端共享）
+        self.retry_budget = retry_budget
+        # 提供商熔断器（进程内共享），熔断时改用 fallback_client（备用提供商的客户端）
+        self.breaker = breaker
+        self.fallback_client: Optional["OpenAIClient"] = None
         self.rpm = rpm
+        self.tpm = tpm
+        self.max_inflight = max_inflight
+        # 限流键：同一提供商、同一密钥、同一后端模型共用一个限流器
+        self.limiter_prefix = f"{provider_id or base_url}:{hash_api_key(api_key or '')[:8]}"
+        # 延迟统计按提供商区分
+        self.provider_id = provider_id or base_url
+        # 对冲请求：generate_text 超过该阶段 p95 耗时仍未返回时，向 hedge_client（未设置时为本客户端）再发一次；
+        # 模型 id 按提供商区分，发往其他提供商时使用 hedge_models 中对应的模型
+        self.hedge = False
+        self.hedge_client: Optional["OpenAIClient"] = None
+        self.hedge_models: Dict[str, str] = {}
         self.rate_limiter = None
         self.use_response_api = use_response_api
+        # 请求级用量统计（同一请求的所有客户端共享），以及流式调用是否请求 usage 块
+        self.usage = usage
+        self.stream_usage = stream_usage
+        # 排队调度：请求优先级和截止时间(time.monotonic)
+        self.priority = priority
+        self.deadline = deadline
+        # 发起请求的 API 密钥：按其权重公平排队，并受其 RPM 限制
+        self.caller = caller
         
         # 统计信息
         self.api_calls = 0
         self.total_tokens = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # 多目标路由中本客户端出错、切换到其他目标的次数
+        self.failovers = 0
         
-        # 如果设置了RPM限制，导入限流器
-        if rpm:
+        # 如果设置了限制，导入限流器
+        if rpm or tpm or max_inflight or (caller and caller.rpm):
             from utils.rate_limiter import rate_limiter
             self.rate_limiter = rate_limiter
     
@@ -64,11 +127,261 @@ class OpenAIClient:
             t = 0.6
         return t, local_kwargs
     
+    async def _acquire_rate_limit(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: Optional[int],
+    ) -> RatePermit:
+        """
+        在后端限流器前按优先级和期限排队（先占用调用方密钥自己的 RPM 配额）
+        返回调用结束时需要归还的名额，TPM 按预估的 prompt token 数加 max_tokens 占用；
+        后端限流器同时记入 current_limiter，供连接池的响应钩子回报提供商的限流信号
+        """
+        permit = RatePermit([])
+        current_limiter.set(None)
+        if not self.rate_limiter:
+            return permit
+        tenant = self.caller.name if self.caller else ""
+        try:
+            if self.caller and self.caller.rpm:
+                permit.add(await self.rate_limiter.acquire(
+                    f"api_key_{tenant}",
+                    rpm=self.caller.rpm,
+                    priority=self.priority,
+                    deadline=self.deadline,
+                ))
+            if self.rpm or self.tpm or self.max_inflight:
+                backend = await self.rate_limiter.acquire(
+                    f"{self.limiter_prefix}:{model}",
+                    rpm=self.rpm,
+                    tpm=self.tpm,
+                    max_inflight=self.max_inflight,
+                    tokens=estimate_messages_tokens(messages) + (max_tokens or 0),
+                    priority=self.priority,
+                    deadline=self.deadline,
+                    tenant=tenant,
+                    weight=self.caller.weight if self.caller else 1.0,
+                )
+                permit.add(backend)
+                current_limiter.set(backend.limiter)
+        except BaseException:
+            permit.release()
+            raise
+        return permit
+    
+    def _stream_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """流式调用的额外参数：要求提供商在最后一个块返回 usage"""
+        if self.stream_usage and "stream_options" not in kwargs:
+            return {**kwargs, "stream_options": {"include_usage": True}}
+        return kwargs
+    
+    def _record_usage(
+        self,
+        stage: Optional[str],
+        usage,
+        messages: List[Dict[str, Any]],
+        text: Optional[str],
+        permit: Optional[RatePermit] = None,
+    ):
+        """记录一次调用的用量（提供商未返回 usage 时按字符数估算），并按实际用量归还限流名额"""
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens or 0
+            completion_tokens = usage.completion_tokens or 0
+            estimated = False
+        else:
+            prompt_tokens = estimate_messages_tokens(messages)
+            completion_tokens = estimate_text_tokens(text or "")
+            estimated = True
+        self.total_tokens += prompt_tokens + completion_tokens
+        if permit is not None:
+            permit.release(prompt_tokens + completion_tokens)
+        if self.usage is not None:
+            self.usage.record(stage, prompt_tokens, completion_tokens, estimated)
+    
+    async def _collect_stream(
+        self,
+        stream,
+        stage: Optional[str],
+        messages: List[Dict[str, Any]],
+        permit: Optional[RatePermit] = None,
+    ) -> str:
+        """聚合流式响应的文本并记录用量，被取消时立即关闭底层连接"""
+        chunks: List[str] = []
+        usage = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if not chunk.choices or len(chunk.choices) == 0:
+                    continue
+                if chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+        finally:
+            await stream.close()
+        text = "".join(chunks)
+        self._record_usage(stage, usage, messages, text, permit)
+        return text
+    
+    async def _with_retry(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: Optional[int],
+        attempt: Callable[[RatePermit], Awaitable[T]],
+        max_retry: Optional[int] = None,
+        defer_success: bool = False,
+    ) -> T:
+        """
+        执行一次后端调用，可重试的错误按退避时间重试
+        每次尝试都重新在限流器前排队并占用名额；attempt(permit) 成功时负责按实际用量归还名额
+        defer_success 为 True 时（流式调用）成功不在此记录，由调用方在流结束后调用 _record_outcome
+        """
+        policy = RetryPolicy(
+            self.max_retry if max_retry is None else max_retry, self.retry_budget, self.deadline,
+        )
+        while True:
+            # 提供商熔断中立即失败，不占用限流名额
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpenError(self.provider_id, self.breaker.retry_after())
+            permit = await self._acquire_rate_limit(model, messages, max_tokens)
+            started = time.monotonic()
+            try:
+                result = await attempt(permit)
+                if not defer_success:
+                    self._record_outcome(model, None, time.monotonic() - started)
+                return result
+            except BaseException as e:
+                # 出错时归还名额（已按实际用量归还的不会重复）
+                permit.release()
+                self._record_outcome(model, e)
+                delay = policy.next_delay(e) if isinstance(e, Exception) else None
+                if delay is None:
+                    raise
+                self.retries += 1
+                logger.warning(
+                    f"后端调用失败({classify_error(e)})，{delay:.1f} 秒后第 {policy.attempt} 次重试: "
+                    f"model={model}, error={e}"
+                )
+            await asyncio.sleep(delay)
+    
+    def _record_outcome(self, model: str, error: Optional[BaseException] = None, elapsed: Optional[float] = None):
+        """把一次调用的结果计入提供商健康状况和熔断器；取消（非 Exception）不计"""
+        if error is None:
+            provider_health.record(self.provider_id, model, True, elapsed)
+            if self.breaker is not None:
+                self.breaker.record(False, elapsed)
+            return
+        if not isinstance(error, Exception):
+            return
+        kind = classify_error(error)
+        if kind is not None:
+            provider_health.record(self.provider_id, model, False)
+        if self.breaker is not None:
+            # 限流、参数错误等说明提供商仍在正常响应
+            self.breaker.record(kind in PROVIDER_FAILURES)
+    
+    def has_spare_capacity(self, model: str, messages: List[Dict[str, Any]], max_tokens: Optional[int]) -> bool:
+        """提供商未熔断，且调用方密钥和后端的限流器都无人排队、可立即放行一次调用"""
+        if self.breaker is not None and self.breaker.is_open:
+            return False
+        if not self.rate_limiter:
+            return True
+        if self.caller and self.caller.rpm and not self.rate_limiter.has_spare_capacity(
+            f"api_key_{self.caller.name}", rpm=self.caller.rpm
+        ):
+            return False
+        return self.rate_limiter.has_spare_capacity(
+            f"{self.limiter_prefix}:{model}",
+            rpm=self.rpm,
+            tpm=self.tpm,
+            max_inflight=self.max_inflight,
+            tokens=estimate_messages_tokens(messages) + (max_tokens or 0),
+        )
+    
+    def _fallback(self) -> Optional["OpenAIClient"]:
+        """本提供商熔断中且备用提供商可用时，返回备用提供商的客户端"""
+        if self.breaker is None or self.fallback_client is None or not self.breaker.is_open:
+            return None
+        fallback_breaker = self.fallback_client.breaker
+        if fallback_breaker is not None and fallback_breaker.is_open:
+            return None
+        logger.info(f"提供商 {self.provider_id} 熔断中，改用备用提供商 {self.fallback_client.provider_id}")
+        return self.fallback_client
+    
+    def _hedge_target(self, model: str) -> Tuple["OpenAIClient", str]:
+        """对冲调用的客户端和模型 id：hedge_models 中没有该模型在对冲提供商上的 id 时，仍发往本提供商"""
+        target = self.hedge_client
+        if target is None or target is self:
+            return self, model
+        hedge_model = self.hedge_models.get(model)
+        if hedge_model is None:
+            return self, model
+        return target, hedge_model
+    
+    async def _hedged(self, primary: Awaitable[str], send_hedge: Callable[["OpenAIClient", str], Awaitable[str]],
+                      model: str, stage: Optional[str], messages: List[Dict[str, Any]],
+                      max_tokens: Optional[int]) -> str:
+        """
+        主调用超过该 (提供商, 模型, 阶段) 的 p95 耗时仍未返回时发出对冲调用，先成功的结果胜出，另一个被取消
+        样本不足或对冲目标的限流器没有空余配额时不对冲，对冲不会把提供商推向 429
+        """
+        first = asyncio.ensure_future(primary)
+        tasks = [first]
+        try:
+            threshold = latency_tracker.quantile(
+                (self.provider_id, model, stage or "default"), HEDGE_QUANTILE, config.hedge_min_samples,
+            )
+            if threshold is None:
+                return await first
+            done, _ = await asyncio.wait(tasks, timeout=max(threshold, HEDGE_MIN_DELAY))
+            target, hedge_model = self._hedge_target(model)
+            if done or not target.has_spare_capacity(hedge_model, messages, max_tokens):
+                return await first
+            self.hedges += 1
+            logger.info(f"调用超过 p95 ({threshold:.1f}s)，发出对冲请求: model={hedge_model}, stage={stage}, provider={target.provider_id}")
+            tasks.append(asyncio.ensure_future(send_hedge(target, hedge_model)))
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    # 一个失败时继续等待另一个，都失败时抛出主调用的错误
+                    if task is first or error is None:
+                        error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    @staticmethod
+    def _parse_json(text: str) -> Dict[str, Any]:
+        """解析 JSON，失败时尝试从代码块中提取"""
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            if "```json" in text:
+                json_text = text.split("```json")[1].split("```")[0].strip()
+            elif "```" in text:
+                json_text = text.split("```")[1].split("```")[0].strip()
+            else:
+                json_text = text.strip()
+            return json.loads(json_text)
+    
     def get_statistics(self) -> Dict[str, int]:
         """获取统计信息"""
         return {
             "api_calls": self.api_calls,
-            "total_tokens": self.total_tokens
+            "total_tokens": self.total_tokens,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
         }
     
     async def generate_text(
@@ -79,6 +392,8 @@ class OpenAIClient:
         system: str = None,
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
+        stage: Optional[str] = None,
+        max_retry: Optional[int] = None,
         **kwargs
     ) -> str:
         """
@@ -92,16 +407,18 @@ class OpenAIClient:
             system: 系统提示词
             temperature: 温度参数
             max_tokens: 最大token数
+            stage: 调用所属阶段（用于用量统计）
+            max_retry: 本次调用的最大重试次数（不设置则使用客户端配置）
         
         Returns:
             生成的文本
         """
-        # RPM限制 - 在调用后端API之前等待
-        if self.rate_limiter and self.rpm:
-            await self.rate_limiter.wait_for_rate_limit(
-                f"backend_api_{model}",
-                self.rpm,
-                60
+        # 本提供商熔断中时改用备用提供商
+        fallback = self._fallback()
+        if fallback is not None:
+            return await fallback.generate_text(
+                model, prompt=prompt, messages=messages, system=system, temperature=temperature,
+                max_tokens=max_tokens, stage=stage, max_retry=max_retry, **kwargs
             )
         
         # 构建消息列表
@@ -120,61 +437,70 @@ class OpenAIClient:
         # 统一规范化温度，避免提供商返回 400
         temperature, kwargs = self._prepare_temperature(temperature, kwargs)
         
-        # 当启用 response_api 时，使用流式接口并在本地聚合，向后兼容返回完整文本
-        if self.use_response_api:
-            stream = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                stream=True,
-                **kwargs
-            )
-            self.api_calls += 1
-            chunks: List[str] = []
-            async for chunk in stream:
-                if not chunk.choices or len(chunk.choices) == 0:
-                    continue
-                if chunk.choices[0].delta and chunk.choices[0].delta.content:
-                    chunks.append(chunk.choices[0].delta.content)
-            return "".join(chunks)
-        
-        response = await self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            **kwargs
+        primary = self._generate_text(model, messages, temperature, max_tokens, stage, kwargs, max_retry)
+        if not self.hedge:
+            return await primary
+        return await self._hedged(
+            primary,
+            # 对冲调用只尝试一次，不占用重试预算
+            lambda target, hedge_model: target._generate_text(
+                hedge_model, messages, temperature, max_tokens, stage, kwargs, max_retry=0
+            ),
+            model, stage, messages, max_tokens,
         )
-        
-        # 统计 API 调用
-        self.api_calls += 1
-        if hasattr(response, 'usage') and response.usage:
-            self.total_tokens += response.usage.total_tokens
-        
-        # 检查响应是否包含 choices
-        if not response.choices or len(response.choices) == 0:
-            logger.error(f"API 返回空响应，自动重试一次: model={model}")
-            # 重试一次
-            await asyncio.sleep(2)
-            retry_response = await self.client.chat.completions.create(
+    
+    async def _generate_text(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        stage: Optional[str],
+        kwargs: Dict[str, Any],
+        max_retry: Optional[int] = None,
+    ) -> str:
+        """按重试策略完成一次文本生成，记录成功调用的耗时"""
+        async def attempt(permit: RatePermit) -> str:
+            started = time.monotonic()
+            # 当启用 response_api 时，使用流式接口并在本地聚合，向后兼容返回完整文本
+            if self.use_response_api:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    **self._stream_kwargs(kwargs)
+                )
+                self.api_calls += 1
+                text = await self._collect_stream(stream, stage, messages, permit)
+                latency_tracker.record((self.provider_id, model, stage or "default"), time.monotonic() - started)
+                return text
+            
+            response = await self.client.chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 **kwargs
             )
+            
             # 统计 API 调用
             self.api_calls += 1
-            if hasattr(retry_response, 'usage') and retry_response.usage:
-                self.total_tokens += retry_response.usage.total_tokens
-            # 再次检查
-            if not retry_response.choices or len(retry_response.choices) == 0:
-                logger.error(f"API 两次返回空响应: model={model}")
-                raise EmptyResponseError(f"API 返回空响应两次，模型: {model}")
-            return retry_response.choices[0].message.content
+            
+            # 检查响应是否包含 choices（空响应可重试）
+            if not response.choices or len(response.choices) == 0:
+                self._record_usage(stage, getattr(response, 'usage', None), messages, "", permit)
+                logger.error(f"API 返回空响应: model={model}")
+                raise EmptyResponseError(f"API 返回空响应，模型: {model}")
+            
+            text = response.choices[0].message.content
+            self._record_usage(stage, getattr(response, 'usage', None), messages, text, permit)
+            latency_tracker.record((self.provider_id, model, stage or "default"), time.monotonic() - started)
+            return text
         
-        return response.choices[0].message.content
+        # 限流 - 每次尝试前在限流器前等待
+        return await self._with_retry(model, messages, max_tokens, attempt, max_retry)
     
     async def generate_object(
         self,
@@ -182,6 +508,8 @@ class OpenAIClient:
         prompt: str,
         response_format: Dict[str, Any],
         temperature: float = 0.7,
+        stage: Optional[str] = None,
+        max_retry: Optional[int] = None,
         **kwargs
     ) -> Dict[str, Any]:
         """
@@ -192,99 +520,62 @@ class OpenAIClient:
             prompt: 提示词
             response_format: 响应格式定义
             temperature: 温度参数
+            stage: 调用所属阶段（用于用量统计）
+            max_retry: 本次调用的最大重试次数（不设置则使用客户端配置）
         
         Returns:
             解析后的JSON对象
         """
-        # RPM限制 - 在调用后端API之前等待
-        if self.rate_limiter and self.rpm:
-            await self.rate_limiter.wait_for_rate_limit(
-                f"backend_api_{model}",
-                self.rpm,
-                60
+        # 本提供商熔断中时改用备用提供商
+        fallback = self._fallback()
+        if fallback is not None:
+            return await fallback.generate_object(
+                model, prompt, response_format, temperature=temperature, stage=stage, max_retry=max_retry, **kwargs
             )
         
         # 统一规范化温度，避免提供商返回 400
         temperature, kwargs = self._prepare_temperature(temperature, kwargs)
+        messages = [{"role": "user", "content": prompt}]
         
-        # 当启用 response_api 时，使用流式接口并在本地聚合文本后再解析 JSON
-        if self.use_response_api:
-            stream = await self.client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=temperature,
-                response_format={"type": "json_object"},
-                stream=True,
-                **kwargs
-            )
-            self.api_calls += 1
-            chunks: List[str] = []
-            async for chunk in stream:
-                if not chunk.choices or len(chunk.choices) == 0:
-                    continue
-                if chunk.choices[0].delta and chunk.choices[0].delta.content:
-                    chunks.append(chunk.choices[0].delta.content)
-            text = "".join(chunks)
-            try:
-                return json.loads(text)
-            except json.JSONDecodeError:
-                # 尝试从代码块中提取JSON
-                if "```json" in text:
-                    json_text = text.split("```json")[1].split("```")[0].strip()
-                elif "```" in text:
-                    json_text = text.split("```")[1].split("```")[0].strip()
-                else:
-                    json_text = text.strip()
-                return json.loads(json_text)
-        
-        response = await self.client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            response_format={"type": "json_object"},
-            **kwargs
-        )
-        
-        # 统计 API 调用
-        self.api_calls += 1
-        if hasattr(response, 'usage') and response.usage:
-            self.total_tokens += response.usage.total_tokens
-        
-        # 检查响应是否包含 choices
-        if not response.choices or len(response.choices) == 0:
-            logger.error(f"API 返回空响应，自动重试一次: model={model}")
-            # 重试一次
-            await asyncio.sleep(2)
-            retry_response = await self.client.chat.completions.create(
+        async def attempt(permit: RatePermit) -> Dict[str, Any]:
+            # 当启用 response_api 时，使用流式接口并在本地聚合文本后再解析 JSON
+            if self.use_response_api:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    response_format={"type": "json_object"},
+                    stream=True,
+                    **self._stream_kwargs(kwargs)
+                )
+                self.api_calls += 1
+                text = await self._collect_stream(stream, stage, messages, permit)
+                return self._parse_json(text)
+            
+            response = await self.client.chat.completions.create(
                 model=model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=messages,
                 temperature=temperature,
                 response_format={"type": "json_object"},
                 **kwargs
             )
+            
             # 统计 API 调用
             self.api_calls += 1
-            if hasattr(retry_response, 'usage') and retry_response.usage:
-                self.total_tokens += retry_response.usage.total_tokens
-            if not retry_response.choices or len(retry_response.choices) == 0:
-                logger.error(f"API 两次返回空响应: model={model}")
-                raise EmptyResponseError(f"API 返回空响应两次，模型: {model}")
-            text = retry_response.choices[0].message.content
-        else:
+            
+            # 检查响应是否包含 choices（空响应可重试）
+            if not response.choices or len(response.choices) == 0:
+                self._record_usage(stage, getattr(response, 'usage', None), messages, "", permit)
+                logger.error(f"API 返回空响应: model={model}")
+                raise EmptyResponseError(f"API 返回空响应，模型: {model}")
+            
             text = response.choices[0].message.content
+            self._record_usage(stage, getattr(response, 'usage', None), messages, text, permit)
+            # 无法解析的 JSON 同样重试
+            return self._parse_json(text)
         
-        try:
-            return json.loads(text)
-        except json.JSONDecodeError:
-            # 尝试从代码块中提取JSON
-            if "```json" in text:
-                json_text = text.split("```json")[1].split("```")[0].strip()
-            elif "```" in text:
-                json_text = text.split("```")[1].split("```")[0].strip()
-            else:
-                json_text = text.strip()
-            
-            return json.loads(json_text)
+        # 限流 - 每次尝试前在限流器前等待
+        return await self._with_retry(model, messages, kwargs.get("max_tokens"), attempt, max_retry)
     
     async def stream_text(
         self,
@@ -292,6 +583,9 @@ class OpenAIClient:
         messages: List[Dict[str, Any]],
         temperature: float = 0.7,
         max_tokens: Optional[int] = None,
+        system: str = None,
+        stage: Optional[str] = None,
+        max_retry: Optional[int] = None,
         **kwargs
     ) -> AsyncIterator[str]:
         """
@@ -303,44 +597,101 @@ class OpenAIClient:
             messages: 消息列表（支持多模态content）
             temperature: 温度参数
             max_tokens: 最大token数
+            system: 系统提示词
+            stage: 调用所属阶段（用于用量统计）
+            max_retry: 本次调用的最大重试次数（不设置则使用客户端配置）
         
         Yields:
             文本块
         """
-        # RPM限制 - 在调用后端API之前等待
-        if self.rate_limiter and self.rpm:
-            await self.rate_limiter.wait_for_rate_limit(
-                f"backend_api_{model}",
-                self.rpm,
-                60
-            )
+        # 本提供商熔断中时改用备用提供商
+        fallback = self._fallback()
+        if fallback is not None:
+            async for text in fallback.stream_text(
+                model, messages, temperature=temperature, max_tokens=max_tokens, system=system,
+                stage=stage, max_retry=max_retry, **kwargs
+            ):
+                yield text
+            return
+        
+        # 如果提供了system,插入到消息列表开头
+        if system:
+            messages = [{"role": "system", "content": system}] + messages
         
         # 统一规范化温度，避免提供商返回 400
         temperature, kwargs = self._prepare_temperature(temperature, kwargs)
         
-        stream = await self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            stream=True,
-            **kwargs
+        async def attempt(permit: RatePermit):
+            started = time.monotonic()
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                **self._stream_kwargs(kwargs)
+            )
+            return stream, permit, started
+        
+        # 限流 - 每次尝试前在限流器前等待；只重试建立流式连接，开始输出后不再重试
+        # 连接成功不算调用成功：流读完后才把结果（含中途断开）计入健康状况和熔断器
+        stream, permit, started = await self._with_retry(
+            model, messages, max_tokens, attempt, max_retry, defer_success=True
         )
         
         # 统计 API 调用
         self.api_calls += 1
         
-        async for chunk in stream:
-            # 检查 chunk 是否包含 choices
-            if not chunk.choices or len(chunk.choices) == 0:
-                logger.warning(f"流式响应中收到空 chunk: model={model}")
-                continue
-            
-            if chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+        usage = None
+        chunks: List[str] = []
+        error: Optional[BaseException] = None
+        try:
+            async for chunk in stream:
+                # 最后一个块携带 usage（choices 为空）
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                # 检查 chunk 是否包含 choices
+                if not chunk.choices or len(chunk.choices) == 0:
+                    if usage is None:
+                        logger.warning(f"流式响应中收到空 chunk: model={model}")
+                    continue
+                
+                if chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 被取消或提前退出时立即关闭连接，释放连接池
+            await stream.close()
+            # 中途取消的调用同样计入已生成部分的用量
+            self._record_usage(stage, usage, messages, "".join(chunks), permit)
+            # 耗时按整个流计算，与非流式调用一致；消费方提前关闭（GeneratorExit）和取消不计
+            self._record_outcome(model, error, time.monotonic() - started)
 
 
-def create_client(base_url: str, api_key: str, rpm: Optional[int] = None, max_retry: int = 3, use_response_api: bool = False) -> OpenAIClient:
-    """创建OpenAI客户端"""
-    return OpenAIClient(base_url, api_key, rpm, max_retry, use_response_api)
+def create_client(
+    base_url: str,
+    api_key: str,
+    rpm: Optional[int] = None,
+    max_retry: int = 3,
+    use_response_api: bool = False,
+    usage: Optional[UsageTracker] = None,
+    stream_usage: bool = True,
+    priority: int = 0,
+    deadline: Optional[float] = None,
+    caller: Optional[ApiKeyConfig] = None,
+    client: Optional[AsyncOpenAI] = None,
+    provider_id: str = "",
+    tpm: Optional[int] = None,
+    max_inflight: Optional[int] = None,
+    retry_budget: Optional[RetryBudget] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> OpenAIClient:
+    """创建OpenAI客户端，client 为共享的 AsyncOpenAI（统计仍按本客户端单独计算）"""
+    return OpenAIClient(
+        base_url, api_key, rpm, max_retry, use_response_api, usage, stream_usage, priority, deadline, caller, client,
+        provider_id, tpm, max_inflight, retry_budget, breaker,
+    )
 
@@ -0,0 +1,84 @@
+"""
+跨进程共享的限流状态
+多个 worker 进程通过同一个本地 SQLite 文件共享漏桶水位：每次取配额在一个 IMMEDIATE 事务中
+完成“漏水 - 检查 - 放入”，对同一主机的所有进程是原子的；水位按墙上时间漏出，服务重启后仍然有效
+所有方法都是同步的，由调用方通过 asyncio.to_thread 放到线程中执行
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    level REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class RateLimitStore:
+    """SQLite 漏桶存储（单连接，线程锁串行化本进程内的访问，事务锁串行化进程间的访问）"""
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # 自行管理事务；其他进程持有写锁时最多等待 30 秒
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _level(self, key: str, rate: float, now: float) -> float:
+        """漏水后的当前水位"""
+        row = self._conn.execute("SELECT level, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return 0.0
+        level, updated_at = row
+        return max(0.0, level - max(now - updated_at, 0.0) * rate / 60)
+
+    def _save(self, key: str, level: float, now: float):
+        self._conn.execute(
+            "INSERT INTO buckets (key, level, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET level = excluded.level, updated_at = excluded.updated_at",
+            (key, level, now),
+        )
+
+    def try_take(self, key: str, rate: float, amount: float) -> float:
+        """
+        向每分钟 rate 个单位的漏桶放入 amount：放得下时放入并返回 0，否则返回还需等待的秒数
+        超过容量的 amount 按容量计，桶空时总能通过
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                level = self._level(key, rate, now)
+                excess = level + min(amount, rate) - rate
+                if excess > 0:
+                    self._conn.execute("COMMIT")
+                    return excess * 60 / rate
+                self._save(key, level + amount, now)
+                self._conn.execute("COMMIT")
+                return 0.0
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def adjust(self, key: str, rate: float, delta: float):
+        """追加（正数）或退还（负数）水位，用于按实际用量校正"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self._save(key, max(0.0, self._level(key, rate, now) + delta), now)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
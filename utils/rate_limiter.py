@@ -1,59 +1,463 @@
 """
 速率限制器
-实现每分钟请求数(RPM)限制
 用于限制后端调用LLM API的频率，而非限制用户请求频率
-使用 aiolimiter 库实现
+每个后端（提供商、密钥、模型）一个组合限流器，同时限制 RPM、TPM 和同时进行的调用数；
+RPM 默认使用 aiolimiter 在进程内实现，多 worker 部署时可改用 SQLite 在同一主机的进程间共享；
+提供商返回 429 或限流响应头显示配额用尽时，按 AIMD 降低实际使用的 RPM 并暂停，之后逐步恢复到配置值；
+限流器前由 PriorityScheduler 按优先级和期限排队
 """
-from typing import Dict
+import asyncio
+import email.utils
+import logging
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple, Any, Union
+
 from aiolimiter import AsyncLimiter
 
+from config import config
+from utils.scheduler import PriorityScheduler
+from utils.rate_limit_store import RateLimitStore
+
+logger = logging.getLogger(__name__)
+
+# 清理空闲限流器的检查间隔(秒)
+EVICT_INTERVAL = 60
+
+# 自适应限速：429 时速率减半（两次减半至少间隔几秒，避免并发调用同时收到 429 时速率骤降），
+# 每次成功响应恢复 1 RPM；没有给出重试时间时暂停的秒数；速率下限
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_DECREASE_COOLDOWN = 5.0
+AIMD_INCREASE_STEP = 1.0
+DEFAULT_PAUSE = 1.0
+MIN_RPM = 1.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析限流重置时间，如 "20ms"、"1s"、"6m0s" 或纯秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    """从响应头读取建议的重试等待时间(秒)：retry-after-ms、retry-after（秒数或 HTTP 日期）或限流重置时间"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    resets = [parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class TokenBucket:
+    """漏桶：每分钟最多放入 rate 个单位，可追加或退还（用于 TPM 及按实际用量校正）"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.level = 0.0
+        self._last = time.monotonic()
+
+    def _leak(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self._last) * self.rate / 60)
+        self._last = now
+
+    def wait_time(self, amount: float) -> float:
+        """还需等待多少秒才能放入 amount（超过容量的按容量计，桶空时总能通过）"""
+        self._leak()
+        excess = self.level + min(amount, self.rate) - self.rate
+        return max(0.0, excess * 60 / self.rate)
+
+    def consume(self, amount: float):
+        """放入 amount，负数表示退还"""
+        self._leak()
+        self.level = max(0.0, self.level + amount)
+
+    async def try_take(self, amount: float) -> float:
+        """放得下时放入 amount 并返回 0，否则返回还需等待的秒数"""
+        delay = self.wait_time(amount)
+        if delay <= 0:
+            self.consume(amount)
+        return delay
+
+
+class SharedBucket:
+    """与 TokenBucket 接口相同的跨进程漏桶，水位保存在 RateLimitStore 中"""
+
+    def __init__(self, store: RateLimitStore, key: str, rate: float):
+        self.store = store
+        self.key = key
+        self.rate = rate
+
+    async def try_take(self, amount: float) -> float:
+        return await asyncio.to_thread(self.store.try_take, self.key, self.rate, amount)
+
+    async def acquire(self):
+        """占用一个单位（作为 RPM 限流器，与 AsyncLimiter.acquire 对应）"""
+        while (delay := await self.try_take(1)) > 0:
+            await asyncio.sleep(delay)
+
+    def consume(self, amount: float):
+        """追加或退还水位（在线程池中执行，不等待完成）"""
+        asyncio.get_running_loop().run_in_executor(None, self.store.adjust, self.key, self.rate, amount)
+
+
+class CompositeLimiter:
+    """
+    单个后端的组合限流：RPM、TPM 和同时进行的调用数
+    接口与 AsyncLimiter 相同（has_capacity / acquire），amount 为本次调用预估的 token 数；
+    调用结束后 release 归还调用名额，并按实际用量校正 TPM
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_inflight: Optional[int] = None,
+        key: str = "",
+        store: Optional[RateLimitStore] = None,
+    ):
+        self.rpm: Optional[int] = None
+        self.tpm: Optional[int] = None
+        self.max_inflight: Optional[int] = None
+        # 设置 store 时 RPM 和 TPM 在进程间共享（同时进行的调用数仍按进程计算）
+        self.key = key
+        self._store = store
+        self._requests: Union[AsyncLimiter, SharedBucket, None] = None
+        self._tokens: Union[TokenBucket, SharedBucket, None] = None
+        self.in_flight = 0
+        self._slot_waiters: Deque[asyncio.Future] = deque()
+        # 有调用归还 token 时通知等待 TPM 的调用提前重新检查
+        self._refunded = asyncio.Event()
+        # 自适应限速：实际使用的 RPM（低于配置值时由 _adaptive 漏桶限速）、暂停截止时间和收到的 429 次数
+        self.effective_rpm: Optional[float] = None
+        self._adaptive: Optional[TokenBucket] = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self.throttled = 0
+        self.last_used = time.monotonic()
+        # 限制在创建后不再改变：不同的限制对应不同的键（见 RateLimiterManager.scheduler_key）
+        if rpm:
+            self.rpm = rpm
+            if self._store is not None:
+                self._requests = SharedBucket(self._store, f"{self.key}:rpm", rpm)
+            else:
+                self._requests = AsyncLimiter(max_rate=rpm, time_period=60)
+            self.effective_rpm = float(rpm)
+        if tpm:
+            self.tpm = tpm
+            if self._store is not None:
+                self._tokens = SharedBucket(self._store, f"{self.key}:tpm", tpm)
+            else:
+                self._tokens = TokenBucket(tpm)
+        self.max_inflight = max_inflight or None
+
+    def _slot_free(self) -> bool:
+        return not self.max_inflight or self.in_flight < self.max_inflight
+
+    def has_capacity(self, amount: float = 1) -> bool:
+        if not self._slot_free():
+            return False
+        if self._store is not None:
+            # 共享状态需要查询数据库，统一由分发任务获取
+            return False
+        if self._paused_until > time.monotonic():
+            return False
+        if self._adaptive and self._adaptive.wait_time(1) > 0:
+            return False
+        if self._tokens and self._tokens.wait_time(amount) > 0:
+            return False
+        return self._requests is None or self._requests.has_capacity()
+
+    async def acquire(self, amount: float = 1):
+        """等待并占用一个调用名额和 amount 个 token"""
+        while not self._slot_free():
+            future = asyncio.get_running_loop().create_future()
+            self._slot_waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # 已被唤醒却被取消，把名额让给下一个
+                    self._wake_slot_waiter()
+                raise
+        # 先占用名额和 token，之后的等待期间其他调用不会超额
+        self.in_flight += 1
+        consumed = 0.0
+        try:
+            if self._tokens:
+                while (delay := await self._tokens.try_take(amount)) > 0:
+                    try:
+                        await asyncio.wait_for(self._refunded.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                consumed = amount
+            # 提供商要求暂停或自适应速率低于配置值时额外等待
+            while (delay := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            # 等待期间速率可能已恢复到配置值（_adaptive 被移除），每次重新检查
+            while self._adaptive and (delay := await self._adaptive.try_take(1)) > 0:
+                await asyncio.sleep(delay)
+            if self._requests:
+                await self._requests.acquire()
+        except BaseException:
+            self.release(consumed, 0)
+            raise
+        self.last_used = time.monotonic()
+
+    def release(self, estimated: float = 0, actual: Optional[float] = None):
+        """归还调用名额；给出实际 token 用量时校正预估（少退多补）"""
+        self.in_flight -= 1
+        self._wake_slot_waiter()
+        if self._tokens and actual is not None:
+            self._tokens.consume(actual - estimated)
+            if actual < estimated:
+                self._refunded.set()
+                self._refunded = asyncio.Event()
+        self.last_used = time.monotonic()
+
+    def feedback(self, status: int, headers):
+        """
+        根据提供商的响应调整速率：
+        429 时乘性降低 RPM 并按 retry-after 暂停；配额用尽（x-ratelimit-remaining-* 为 0）时暂停到重置；
+        成功响应加性恢复，最高到配置的 RPM
+        """
+        if not config.adaptive_rate_limit:
+            return
+        now = time.monotonic()
+        if status == 429:
+            self.throttled += 1
+            self._pause(now + (retry_after(headers) or DEFAULT_PAUSE))
+            self._decrease(now)
+            return
+        if status >= 400:
+            return
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is not None and remaining.strip() in ("0", "0.0"):
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                self._pause(now + (reset if reset is not None else DEFAULT_PAUSE))
+        self._increase()
+
+    def _pause(self, until: float):
+        if until > self._paused_until:
+            self._paused_until = until
+            logger.info(f"Rate limiter {self.key} paused for {until - time.monotonic():.1f}s by provider")
+
+    def _decrease(self, now: float):
+        if not self.rpm or now - self._last_decrease < AIMD_DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.effective_rpm = max(MIN_RPM, self.effective_rpm * AIMD_DECREASE_FACTOR)
+        if self._adaptive is None:
+            # 从满桶开始，降速立即生效
+            self._adaptive = TokenBucket(self.effective_rpm)
+            self._adaptive.level = self.effective_rpm
+        self._adaptive.rate = self.effective_rpm
+        logger.warning(f"Rate limiter {self.key} throttled by provider, effective RPM {self.effective_rpm:.1f}/{self.rpm}")
+
+    def _increase(self):
+        if self._adaptive is None:
+            return
+        self.effective_rpm = min(float(self.rpm), self.effective_rpm + AIMD_INCREASE_STEP)
+        if self.effective_rpm >= self.rpm:
+            # 恢复到配置值，只由 RPM 限流器限速
+            self._adaptive = None
+            logger.info(f"Rate limiter {self.key} recovered to configured RPM {self.rpm}")
+        else:
+            self._adaptive.rate = self.effective_rpm
+
+    def _wake_slot_waiter(self):
+        while self._slot_waiters:
+            future = self._slot_waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "max_inflight": self.max_inflight,
+            "in_flight": self.in_flight,
+            "tokens_used": round(self._tokens.level) if isinstance(self._tokens, TokenBucket) else None,
+            "shared": self._store is not None,
+            "effective_rpm": round(self.effective_rpm, 1) if self.effective_rpm is not None else None,
+            "throttled": self.throttled,
+            "paused_for": round(max(self._paused_until - time.monotonic(), 0.0), 1),
+        }
+
+
+# 当前后端调用对应的限流器，连接池的响应钩子据此把 429 和限流响应头回报给它
+current_limiter: ContextVar[Optional[CompositeLimiter]] = ContextVar("current_limiter", default=None)
+
+
+class RatePermit:
+    """一次后端调用占用的限流名额，调用结束时按实际 token 用量归还（可重复调用）"""
+
+    def __init__(self, held: List[Tuple[CompositeLimiter, float]]):
+        self._held = held
+
+    @property
+    def limiter(self) -> Optional[CompositeLimiter]:
+        """最后占用的限流器（后端限流器）"""
+        return self._held[-1][0] if self._held else None
+
+    def add(self, other: "RatePermit"):
+        self._held.extend(other._held)
+
+    def release(self, actual_tokens: Optional[int] = None):
+        held, self._held = self._held, []
+        for limiter, estimated in held:
+            limiter.release(estimated, actual_tokens)
+
 
 class RateLimiterManager:
-    """速率限制器管理器，为每个key维护独立的限流器"""
-    
+    """速率限制器管理器，为每个key维护独立的限流器和排队调度"""
+
     def __init__(self):
-        self._limiters: Dict[str, AsyncLimiter] = {}
-    
-    def _get_limiter(self, key: str, limit: int, window: int = 60) -> AsyncLimiter:
-        """获取或创建指定key的限流器"""
-        limiter_key = f"{key}:{limit}:{window}"
-        
-        if limiter_key not in self._limiters:
-            # 创建新的限流器: max_rate 次/time_period 秒
-            self._limiters[limiter_key] = AsyncLimiter(max_rate=limit, time_period=window)
-        
-        return self._limiters[limiter_key]
-    
-    async def wait_for_rate_limit(self, key: str, limit: int, window: int = 60):
+        self._schedulers: Dict[str, PriorityScheduler] = {}
+        self._last_sweep = time.monotonic()
+        self._store: Optional[RateLimitStore] = None
+
+    def _shared_store(self) -> Optional[RateLimitStore]:
+        """rate_limit_backend 为 sqlite 时的共享存储（首次使用时打开）"""
+        if config.rate_limit_backend != "sqlite":
+            return None
+        if self._store is None:
+            self._store = RateLimitStore(config.rate_limit_db_path)
+        return self._store
+
+    @staticmethod
+    def scheduler_key(key: str, rpm: Optional[int], tpm: Optional[int], max_inflight: Optional[int]) -> str:
         """
-        等待直到可以发起请求（自动获取令牌）
-        
-        Args:
-            key: 限制的键(通常是后端API模型ID)
-            limit: 限制数量
-            window: 时间窗口(秒),默认60秒
+        限流器的完整键：调用方给出的键加上配置的限制
+        限制相同的模型配置共用一个限流器，限制不同的各自计数，互不影响
         """
-        limiter = self._get_limiter(key, limit, window)
-        async with limiter:
-            # 自动等待直到有可用配额
-            pass
-    
-    def has_capacity(self, key: str, limit: int, window: int = 60) -> bool:
+        return f"{key}:{rpm or '-'}:{tpm or '-'}:{max_inflight or '-'}"
+
+    def _get_scheduler(
+        self,
+        key: str,
+        rpm: Optional[int],
+        tpm: Optional[int],
+        max_inflight: Optional[int],
+    ) -> PriorityScheduler:
+        """获取或创建指定key和限制的限流器及其调度队列"""
+        self._evict_idle()
+        key = self.scheduler_key(key, rpm, tpm, max_inflight)
+        scheduler = self._schedulers.get(key)
+        if scheduler is None:
+            scheduler = self._schedulers[key] = PriorityScheduler(
+                CompositeLimiter(rpm, tpm, max_inflight, key, self._shared_store()),
+                aging_seconds=config.scheduler_aging_seconds,
+            )
+        return scheduler
+
+    def _evict_idle(self):
+        """移除长时间空闲的限流器（空闲超过一分钟后桶已清空，移除不会放过突发）"""
+        now = time.monotonic()
+        if now - self._last_sweep < EVICT_INTERVAL:
+            return
+        self._last_sweep = now
+        ttl = max(config.rate_limiter_idle_ttl, 60)
+        idle = [
+            key for key, scheduler in self._schedulers.items()
+            if not scheduler.pending
+            and scheduler.limiter.in_flight == 0
+            and now - scheduler.limiter.last_used > ttl
+        ]
+        for key in idle:
+            del self._schedulers[key]
+        if idle:
+            logger.debug(f"Evicted {len(idle)} idle rate limiters")
+
+    async def acquire(
+        self,
+        key: str,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_inflight: Optional[int] = None,
+        tokens: int = 1,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+        tenant: str = "",
+        weight: float = 1.0,
+    ) -> RatePermit:
         """
-        检查是否有可用配额（非阻塞）
-        
+        等待直到可以发起请求，返回调用结束时需要归还的名额
+
         Args:
-            key: 限制的键
-            limit: 限制数量
-            window: 时间窗口(秒)
-        
-        Returns:
-            True如果有可用配额，False如果需要等待
+            key: 限制的键(通常是 提供商:密钥指纹:后端模型)，与下面的限制一起确定使用哪个限流器
+            rpm / tpm / max_inflight: 每分钟请求数、每分钟 token 数、同时进行的调用数，None 表示不限
+            tokens: 本次调用预估的 token 数（prompt + max_tokens）
+            priority: 请求优先级，越大越先获得配额
+            deadline: 请求截止时间(time.monotonic)，同优先级时先到期的先走
+            tenant: 调用方(API 密钥名称)，多个调用方排队时按权重公平分配配额
+            weight: 调用方的公平份额权重
         """
-        limiter = self._get_limiter(key, limit, window)
-        return limiter.has_capacity()
+        scheduler = self._get_scheduler(key, rpm, tpm, max_inflight)
+        await scheduler.acquire(priority, deadline, tenant, weight, amount=tokens)
+        return RatePermit([(scheduler.limiter, tokens)])
+
+    def has_spare_capacity(
+        self,
+        key: str,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_inflight: Optional[int] = None,
+        tokens: float = 1,
+    ) -> bool:
+        """限流器无人排队且可立即放行一次调用（用于对冲请求等可有可无的额外调用）"""
+        scheduler = self._schedulers.get(self.scheduler_key(key, rpm, tpm, max_inflight))
+        if scheduler is None:
+            return True
+        return not scheduler.pending and scheduler.limiter.has_capacity(tokens)
+
+    def pending(self) -> Dict[str, int]:
+        """各限流器前排队等待的调用数量"""
+        return {key: s.pending for key, s in self._schedulers.items() if s.pending}
+
+    def waiting_above(self, priority: int) -> int:
+        """所有限流器前排队中、优先级高于 priority 的调用数量（批处理据此给交互请求让路）"""
+        return sum(s.waiting_above(priority) for s in self._schedulers.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """各限流器的限制和当前占用"""
+        return {key: {**s.limiter.stats(), "pending": s.pending} for key, s in self._schedulers.items()}
+
+    def close(self):
+        """关闭共享存储"""
+        if self._store is not None:
+            self._store.close()
+            self._store = None
 
 
 # 全局速率限制器实例
 rate_limiter = RateLimiterManager()
-
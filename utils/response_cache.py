@@ -0,0 +1,178 @@
+"""
+响应缓存
+按预处理请求的规范化哈希缓存已完成的引擎结果（DeepThinkResult / UltraThinkResult）
+两级存储：内存 LRU（按字节数计算容量）+ 磁盘（服务重启后仍然有效）
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple, Union, Set
+
+from config import config
+from models import DeepThinkResult, UltraThinkResult
+from utils.sse_writer import dumps_bytes
+
+logger = logging.getLogger(__name__)
+
+EngineResult = Union[DeepThinkResult, UltraThinkResult]
+
+
+def parse_result(data: Dict[str, Any]) -> EngineResult:
+    """按 mode 字段还原引擎结果"""
+    if data.get("mode") == "ultra-think":
+        return UltraThinkResult(**data)
+    return DeepThinkResult(**data)
+
+
+class CachedEngine:
+    """直接返回缓存结果的引擎，让缓存命中复用与真实运行相同的输出流程"""
+
+    def __init__(self, result: EngineResult):
+        self.result = result
+        self.on_progress = None
+        self.on_content = None
+
+    async def run(self) -> EngineResult:
+        return self.result
+
+
+class ResponseCache:
+    """两级响应缓存；磁盘读写放在线程中执行，不阻塞事件循环"""
+
+    def __init__(self, max_memory_bytes: int, disk_dir: Optional[str] = None):
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        # key -> (过期时间, JSON 字节)，按最近使用排序
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # 后台写入任务，保持引用避免被回收
+        self._pending: Set[asyncio.Task] = set()
+
+    # ---------- 内存层 ----------
+
+    def _memory_get(self, key: str) -> Optional[bytes]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            self._memory_pop(key)
+            return None
+        self._memory.move_to_end(key)
+        return entry[1]
+
+    def _memory_put(self, key: str, expires_at: float, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return  # 单条超过容量，只存磁盘
+        self._memory_pop(key)
+        self._memory[key] = (expires_at, data)
+        self.memory_bytes += len(data)
+        # 超出容量时淘汰最久未使用的条目
+        while self.memory_bytes > self.max_memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _memory_pop(self, key: str):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= len(entry[1])
+
+    # ---------- 磁盘层 ----------
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _disk_get(self, key: str) -> Optional[Tuple[float, bytes]]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        if entry["expires_at"] <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["expires_at"], dumps_bytes(entry["result"])
+
+    def _disk_put(self, key: str, expires_at: float, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再原子替换，避免并发读到半个文件
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(b'{"expires_at":' + dumps_bytes(expires_at) + b',"result":' + data + b"}")
+        os.replace(tmp, path)
+
+    def purge_expired(self) -> int:
+        """删除磁盘上已过期的条目，返回删除数量"""
+        if not self.disk_dir or not self.disk_dir.exists():
+            return 0
+        removed = 0
+        now = time.time()
+        for path in self.disk_dir.glob("*/*.json"):
+            try:
+                with open(path, "rb") as f:
+                    expired = json.loads(f.read())["expires_at"] <= now
+            except (OSError, ValueError, KeyError):
+                expired = True
+            if expired:
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    # ---------- 对外接口 ----------
+
+    async def get(self, key: str) -> Optional[EngineResult]:
+        data = self._memory_get(key)
+        if data is None and self.disk_dir:
+            entry = await asyncio.to_thread(self._disk_get, key)
+            if entry is not None:
+                # 磁盘命中后提升到内存层
+                self._memory_put(key, *entry)
+                data = entry[1]
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return parse_result(json.loads(data))
+
+    async def set(self, key: str, result: EngineResult, ttl: float):
+        expires_at = time.time() + ttl
+        data = dumps_bytes(result.model_dump(mode="json"))
+        self._memory_put(key, expires_at, data)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_put, key, expires_at, data)
+            except OSError as e:
+                logger.warning(f"Failed to write cache entry {key}: {e}")
+
+    def set_later(self, key: str, result: EngineResult, ttl: float):
+        """在后台写入缓存（用于回调中）"""
+        task = asyncio.create_task(self.set(key, result, ttl))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+
+def cache_directives(cache_control: Optional[str]) -> Tuple[bool, bool]:
+    """解析 Cache-Control 请求头，返回 (是否读取缓存, 是否写入缓存)"""
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    if "no-store" in directives:
+        return False, False
+    return "no-cache" not in directives, True
+
+
+# 全局响应缓存（是否启用由模型的 cache_ttl 决定）
+response_cache = ResponseCache(
+    max_memory_bytes=config.response_cache_memory_mb * 1024 * 1024,
+    disk_dir=config.response_cache_dir or None,
+)
@@ -0,0 +1,120 @@
+"""
+后端调用重试
+由 OpenAIClient 自己重试（SDK 的 max_retries 设为 0），每次尝试都重新经过限流器占用配额；
+按错误类型决定是否重试，退避时间为带随机抖动的指数退避（有 retry-after 时不短于它）。
+同一请求的所有后端调用共享一份重试预算：提供商故障时重试次数受限，不会成倍放大流量
+"""
+import json
+import random
+import time
+from typing import Optional
+
+import httpx
+import openai
+
+from config import config
+from utils.circuit_breaker import CircuitOpenError
+from utils.rate_limiter import retry_after
+
+# 可重试的错误类型
+RATE_LIMIT = "rate_limit"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+EMPTY_RESPONSE = "empty_response"
+INVALID_JSON = "invalid_json"
+# 提供商熔断中：不重试，但多目标路由会切换到其他目标
+CIRCUIT_OPEN = "circuit_open"
+
+# 计入熔断器失败率的错误（提供商本身故障，限流和内容问题不算）
+PROVIDER_FAILURES = {SERVER_ERROR, TIMEOUT, CONNECTION}
+
+
+def classify_error(exc: BaseException) -> Optional[str]:
+    """返回可重试错误的类型，不应重试的错误（参数错误、鉴权失败等）返回 None"""
+    # 避免循环导入：EmptyResponseError 定义在 openai_client 中
+    from utils.openai_client import EmptyResponseError
+
+    if isinstance(exc, CircuitOpenError):
+        return CIRCUIT_OPEN
+    if isinstance(exc, EmptyResponseError):
+        return EMPTY_RESPONSE
+    if isinstance(exc, json.JSONDecodeError):
+        return INVALID_JSON
+    if isinstance(exc, openai.APITimeoutError):
+        return TIMEOUT
+    if isinstance(exc, openai.APIConnectionError):
+        return CONNECTION
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code == 429:
+            return RATE_LIMIT
+        if exc.status_code >= 500 or exc.status_code in (408, 409):
+            return SERVER_ERROR
+        return None
+    # 流式输出中途的错误：SDK 不包装读取时的传输错误，提供商在流中返回的 error 事件为 APIError
+    if isinstance(exc, httpx.TimeoutException):
+        return TIMEOUT
+    if isinstance(exc, httpx.TransportError):
+        return CONNECTION
+    if isinstance(exc, openai.APIError):
+        return SERVER_ERROR
+    return None
+
+
+def backoff_delay(attempt: int, exc: Optional[BaseException] = None) -> float:
+    """第 attempt 次重试（从 1 开始）前等待的秒数：全抖动指数退避，不短于响应的 retry-after"""
+    delay = random.uniform(0, min(config.retry_backoff_max, config.retry_backoff_base * 2 ** (attempt - 1)))
+    response = getattr(exc, "response", None)
+    if response is not None:
+        delay = max(delay, min(retry_after(response.headers) or 0.0, config.retry_backoff_max))
+    return delay
+
+
+class RetryBudget:
+    """
+    单请求的重试预算：最多重试 min_retries + ratio × 已发起调用数 次
+    正常情况下偶发的失败都能重试；大面积失败时重试比例被限制在 ratio 以内
+    """
+
+    def __init__(self, ratio: Optional[float] = None, min_retries: Optional[int] = None):
+        self.ratio = config.retry_budget_ratio if ratio is None else ratio
+        self.min_retries = config.retry_budget_min if min_retries is None else min_retries
+        self.calls = 0
+        self.retries = 0
+        self.exhausted = 0
+
+    def record_call(self):
+        """记录一次首次调用（不含重试）"""
+        self.calls += 1
+
+    def try_spend(self) -> bool:
+        """占用一次重试，预算用尽时返回 False"""
+        if self.retries >= self.min_retries + self.ratio * self.calls:
+            self.exhausted += 1
+            return False
+        self.retries += 1
+        return True
+
+
+class RetryPolicy:
+    """一次后端调用的重试决策：次数上限、请求级预算和截止时间"""
+
+    def __init__(self, max_retry: int, budget: Optional[RetryBudget], deadline: Optional[float]):
+        self.max_retry = max_retry
+        self.budget = budget
+        self.deadline = deadline
+        self.attempt = 0
+        if budget is not None:
+            budget.record_call()
+
+    def next_delay(self, exc: BaseException) -> Optional[float]:
+        """出错后是否重试：重试时返回等待秒数，否则返回 None"""
+        if classify_error(exc) in (None, CIRCUIT_OPEN) or self.attempt >= self.max_retry:
+            return None
+        delay = backoff_delay(self.attempt + 1, exc)
+        if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+            return None
+        if self.budget is not None and not self.budget.try_spend():
+            return None
+        self.attempt += 1
+        return delay
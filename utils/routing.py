@@ -0,0 +1,111 @@
+"""
+分阶段多目标路由
+一个阶段可以配置多个加权的 (模型, 提供商) 目标，每次调用按实时健康状况选择：
+权重 × 成功率 × 相对延迟，限流器有空余配额的目标优先；
+调用出错（可重试的错误）时自动切换到下一个目标，只有最后一个目标才按 max_retry 重试
+"""
+import random
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from config import StageTarget
+from utils.latency import provider_health
+from utils.openai_client import OpenAIClient
+from utils.retry import classify_error
+
+# 健康分的下限：持续出错的目标仍偶尔被选中，恢复后能重新积累样本
+MIN_HEALTH = 0.02
+
+
+class StageRouter:
+    """
+    一个阶段的多目标路由，接口与 OpenAIClient 相同（引擎传入的 model 参数由目标自己的模型代替）
+    """
+
+    def __init__(self, targets: List[Tuple[StageTarget, OpenAIClient]]):
+        self.targets = targets
+
+    def _score(self, target: StageTarget, client: OpenAIClient, best_latency: Optional[float]) -> float:
+        health = provider_health.get(client.provider_id, target.model)
+        score = target.weight * (1 - health.error_rate) ** 2
+        if best_latency and health.latency:
+            score *= best_latency / health.latency
+        return max(score, MIN_HEALTH * target.weight)
+
+    def _order(self, messages: List[Dict[str, Any]], max_tokens: Optional[int]) -> List[Tuple[StageTarget, OpenAIClient]]:
+        """按健康分加权随机排序，限流器有空余配额的目标排在前面"""
+        latencies = [
+            provider_health.get(client.provider_id, target.model).latency for target, client in self.targets
+        ]
+        best_latency = min((latency for latency in latencies if latency), default=None)
+        keyed = []
+        for target, client in self.targets:
+            score = self._score(target, client, best_latency)
+            spare = client.has_spare_capacity(target.model, messages, max_tokens)
+            # 加权随机排序：随机数的 1/score 次方越大越靠前
+            keyed.append(((spare, random.random() ** (1 / score)), (target, client)))
+        keyed.sort(key=lambda item: item[0], reverse=True)
+        return [item for _, item in keyed]
+
+    @staticmethod
+    def _can_failover(exc: BaseException) -> bool:
+        """限流、服务端错误、超时、空响应等换一个目标可能成功的错误"""
+        return isinstance(exc, Exception) and classify_error(exc) is not None
+
+    @staticmethod
+    def _messages(prompt=None, messages=None, system=None) -> List[Dict[str, Any]]:
+        """与 OpenAIClient.generate_text 相同的消息构建（只用于估算 token 数）"""
+        result = list(messages or [])
+        if prompt and messages is None:
+            result.append({"role": "user", "content": prompt})
+        if system:
+            result.insert(0, {"role": "system", "content": system})
+        return result
+
+    async def _call(self, ordered: List[Tuple[StageTarget, OpenAIClient]], method: str, *args, **kwargs):
+        """按顺序尝试各目标，可切换的错误换下一个目标"""
+        for index, (target, client) in enumerate(ordered):
+            last = index == len(ordered) - 1
+            try:
+                return await getattr(client, method)(
+                    target.model, *args, max_retry=None if last else 0, **kwargs
+                )
+            except Exception as e:
+                if last or not self._can_failover(e):
+                    raise
+                client.failovers += 1
+
+    async def generate_text(self, model: str, prompt=None, messages=None, system=None, max_tokens=None, **kwargs) -> str:
+        ordered = self._order(self._messages(prompt, messages, system), max_tokens)
+        return await self._call(
+            ordered, "generate_text", prompt=prompt, messages=messages, system=system, max_tokens=max_tokens, **kwargs
+        )
+
+    async def generate_object(self, model: str, prompt: str, response_format: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        ordered = self._order(self._messages(prompt), kwargs.get("max_tokens"))
+        return await self._call(ordered, "generate_object", prompt, response_format, **kwargs)
+
+    async def stream_text(self, model: str, messages: List[Dict[str, Any]], system=None, max_tokens=None,
+                          **kwargs) -> AsyncIterator[str]:
+        """
+        流式调用只在输出第一个块之前切换目标；
+        开始输出后中途出错不再切换，但和连接失败一样计入该目标的健康分和熔断器（由 OpenAIClient 在流结束时记录），
+        之后的调用会避开它
+        """
+        ordered = self._order(self._messages(messages=messages, system=system), max_tokens)
+        for index, (target, client) in enumerate(ordered):
+            last = index == len(ordered) - 1
+            started = False
+            stream = client.stream_text(
+                target.model, messages, system=system, max_tokens=max_tokens, max_retry=None if last else 0, **kwargs
+            )
+            try:
+                async for text in stream:
+                    started = True
+                    yield text
+                return
+            except Exception as e:
+                if started or last or not self._can_failover(e):
+                    raise
+                client.failovers += 1
+            finally:
+                await stream.aclose()
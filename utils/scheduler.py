@@ -0,0 +1,130 @@
+"""
+后端调用调度器
+所有引擎的每次阶段调用在同一个后端限流器前排队，按请求优先级和剩余期限分配 RPM 配额：
+优先级高的先走，同优先级按截止时间先后（EDF）；等待时间越长优先级逐步提升，避免饥饿。
+多个调用方（API 密钥）同时排队时，同一优先级内按权重公平轮转（虚拟时间公平排队），
+一个调用方的大批量请求不会占满其他调用方的配额
+"""
+import asyncio
+import itertools
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+_sequence = itertools.count()
+
+
+@dataclass
+class _Waiter:
+    priority: int
+    deadline: Optional[float]  # time.monotonic() 时间点
+    future: asyncio.Future
+    tenant: str = ""  # 调用方（API 密钥名称）
+    amount: float = 1  # 本次调用占用的配额（预估 token 数）
+    enqueued_at: float = field(default_factory=time.monotonic)
+    seq: int = field(default_factory=lambda: next(_sequence))
+
+    def sort_key(self, now: float, aging_seconds: float):
+        # 每等待 aging_seconds 秒优先级提升一级
+        level = self.priority + int((now - self.enqueued_at) // aging_seconds)
+        return (-level, self.deadline if self.deadline is not None else math.inf, self.seq)
+
+
+class PriorityScheduler:
+    """单个限流器前的优先级队列：由一个分发任务逐个为最优先的等待者获取配额"""
+
+    def __init__(self, limiter, aging_seconds: float = 30.0):
+        # limiter 需提供 has_capacity(amount) / acquire(amount) / release(amount, actual)（见 CompositeLimiter）
+        self.limiter = limiter
+        self.aging_seconds = aging_seconds
+        self._waiters: List[_Waiter] = []
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.dispatched = 0
+        # 公平排队：每个调用方的虚拟时间（已获得的配额 / 权重），以及最近一次分发时的虚拟时间
+        self._vtime: Dict[str, float] = {}
+        self._weights: Dict[str, float] = {}
+        self._clock = 0.0
+
+    @property
+    def pending(self) -> int:
+        return len(self._waiters)
+
+    def waiting_above(self, priority: int) -> int:
+        """排队中、优先级高于 priority 的调用数量"""
+        return sum(1 for w in self._waiters if w.priority > priority and not w.future.done())
+
+    def _charge(self, tenant: str):
+        # 分发一次，该调用方的虚拟时间前进 1/权重
+        start = self._vtime.get(tenant, self._clock)
+        self._clock = start
+        self._vtime[tenant] = start + 1 / self._weights.get(tenant, 1.0)
+
+    async def acquire(
+        self,
+        priority: int = 0,
+        deadline: Optional[float] = None,
+        tenant: str = "",
+        weight: float = 1.0,
+        amount: float = 1,
+    ):
+        """等待 amount 个配额"""
+        self._weights[tenant] = max(weight, 0.01)
+        # 无人排队且有配额时直接通过
+        if not self._waiters and self.limiter.has_capacity(amount):
+            await self.limiter.acquire(amount)
+            self._charge(tenant)
+            self.dispatched += 1
+            return
+        # 空闲后重新排队的调用方从当前虚拟时间开始，不能攒下之前未用的份额
+        if not any(w.tenant == tenant for w in self._waiters):
+            self._vtime[tenant] = max(self._vtime.get(tenant, 0.0), self._clock)
+        waiter = _Waiter(priority, deadline, asyncio.get_running_loop().create_future(), tenant, amount)
+        self._waiters.append(waiter)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # 配额已分发给本调用、但调用方在恢复执行前被取消，归还配额
+                self.limiter.release(waiter.amount, 0)
+            raise
+
+    def _pop_best(self) -> Optional[_Waiter]:
+        # 排队的调用通常只有几十个，每次分发时按当前时间重新排序即可
+        live = [w for w in self._waiters if not w.future.done()]
+        if not live:
+            self._waiters.clear()
+            return None
+        now = time.monotonic()
+        # 每个调用方排在最前的调用
+        heads = {}
+        for w in live:
+            key = w.sort_key(now, self.aging_seconds)
+            if w.tenant not in heads or key < heads[w.tenant][0]:
+                heads[w.tenant] = (key, w)
+        # 最高优先级一档内，虚拟时间最小的调用方先走
+        level = min(key[0] for key, _ in heads.values())
+        _, best = min(
+            (item for item in heads.values() if item[0][0] == level),
+            key=lambda item: (self._vtime.get(item[1].tenant, 0.0), item[0]),
+        )
+        self._waiters.remove(best)
+        self._charge(best.tenant)
+        return best
+
+    async def _dispatch(self):
+        while self._waiters:
+            waiter = self._pop_best()
+            if waiter is None:
+                return
+            await self.limiter.acquire(waiter.amount)
+            if waiter.future.done():
+                # 等待配额期间调用方已取消，归还配额
+                self.limiter.release(waiter.amount, 0)
+                continue
+            waiter.future.set_result(None)
+            self.dispatched += 1
@@ -0,0 +1,34 @@
+"""
+相同请求合并
+进行中的相同请求共享同一次引擎运行，重复提交不会再启动新的运行
+"""
+from typing import Any, Callable, Dict, Optional
+
+
+class SingleFlight:
+    """按请求键登记进行中的运行，运行结束后自动移除"""
+
+    def __init__(self):
+        self._calls: Dict[str, Any] = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._calls.get(key)
+
+    def add(self, key: str, call: Any, on_done: Callable[[Callable[[Any], None]], None]):
+        """
+        登记运行，结束时移除（只移除同一个运行，避免误删后来者）
+        on_done 用于注册结束回调，如 task.add_done_callback 或 EngineRun.on_finish
+        """
+        self._calls[key] = call
+        on_done(lambda _: self._remove(key, call))
+
+    def _remove(self, key: str, call: Any):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+# 全局相同请求合并表
+single_flight = SingleFlight()
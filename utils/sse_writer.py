@@ -0,0 +1,90 @@
+"""
+SSE 输出编码器
+每个请求预先编码 chat.completion.chunk 的固定信封（id/created/model），
+每个块只序列化 delta；同一批到达的增量合并成一次网络写入
+"""
+import json
+from typing import Optional, List, Tuple, Dict, Any
+
+try:
+    import orjson  # 可选依赖，存在时用于加速序列化
+except ImportError:
+    orjson = None
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """JSON 序列化为 UTF-8 字节（优先使用 orjson）"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def sse_frame(payload: bytes, event_id: Optional[str] = None) -> bytes:
+    """把 data 载荷包装成一个 SSE 事件，可选带 id 字段"""
+    if event_id is None:
+        return b"data: " + payload + b"\n\n"
+    return b"id: " + event_id.encode("utf-8") + b"\ndata: " + payload + b"\n\n"
+
+
+class SSEWriter:
+    """单请求的 chat.completion.chunk SSE 编码器"""
+
+    DONE_PAYLOAD = b"[DONE]"
+    DONE = b"data: [DONE]\n\n"
+    # SSE 注释行，客户端会忽略，用于防止反向代理因空闲断开连接
+    HEARTBEAT = b": keep-alive\n\n"
+
+    def __init__(self, request_id: str, created: int, model: str):
+        self.request_id = request_id
+        self.created = created
+        self.model = model
+        # 预编码固定信封：{"id":...,"choices":[{"index":0,"delta":<delta>,"finish_reason":null}]}
+        envelope = dumps_bytes({
+            "id": request_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+        })
+        self._prefix = envelope[:-1] + b',"choices":[{"index":0,"delta":'
+        self._usage_prefix = envelope[:-1] + b',"choices":[],"usage":'
+        self._suffix = b',"finish_reason":null}]}'
+
+    def payload(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        """编码单个块的 JSON 载荷（不含 SSE 包装）"""
+        if finish_reason is None:
+            return self._prefix + dumps_bytes(delta) + self._suffix
+        return (
+            self._prefix + dumps_bytes(delta)
+            + b',"finish_reason":' + dumps_bytes(finish_reason) + b"}]}"
+        )
+
+    def usage_payload(self, usage: Dict[str, Any]) -> bytes:
+        """编码 usage 块的载荷（choices 为空，与 OpenAI include_usage 一致）"""
+        return self._usage_prefix + dumps_bytes(usage) + b"}"
+
+    def payloads(self, items: List[Tuple[str, str]]) -> List[bytes]:
+        """编码一批 (字段, 文本) 增量，连续的同字段增量合并为一个块"""
+        parts: List[bytes] = []
+        field = None
+        texts: List[str] = []
+        for key, text in items:
+            if key != field and texts:
+                parts.append(self.payload({field: "".join(texts)}))
+                texts = []
+            field = key
+            texts.append(text)
+        if texts:
+            parts.append(self.payload({field: "".join(texts)}))
+        return parts
+
+    def chunk(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+        """编码单个 SSE 块"""
+        return sse_frame(self.payload(delta, finish_reason))
+
+    def deltas(self, items: List[Tuple[str, str]]) -> bytes:
+        """编码一批增量，返回可一次写出的字节串"""
+        return b"".join(sse_frame(p) for p in self.payloads(items))
+
+    def finish(self, finish_reason: str = "stop") -> bytes:
+        """结束块"""
+        return self.chunk({}, finish_reason)
@@ -2,10 +2,36 @@
 简化版思维链生成器
 把280行垃圾代码简化成50行
 """
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 from models import ProgressEvent
 
 
+# 思维链实际使用的事件类型及其字段，其余事件（solution、agent-update 等大载荷）在源头丢弃
+THINKING_EVENT_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "init": (),
+    "thinking": ("iteration",),
+    "verification": ("passed",),
+    "summarizing": (),
+    "planning": (),
+    "agent-start": ("agentId", "approach"),
+    "agent-complete": ("agentId",),
+    "synthesis": (),
+    "success": ("iterations",),
+    "failure": ("reason",),
+}
+
+
+def slim_thinking_event(event: ProgressEvent) -> Optional[ProgressEvent]:
+    """只保留思维链需要的事件和字段，不需要的返回 None"""
+    fields = THINKING_EVENT_FIELDS.get(event.type)
+    if fields is None:
+        return None
+    return ProgressEvent(
+        type=event.type,
+        data={k: event.data[k] for k in fields if k in event.data},
+    )
+
+
 def process_thinking_event(event: ProgressEvent, mode: str = "deepthink") -> str:
     """处理进度事件，生成思维链文本"""
     event_type = event.type
@@ -35,12 +61,26 @@ def process_thinking_event(event: ProgressEvent, mode: str = "deepthink") -> str
 
 class ThinkingSummaryGenerator:
     """保持接口兼容的简化版生成器"""
-    def __init__(self, mode: str = "deepthink"):
+    def __init__(self, mode: str = "deepthink", stream_drafts: bool = False):
         self.mode = mode
+        # 草稿模式下，草稿 token 直接作为思维链输出，每份草稿结束后空行分隔
+        self.stream_drafts = stream_drafts
     
     def process_event(self, event: ProgressEvent) -> str:
+        if self.stream_drafts:
+            if event.type == "draft":
+                return event.data.get("text", "")
+            if event.type == "solution":
+                return "\n\n"
         return process_thinking_event(event, self.mode)
 
+    def filter_event(self, event: ProgressEvent) -> Optional[ProgressEvent]:
+        """事件总线的源头过滤器"""
+        if self.stream_drafts and event.type == "solution":
+            # 草稿正文已经逐 token 输出，这里只保留分隔用的事件本身
+            return ProgressEvent(type="solution", data={})
+        return slim_thinking_event(event)
+
 
 class UltraThinkSummaryGenerator(ThinkingSummaryGenerator):
     """UltraThink版本"""
@@ -0,0 +1,101 @@
+"""
+Token 用量统计
+每个请求一个 UsageTracker，由该请求的所有后端客户端共享，按阶段累计用量
+"""
+from typing import Dict, Any, Optional
+
+from models import MessageContent
+
+# 无法得知图片实际 token 数时按固定值估算
+IMAGE_TOKEN_ESTIMATE = 85
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算文本 token 数：ASCII 约 4 字符/token，CJK 等多字节字符约 1 字符/token"""
+    if not text:
+        return 0
+    n_bytes = len(text.encode("utf-8"))
+    return max(1, len(text) // 4 + (n_bytes - len(text)) // 2)
+
+
+def estimate_content_tokens(content: MessageContent) -> int:
+    """估算单条消息内容（文本或多模态）的 token 数"""
+    if content is None:
+        return 0
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    tokens = 0
+    for item in content:
+        if isinstance(item, dict):
+            if item.get("type") == "text":
+                tokens += estimate_text_tokens(item.get("text", ""))
+            elif item.get("type") == "image_url":
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+def estimate_messages_tokens(messages) -> int:
+    """估算消息列表的 prompt token 数（每条消息额外计 4 个格式 token）"""
+    return sum(estimate_content_tokens(m.get("content")) + 4 for m in messages or [])
+
+
+class UsageTracker:
+    """单请求的 token 用量，按阶段累计"""
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, int]] = {}
+
+    def record(
+        self,
+        stage: Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+        estimated: bool = False,
+    ):
+        """记录一次后端调用的用量，estimated 表示提供商未返回用量、由本地估算"""
+        stats = self._stages.get(stage or "default")
+        if stats is None:
+            stats = self._stages[stage or "default"] = {
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+                "estimated_calls": 0,
+            }
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        stats["total_tokens"] += prompt_tokens + completion_tokens
+        if estimated:
+            stats["estimated_calls"] += 1
+
+    @property
+    def calls(self) -> int:
+        return sum(s["calls"] for s in self._stages.values())
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(s["prompt_tokens"] for s in self._stages.values())
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(s["completion_tokens"] for s in self._stages.values())
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def by_stage(self) -> Dict[str, Dict[str, int]]:
+        """按阶段的用量明细"""
+        return {stage: dict(stats) for stage, stats in self._stages.items()}
+
+    def to_dict(self, include_stages: bool = False) -> Dict[str, Any]:
+        """OpenAI 兼容的 usage 字典，可选附带阶段明细"""
+        usage: Dict[str, Any] = {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+        if include_stages:
+            usage["stage_usage"] = self.by_stage()
+        return usage